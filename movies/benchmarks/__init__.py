@@ -0,0 +1,8 @@
+""" Benchmarks of the movie service. Run them from the movies directory, eg: python -m benchmarks.filter_benchmark """
+import os
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'movies.settings')
+    import django
+    django.setup()
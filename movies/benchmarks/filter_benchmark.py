@@ -0,0 +1,57 @@
+""" Compares filtering the movies of an artist through the precomputed index with the scan it replaced """
+import logging
+import random
+import timeit
+
+from benchmarks import setup_django
+
+setup_django()
+logging.disable(logging.CRITICAL)  # the scan logs every movie it adds, which would swamp the timings
+
+from movies_api.models import Key, Movie, Movies  # noqa: E402
+from movies_api.movie_requests import _filtered  # noqa: E402
+
+GENRES = ['Comedy', 'Drama', 'Thriller', 'Action & Adventure', 'Kids & Family', 'Romance', 'Horror', 'Documentary']
+
+
+def scan_filtered(movies, key):
+    """ The filtering as it was before the index: a scan that rebuilds every matching movie """
+    filtered_movies = Movies(key)
+    for movie in movies.all_movies():
+        track_name, release_date, genre = movie['name'], movie['release date'], movie['genre']
+        genre_matches = key.get_genre() == 'all' or genre.lower() == key.get_genre().lower()
+        release_date_matches = key.get_release_date() == 9999 or release_date == key.get_release_date()
+        if genre_matches and release_date_matches:
+            filtered_movies.add(Movie(track_name, release_date, genre))
+    return filtered_movies
+
+
+def artist_movies(count):
+    rng = random.Random(count)
+    movies = Movies(Key('kevin', 'hart'))
+    for i in range(count):
+        movies.add(Movie(f'title {i}', f'{rng.randint(1990, 2021)}-07-03T07:00:00Z', rng.choice(GENRES)))
+    movies.build_index()
+    return movies
+
+
+def main():
+    queries = {
+        'genre': Key('kevin', 'hart', genre='comedy'),
+        'release date': Key('kevin', 'hart', release_date=2013),
+        'genre and release date': Key('kevin', 'hart', genre='comedy', release_date=2013),
+    }
+    print(f"{'titles':>6} {'filter':<24} {'matches':>7} {'scan µs':>9} {'index µs':>9} {'speedup':>8}")
+    for count in (100, 300, 800):
+        movies = artist_movies(count)
+        for name, key in queries.items():
+            assert scan_filtered(movies, key).all_movies() == _filtered(movies, key).all_movies()
+            runs = 2000
+            scan = timeit.timeit(lambda: scan_filtered(movies, key), number=runs) / runs * 1e6
+            index = timeit.timeit(lambda: _filtered(movies, key), number=runs) / runs * 1e6
+            matches = len(_filtered(movies, key).all_movies())
+            print(f'{count:>6} {name:<24} {matches:>7} {scan:>9.1f} {index:>9.1f} {scan / index:>7.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+""" Compares the time and peak memory of parsing iTunes responses of 50 and 200 results, in full and in projection
+    mode, and of encoding our responses, with the standard library and with orjson
+"""
+import json
+import logging
+import random
+import timeit
+import tracemalloc
+
+from benchmarks import setup_django
+
+setup_django()
+logging.disable(logging.CRITICAL)
+
+from movies_api import json_codec  # noqa: E402
+from movies_api.movie_requests import API_FIELDS  # noqa: E402
+
+GENRES = ['Comedy', 'Drama', 'Thriller', 'Action & Adventure', 'Kids & Family', 'Romance', 'Horror', 'Documentary']
+
+
+def itunes_response(count):
+    """ A response shaped like those of iTunes, with all the fields of its movie results """
+    rng = random.Random(count)
+    results = [{
+        'wrapperType': 'track', 'kind': 'feature-movie', 'trackId': 1000000 + i, 'artistName': 'Some Director',
+        'trackName': f'Title {i}', 'trackCensoredName': f'Title {i}',
+        'trackViewUrl': f'https://itunes.apple.com/us/movie/title-{i}/id{1000000 + i}?uo=4',
+        'previewUrl': 'https://video-ssl.itunes.apple.com/itunes-assets/Video/v4/ab/cd/ef/'
+                      'mzvf_1.640x354.h264lc.U.p.m4v',
+        'artworkUrl30': 'https://is1-ssl.mzstatic.com/image/thumb/Video/v4/ab/cd/ef/source/30x30bb.jpg',
+        'artworkUrl60': 'https://is1-ssl.mzstatic.com/image/thumb/Video/v4/ab/cd/ef/source/60x60bb.jpg',
+        'artworkUrl100': 'https://is1-ssl.mzstatic.com/image/thumb/Video/v4/ab/cd/ef/source/100x100bb.jpg',
+        'collectionPrice': 9.99, 'trackPrice': 9.99, 'trackRentalPrice': 3.99, 'collectionHdPrice': 12.99,
+        'trackHdPrice': 12.99, 'trackHdRentalPrice': 3.99,
+        'releaseDate': f'{rng.randint(1990, 2021)}-07-03T07:00:00Z',
+        'collectionExplicitness': 'notExplicit', 'trackExplicitness': 'notExplicit', 'trackTimeMillis': 5830000,
+        'country': 'USA', 'currency': 'USD', 'primaryGenreName': rng.choice(GENRES), 'contentAdvisoryRating': 'PG-13',
+        'shortDescription': 'A short description of the movie. ' * 3,
+        'longDescription': 'A much longer description of the movie, which goes on for a while. ' * 10,
+        'hasITunesExtras': True,
+    } for i in range(count)]
+    return json.dumps({'resultCount': count, 'results': results}).encode()
+
+
+def measure(fn, runs=200):
+    """ Gets the microseconds a call takes and the KB it allocates at its peak """
+    fn()
+    took = timeit.timeit(fn, number=runs) / runs * 1e6
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return took, peak / 1024
+
+
+def main():
+    print(f"orjson is {'installed' if json_codec.orjson else 'not installed, its rows are skipped'}")
+    print(f"{'results':>7} {'bytes':>7} {'operation':<28} {'µs':>8} {'peak KB':>8}")
+    for count in (50, 200):
+        content = itunes_response(count)
+        rows = [{'name': name, 'release date': int(date[:4]), 'genre': genre}
+                for name, date, genre in json_codec.load_results(content, API_FIELDS, projection=True)]
+        operations = {
+            'parse full, stdlib': lambda: [tuple(map(r.get, API_FIELDS)) for r in json.loads(content)['results']],
+            'parse projection, stdlib': lambda: json_codec.load_results(content, API_FIELDS, projection=True),
+            'encode, stdlib': lambda: json.dumps({'kevin hart': rows}),
+        }
+        if json_codec.orjson:
+            orjson = json_codec.orjson
+            operations.update({
+                'parse full, orjson': lambda: [tuple(map(r.get, API_FIELDS)) for r in orjson.loads(content)['results']],
+                'encode, orjson': lambda: orjson.dumps({'kevin hart': rows}).decode(),
+            })
+        for name, operation in sorted(operations.items(), key=lambda item: item[0].split(',')[0]):
+            took, peak = measure(operation)
+            print(f"{count:>7} {len(content):>7} {name:<28} {took:>8.0f} {peak:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+""" Replays a request log and reports the cache hit rate with the keys as they were before canonicalization and with
+    the canonical keys. Both are counted against an unbounded cache, ie the hits within one freshness window.
+
+    The log holds one request per line, either as the url of the request or its query string, eg:
+        /api/v1/movies?firstname=Kevin&lastname=Hart&genre=comedy
+    Without a log, a synthetic one is made with the spelling variants seen in real traffic.
+
+    Usage: python -m benchmarks.key_canonicalization_report [request log]
+"""
+import random
+import sys
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+from benchmarks import setup_django
+
+setup_django()
+
+from movies_api.models import Key  # noqa: E402
+
+ARTISTS = [('kevin', 'hart'), ('brad', 'pitt'), ('beyoncé', 'knowles'), ('penélope', 'cruz'), ('will', 'smith'),
+           ('dwayne', 'johnson'), ('zoë', 'saldaña'), ('renée', 'zellweger'), ('samuel l.', 'jackson'),
+           ('tom', 'hanks'), ('meryl', 'streep'), ('chloë', 'moretz'), ('gael', 'garcía bernal'), ('emma', 'stone')]
+
+
+def variant(name, rng):
+    choice = rng.random()
+    if choice < 0.5:
+        return name
+    if choice < 0.7:
+        return name.title()
+    if choice < 0.8:
+        return name.upper()
+    if choice < 0.9:
+        return f' {name}  '
+    return name.replace('é', 'e').replace('ë', 'e').replace('í', 'i').replace('ñ', 'n')
+
+
+def synthetic_log(size=20000, seed=7):
+    rng = random.Random(seed)
+    weights = [1 / rank for rank in range(1, len(ARTISTS) + 1)]  # popularity falls off like a zipf distribution
+    for firstname, lastname in rng.choices(ARTISTS, weights, k=size):
+        yield variant(firstname, rng), variant(lastname, rng)
+
+
+def logged_requests(path):
+    with open(path, encoding='utf-8') as log:
+        for line in log:
+            query = parse_qs(urlsplit(line.strip()).query or line.strip())
+            if 'firstname' in query and 'lastname' in query:
+                yield query['firstname'][0], query['lastname'][0]
+
+
+def hit_rate(keys):
+    seen, hits = set(), 0
+    for key in keys:
+        hits += key in seen
+        seen.add(key)
+    return hits, len(seen)
+
+
+def main():
+    requests = list(logged_requests(sys.argv[1]) if len(sys.argv) > 1 else synthetic_log())
+    raw_hits, raw_keys = hit_rate(f'{firstname}_{lastname}' for firstname, lastname in requests)
+    canonical_hits, canonical_keys = hit_rate(Key(firstname, lastname).as_key() for firstname, lastname in requests)
+
+    print(f'requests replayed: {len(requests)}')
+    print(f"{'keys':<10} {'distinct':>8} {'hit rate':>9} {'upstream calls':>15}")
+    print(f"{'raw':<10} {raw_keys:>8} {raw_hits / len(requests):>9.2%} {len(requests) - raw_hits:>15}")
+    print(f"{'canonical':<10} {canonical_keys:>8} {canonical_hits / len(requests):>9.2%} "
+          f"{len(requests) - canonical_hits:>15}")
+    print(f'upstream calls saved: {raw_keys - canonical_keys} ({1 - canonical_keys / raw_keys:.1%})')
+
+
+if __name__ == '__main__':
+    main()
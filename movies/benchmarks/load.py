@@ -0,0 +1,242 @@
+""" Load driver for /api/v1/movies. It starts the stand-ins for memcached and iTunes, serves the service in a separate
+    process pointed at them and runs these workloads against it:
+
+    cold      every request is for an artist not requested before, so every request goes to iTunes
+    warm      requests for a pool of artists that are all cached
+    filtered  requests for the cached artists filtered by genre, release year or both
+    mixed     70% warm, 20% filtered and 10% cold
+
+    It reports the requests per second, the p50, p95 and p99 latencies and the memory of the service for each, and
+    writes them as json so runs can be compared, eg:
+    python -m benchmarks.load --requests 2000 --concurrency 16 --compare benchmarks/results/load-20211004-101500.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+
+import requests
+
+from movies_api.testing.itunes_stub import GENRES
+from movies_api.testing.itunes_stub import ITunesStub
+from movies_api.testing.memcached_stub import MemcachedStub
+
+WORKLOADS = ('cold', 'warm', 'filtered', 'mixed')
+RESULTS_DIR = Path(__file__).parent / 'results'
+
+
+class Service:
+    """ The service under load, served by benchmarks.serve in a child process """
+
+    def __init__(self, memcached: list, itunes: ITunesStub, profile='full'):
+        self.database = tempfile.TemporaryDirectory()  # so that every run starts without a snapshot of the cache
+        env = dict(os.environ, BENCH_MEMCACHED=','.join(node.location for node in memcached), BENCH_ITUNES=itunes.url,
+                   BENCH_PROFILE=profile, BENCH_DATABASE=os.path.join(self.database.name, 'db.sqlite3'))
+        self.process = subprocess.Popen([sys.executable, '-m', 'benchmarks.serve', '--port', '0'],
+                                        cwd=Path(__file__).parent.parent, env=env, stdout=subprocess.PIPE, text=True)
+        line = self.process.stdout.readline()
+        if not line.startswith('serving on '):
+            self.process.kill()
+            raise RuntimeError(f"The service did not start: {line!r}")
+        self.url = line.split()[-1]
+
+    def memory(self):
+        """ Gets the resident and peak resident memory of the service in MB, None where /proc is not available """
+        try:
+            status = Path(f'/proc/{self.process.pid}/status').read_text()
+        except OSError:
+            return None, None
+        fields = dict(line.split(':', 1) for line in status.splitlines() if ':' in line)
+        return (int(fields['VmRSS'].split()[0]) / 1024 if 'VmRSS' in fields else None,
+                int(fields['VmHWM'].split()[0]) / 1024 if 'VmHWM' in fields else None)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(timeout=10)
+        self.database.cleanup()
+
+
+class Paths:
+    """ Makes the paths requested by each workload. Cold artists are never repeated within a run """
+
+    def __init__(self, pool_size, seed):
+        self.random = random.Random(seed)
+        self.run = f'{seed}x{int(time.time())}'
+        self.pool = [f'/api/v1/movies/?firstname=warm{i}&lastname=artist' for i in range(pool_size)]
+        self.cold = 0
+
+    def next_cold(self):
+        self.cold += 1
+        return f'/api/v1/movies/?firstname=cold{self.cold}&lastname=run{self.run}'
+
+    def next_filtered(self):
+        path = self.random.choice(self.pool)
+        genre = self.random.choice(GENRES).replace('&', '%26').replace(' ', '+')
+        year = self.random.randint(1990, 2021)
+        filters = [f'&genre={genre}', f'&releaseDate={year}', f'&genre={genre}&releaseDate={year}']
+        return path + self.random.choice(filters)
+
+    def make(self, workload, count):
+        if workload == 'cold':
+            return [self.next_cold() for _ in range(count)]
+        if workload == 'warm':
+            return [self.random.choice(self.pool) for _ in range(count)]
+        if workload == 'filtered':
+            return [self.next_filtered() for _ in range(count)]
+        choices = [self.random.random() for _ in range(count)]
+        return [self.random.choice(self.pool) if choice < 0.7 else self.next_filtered() if choice < 0.9
+                else self.next_cold() for choice in choices]
+
+
+def drive(base_url, paths, concurrency):
+    """ Requests the paths with as many threads as the concurrency, returning the latency in seconds and the status of
+        each request along with the time all of them took
+    """
+    results = []
+    lock = threading.Lock()
+    remaining = iter(paths)
+
+    def worker():
+        session = requests.Session()
+        recorded = []
+        while True:
+            with lock:
+                path = next(remaining, None)
+            if path is None:
+                break
+            start = time.perf_counter()
+            try:
+                status = session.get(base_url + path, timeout=30).status_code
+            except requests.RequestException:
+                status = 'error'
+            recorded.append((time.perf_counter() - start, status))
+        with lock:
+            results.extend(recorded)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def percentile(ordered, share):
+    """ Nearest rank percentile of sorted values """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(share * len(ordered)) - 1))]
+
+
+def summarize(workload, results, elapsed, concurrency, service, memcached, itunes, upstream_before, commands_before):
+    latencies = sorted(latency for latency, _ in results)
+    rss, peak = service.memory()
+    return {
+        'workload': workload,
+        'requests': len(results),
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'rps': round(len(results) / elapsed, 1) if elapsed else None,
+        'latency_ms': {name: round(percentile(latencies, share) * 1000, 2) for name, share in
+                       (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1.0))} if latencies else None,
+        'statuses': {str(status): count for status, count in sorted(Counter(s for _, s in results).items(), key=str)},
+        'upstream_requests': itunes.requests - upstream_before,
+        'memcached_commands': sum(node.commands for node in memcached) - commands_before,
+        'rss_mb': rss and round(rss, 1),
+        'peak_rss_mb': peak and round(peak, 1),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def print_summary(summary, baseline=None):
+    latency = summary['latency_ms'] or {}
+    line = (f"{summary['workload']:<9} {summary['requests']:>7} {summary['rps']:>9} {latency.get('p50'):>8} "
+            f"{latency.get('p95'):>8} {latency.get('p99'):>8} {summary['upstream_requests']:>8} "
+            f"{summary['peak_rss_mb']!s:>8}")
+    if baseline is not None and baseline.get('rps') and baseline.get('latency_ms'):
+        line += (f"   rps {(summary['rps'] / baseline['rps'] - 1) * 100:+.1f}%, "
+                 f"p95 {(latency['p95'] / baseline['latency_ms']['p95'] - 1) * 100:+.1f}%")
+    print(line, flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Drives load at /api/v1/movies against stand-ins for its backends")
+    parser.add_argument('--workloads', nargs='+', choices=WORKLOADS, default=list(WORKLOADS))
+    parser.add_argument('--requests', type=int, default=2000, help="Requests per workload")
+    parser.add_argument('--concurrency', type=int, default=16, help="Requests in flight at once")
+    parser.add_argument('--pool', type=int, default=200, help="Artists cached for the warm and filtered workloads")
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds the iTunes stub takes to answer")
+    parser.add_argument('--jitter', type=float, default=0.02, help="Up to this many seconds added to the latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of iTunes requests failing with a 503")
+    parser.add_argument('--results', type=int, default=50, help="Movies per artist returned by the iTunes stub")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--profile', choices=('full', 'api'), default='full',
+                        help="Settings to serve with, movies.settings or movies.settings_api")
+    parser.add_argument('--memcached-nodes', type=int, default=1, help="Memcached stand-ins the cache is sharded over")
+    parser.add_argument('--output', type=Path, help="File to write the results to, by default a new file in "
+                                                    "benchmarks/results")
+    parser.add_argument('--compare', type=Path, help="Results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    memcached = [MemcachedStub().start() for _ in range(args.memcached_nodes)]
+    itunes = ITunesStub(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, results=args.results,
+                        seed=args.seed).start()
+    service = Service(memcached, itunes, args.profile)
+    baseline = {}
+    if args.compare:
+        baseline = {run['workload']: run for run in json.loads(args.compare.read_text())['workloads']}
+
+    try:
+        paths = Paths(args.pool, args.seed)
+        if {'warm', 'filtered', 'mixed'} & set(args.workloads):
+            drive(service.url, paths.pool, args.concurrency)  # fills the cache for the pool, not measured
+
+        print(f"{'workload':<9} {'requests':>7} {'rps':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'upstream':>8} "
+              f"{'peak MB':>8}")
+        summaries = []
+        for workload in args.workloads:
+            upstream_before, commands_before = itunes.requests, sum(node.commands for node in memcached)
+            results, elapsed = drive(service.url, paths.make(workload, args.requests), args.concurrency)
+            summary = summarize(workload, results, elapsed, args.concurrency, service, memcached, itunes,
+                                upstream_before, commands_before)
+            summaries.append(summary)
+            print_summary(summary, baseline.get(workload))
+    finally:
+        service.stop()
+        itunes.stop()
+        for node in memcached:
+            node.stop()
+
+    output = args.output or RESULTS_DIR / f"load-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps({
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'config': {name: str(value) if isinstance(value, Path) else value for name, value in vars(args).items()},
+        'workloads': summaries,
+    }, indent=2))
+    print(f"Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
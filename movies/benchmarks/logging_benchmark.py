@@ -0,0 +1,112 @@
+""" Measures what logging costs the request threads, with logging off, with DEBUG records written synchronously as
+    before, with DEBUG records written through the queue and with the queue and sampling, for:
+
+    request  a request for a cached artist filtered by genre, through the view
+    parse    turning an iTunes response of 50 movies into the movies of an artist, which logs for every movie
+
+    Records are written to a temporary file and to a console that takes 50µs for every write, as a terminal or a
+    pipe read by a log collector does under load, eg: python -m benchmarks.logging_benchmark
+"""
+import logging
+import logging.config
+import random
+import tempfile
+import time
+import timeit
+from unittest import mock
+
+from benchmarks import setup_django
+
+setup_django()
+
+from django.test import RequestFactory  # noqa: E402
+
+from benchmarks.json_benchmark import itunes_response  # noqa: E402
+from movies_api import movie_requests  # noqa: E402
+from movies_api import views  # noqa: E402
+from movies_api.models import Key, Movie, Movies  # noqa: E402
+from movies_api.responses import ResponseCache  # noqa: E402
+
+logging.disable(logging.NOTSET)  # turned off by the json benchmark on import
+
+GENRES = ['Comedy', 'Drama', 'Thriller', 'Action & Adventure', 'Kids & Family', 'Romance', 'Horror', 'Documentary']
+
+SYNC = {'class': 'logging.StreamHandler', 'formatter': 'verbose'}
+QUEUED = {'()': 'movies_api.log.QueuedHandler', 'handler': 'logging.StreamHandler', 'formatter': 'verbose'}
+MODES = {
+    'off': (SYNC, 'WARNING', []),
+    'sync DEBUG': (SYNC, 'DEBUG', []),
+    'queued DEBUG': (QUEUED, 'DEBUG', []),
+    'queued DEBUG, sampled': (QUEUED, 'DEBUG', ['sampling']),
+}
+
+
+class SlowConsole:
+    """ Stream whose writes wait as a console or a busy pipe would, without holding the GIL """
+
+    def __init__(self, delay=0.00005):
+        self.delay = delay
+
+    def write(self, text):
+        time.sleep(self.delay)
+
+    def flush(self):
+        pass
+
+
+def configure(log, handler, level, filters):
+    logging.config.dictConfig({
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {'verbose': {'format': '{levelname} {asctime} {module}: {message}', 'style': '{'}},
+        'filters': {'sampling': {'()': 'movies_api.log.SamplingFilter', 'rates': {'movies_api.models': 0.01}}},
+        'handlers': {'out': dict(handler, stream=log, filters=filters)},
+        'root': {'handlers': ['out'], 'level': level},
+    })
+
+
+def cached_artist():
+    rng = random.Random(1)
+    key = Key('kevin', 'hart')
+    movies = Movies(key)
+    for i in range(50):
+        movies.add(Movie(f'title {i}', f'{rng.randint(1990, 2021)}-07-03T07:00:00Z', rng.choice(GENRES)))
+    cache = movie_requests.CacheSpi(in_memory=True)
+    cache.save_movies(key, movies)
+    return cache
+
+
+def main(runs=1000, rounds=5):
+    cache = cached_artist()
+    request = RequestFactory().get('/api/v1/movies/', {'firstname': 'kevin', 'lastname': 'hart', 'genre': 'comedy'})
+    content = itunes_response(50)
+    key = Key('kevin', 'hart')
+    operations = {
+        'request': lambda: views.actor_movies(request),
+        'parse': lambda: movie_requests.to_movies(key, 200, content),
+    }
+    best = {mode: [float('inf')] * len(operations) * 2 for mode in MODES}
+    with tempfile.TemporaryFile('w') as log, mock.patch.object(movie_requests, 'cache_spi', cache), \
+            mock.patch.object(movie_requests, 'response_cache', ResponseCache(None)):
+        sinks = (log, SlowConsole())
+        for _ in range(rounds):  # the modes take turns, so that each sees the machine in the same state
+            for mode, (handler, level, filters) in MODES.items():
+                for s, sink in enumerate(sinks):
+                    configure(sink, handler, level, filters)
+                    for o, operation in enumerate(operations.values()):
+                        operation()
+                        took = timeit.timeit(operation, number=runs) / runs * 1e6
+                        i = s * len(operations) + o
+                        best[mode][i] = min(best[mode][i], took)
+                    for configured in logging.getLogger().handlers:
+                        configured.flush()
+        logging.config.dictConfig({'version': 1, 'disable_existing_loggers': False, 'root': {'level': 'WARNING'}})
+
+    print(f"{'':<22} {'to a file':^21} {'to a slow console':^21}")
+    print(f"{'logging':<22} " + f"{'request µs':>10} {'parse µs':>10} " * len(sinks))
+    for mode, took in best.items():
+        print(f"{mode:<22} " + ' '.join(f'{value:>10.1f}' for value in took))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+""" Measures the memory held per artist in the local cache tier: the movies of each artist as decoded from memcached,
+    along with their index, for artists of 20, 50 and 200 movies, next to the size the local cache estimates for them
+"""
+import gc
+import logging
+import random
+import tracemalloc
+
+from benchmarks import setup_django
+
+setup_django()
+logging.disable(logging.CRITICAL)
+
+from movies_api.models import Key, Movie, Movies  # noqa: E402
+from movies_api.movie_requests import CacheEntry, estimated_size, from_stored, to_stored  # noqa: E402
+
+GENRES = ['Comedy', 'Drama', 'Thriller', 'Action & Adventure', 'Kids & Family', 'Romance', 'Horror', 'Documentary']
+WORDS = ['the', 'secret', 'life', 'of', 'pets', 'central', 'intelligence', 'jumanji', 'next', 'level', 'ride', 'along']
+ARTISTS = 500
+
+
+def stored_artist(i, count):
+    """ An artist as stored in memcached """
+    rng = random.Random(i)
+    movies = Movies(Key(f'artist{i}', 'lastname'))
+    for _ in range(count):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 5))).title()
+        movies.add(Movie(title, f'{rng.randint(1990, 2021)}-07-03T07:00:00Z', rng.choice(GENRES)))
+    movies.version = movies.content_hash()
+    return to_stored(CacheEntry(movies))
+
+
+def main():
+    print(f"{'movies':>6} {'bytes per artist':>17} {'bytes per movie':>16} {'estimated':>10}")
+    for count in (20, 50, 200):
+        stored = [stored_artist(i, count) for i in range(ARTISTS)]
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        held = []
+        for value in stored:
+            entry = from_stored(value)
+            entry.movies.build_index()
+            held.append(entry)
+        gc.collect()
+        used = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        print(f"{count:>6} {used / ARTISTS:>17,.0f} {used / ARTISTS / count:>16,.0f} {estimated_size(held[0]):>10,}")
+
+
+if __name__ == '__main__':
+    main()
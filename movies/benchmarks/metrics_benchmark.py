@@ -0,0 +1,62 @@
+""" Measures what recording metrics costs a request, and compares the per thread shards with a counter behind a lock
+    when many threads record at once
+"""
+import threading
+import time
+import timeit
+
+from movies_api.metrics import Registry
+
+THREADS = 8
+PER_THREAD = 200000
+
+
+class LockedCounter:
+    """ The alternative to the shards: one dict shared by all threads behind a lock """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+def contended(inc):
+    def record():
+        for _ in range(PER_THREAD):
+            inc('hit')
+
+    threads = [threading.Thread(target=record) for _ in range(THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return (time.perf_counter() - start) / (THREADS * PER_THREAD) * 1e9
+
+
+def main():
+    registry = Registry()
+    counter = registry.counter('lookups_total', "Lookups", ('result',))
+    histogram = registry.histogram('stage_seconds', "Stages", ('stage',))
+
+    def timed():
+        with histogram.time('lookup'):
+            pass
+
+    runs = 200000
+    print(f"{'operation':<32} {'ns':>8}")
+    print(f"{'counter inc':<32} {timeit.timeit(lambda: counter.inc('hit'), number=runs) / runs * 1e9:>8.0f}")
+    print(f"{'histogram observe':<32} "
+          f"{timeit.timeit(lambda: histogram.observe(0.003, 'lookup'), number=runs) / runs * 1e9:>8.0f}")
+    print(f"{'histogram time block':<32} {timeit.timeit(timed, number=runs) / runs * 1e9:>8.0f}")
+    print(f"{f'sharded inc, {THREADS} threads':<32} {contended(counter.inc):>8.0f}")
+    print(f"{f'locked inc, {THREADS} threads':<32} {contended(LockedCounter().inc):>8.0f}")
+    render = timeit.timeit(registry.render, number=1000) / 1000 * 1e6
+    print(f"render with {len(registry._shards)} shards: {render:.0f} µs")
+
+
+if __name__ == '__main__':
+    main()
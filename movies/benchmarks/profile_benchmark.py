@@ -0,0 +1,97 @@
+""" Compares the full settings profile, movies.settings, with the api profile, movies.settings_api, on:
+
+    startup   seconds for a new process to set up Django and load the urls, median of several processes
+    requests  requests per second for a cached artist through the WSGI handler, in process and on one thread, which
+              is the cost of the Django machinery and of the view without any network in between
+
+    Each profile runs in its own processes, against the stand-ins for memcached and iTunes, eg:
+    python -m benchmarks.profile_benchmark --requests 5000
+"""
+import argparse
+import io
+import os
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from movies_api.testing.itunes_stub import ITunesStub
+from movies_api.testing.memcached_stub import MemcachedStub
+
+PROFILES = ('full', 'api')
+PATH = '/api/v1/movies/'
+QUERY = 'firstname=kevin&lastname=hart'
+
+
+def startup():
+    """ Runs in the child: sets up Django and loads the urls, as the first request would """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    from django.core.wsgi import get_wsgi_application
+    from django.urls import get_resolver
+    get_wsgi_application()
+    get_resolver().resolve(PATH)
+
+
+def serve(count):
+    """ Runs in the child: times count requests for a cached artist through the WSGI handler """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    from django.core.wsgi import get_wsgi_application
+    application = get_wsgi_application()
+
+    def request():
+        environ = {
+            'REQUEST_METHOD': 'GET', 'PATH_INFO': PATH, 'QUERY_STRING': QUERY, 'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1', 'wsgi.input': io.BytesIO(), 'wsgi.errors': sys.stderr,
+            'wsgi.url_scheme': 'http', 'wsgi.multithread': True, 'wsgi.multiprocess': False, 'wsgi.run_once': False,
+        }
+        statuses = []
+        body = b''.join(application(environ, lambda status, headers, exc_info=None: statuses.append(status)))
+        assert statuses[0].startswith('200') and body, statuses
+
+    for _ in range(100):  # fills the caches
+        request()
+    start = time.perf_counter()
+    for _ in range(count):
+        request()
+    print(count / (time.perf_counter() - start))
+
+
+def run_child(profile, env, *args):
+    return subprocess.run([sys.executable, '-m', 'benchmarks.profile_benchmark', '--child', *args],
+                          cwd=Path(__file__).parent.parent, env=dict(env, BENCH_PROFILE=profile), check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the startup time and requests per second of the settings "
+                                                 "profiles")
+    parser.add_argument('--requests', type=int, default=5000, help="Requests timed for each profile")
+    parser.add_argument('--startups', type=int, default=7, help="Processes started for each profile")
+    parser.add_argument('--log-level', default='profile', help="Level to log at, by default that of each profile")
+    parser.add_argument('--child', nargs='+', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        startup() if args.child[0] == 'startup' else serve(int(args.child[1]))
+        return
+
+    memcached = MemcachedStub().start()
+    itunes = ITunesStub(latency=0, jitter=0).start()
+    env = dict(os.environ, BENCH_MEMCACHED=memcached.location, BENCH_ITUNES=itunes.url, BENCH_LOG_LEVEL=args.log_level)
+    try:
+        print(f"{'profile':<8} {'startup ms':>10} {'requests/s':>10}")
+        for profile in PROFILES:
+            took = []
+            for _ in range(args.startups):
+                start = time.perf_counter()
+                run_child(profile, env, 'startup')
+                took.append(time.perf_counter() - start)
+            rps = float(run_child(profile, env, 'serve', str(args.requests)))
+            print(f"{profile:<8} {statistics.median(took) * 1000:>10.0f} {rps:>10.0f}", flush=True)
+    finally:
+        itunes.stop()
+        memcached.stop()
+
+
+if __name__ == '__main__':
+    main()
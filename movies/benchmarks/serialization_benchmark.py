@@ -0,0 +1,54 @@
+""" Compares the size and the encode and decode times of cached entries in the binary format and as pickles """
+import logging
+import pickle
+import random
+import timeit
+
+from benchmarks import setup_django
+
+setup_django()
+logging.disable(logging.CRITICAL)
+
+from movies_api.models import Key, Movie, Movies  # noqa: E402
+from movies_api.movie_requests import CacheEntry, from_stored  # noqa: E402
+from movies_api.serialization import encode_entry  # noqa: E402
+
+GENRES = ['Comedy', 'Drama', 'Thriller', 'Action & Adventure', 'Kids & Family', 'Romance', 'Horror', 'Documentary']
+WORDS = ['the', 'secret', 'life', 'of', 'pets', 'central', 'intelligence', 'jumanji', 'next', 'level', 'ride', 'along']
+
+
+def cache_entry(count):
+    rng = random.Random(count)
+    movies = Movies(Key('kevin', 'hart'))
+    for _ in range(count):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 5))).title()
+        movies.add(Movie(title, f'{rng.randint(1990, 2021)}-07-03T07:00:00Z', rng.choice(GENRES)))
+    movies.version = movies.content_hash()
+    return CacheEntry(movies)
+
+
+def time_us(fn, runs=500, repeat=5):
+    """ The fastest of repeat timings, which is the least disturbed by other processes """
+    return min(timeit.repeat(fn, number=runs, repeat=repeat)) / runs * 1e6
+
+
+def main():
+    print(f"{'titles':>6} {'format':<18} {'bytes':>7} {'encode µs':>10} {'decode µs':>10}")
+    for count in (50, 200, 800):
+        entry = cache_entry(count)
+        pickled = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        formats = {
+            'pickle': (lambda: pickle.dumps(entry, pickle.HIGHEST_PROTOCOL), lambda: pickle.loads(pickled)),
+            'binary': (lambda: encode_entry(entry, compress_min_bytes=1 << 30),
+                       lambda: from_stored(plain)),
+            'binary + zlib': (lambda: encode_entry(entry, compress_min_bytes=0), lambda: from_stored(compressed)),
+        }
+        plain = encode_entry(entry, compress_min_bytes=1 << 30)
+        compressed = encode_entry(entry, compress_min_bytes=0)
+        sizes = {'pickle': len(pickled), 'binary': len(plain), 'binary + zlib': len(compressed)}
+        for name, (encode, decode) in formats.items():
+            print(f'{count:>6} {name:<18} {sizes[name]:>7} {time_us(encode):>10.1f} {time_us(decode):>10.1f}')
+
+
+if __name__ == '__main__':
+    main()
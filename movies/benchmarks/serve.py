@@ -0,0 +1,38 @@
+""" Serves the service with a threaded WSGI server for the load driver, eg:
+    BENCH_MEMCACHED=127.0.0.1:11211 python -m benchmarks.serve --port 8000
+"""
+import argparse
+import os
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIRequestHandler
+from wsgiref.simple_server import WSGIServer
+from wsgiref.simple_server import make_server
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the service for the load driver")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'benchmarks.settings')
+    from django.core.management import call_command
+    from django.core.wsgi import get_wsgi_application
+    application = get_wsgi_application()
+    call_command('migrate', verbosity=0)  # for the snapshot of the cache
+    server = make_server(args.host, args.port, application, ThreadingWSGIServer, QuietHandler)
+    print(f"serving on http://{args.host}:{server.server_port}", flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+""" Settings of the service under load, pointed at the stand-ins for memcached and iTunes given in the environment:
+    BENCH_MEMCACHED as host:port, or several separated by commas, and BENCH_ITUNES as the url of the search api.
+    BENCH_PROFILE selects the settings they are based on, full for movies.settings or api for movies.settings_api.
+    The snapshot of the cache is kept in the SQLite database BENCH_DATABASE, by default one in the temp directory
+"""
+import os
+import tempfile
+
+if os.environ.get('BENCH_PROFILE', 'full') == 'api':
+    from movies.settings_api import *  # noqa: F401,F403
+    from movies.settings_api import LOGGING
+else:
+    from movies.settings import *  # noqa: F401,F403
+    from movies.settings import LOGGING
+from movies.settings import UPSTREAM_GUARDS
+from movies.settings import UPSTREAM_HTTP
+
+DEBUG = False
+ALLOWED_HOSTS = ['*']
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+        'LOCATION': os.environ.get('BENCH_MEMCACHED', '127.0.0.1:11211'),
+        'TIMEOUT': 86400
+    }
+}
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.environ.get('BENCH_DATABASE', os.path.join(tempfile.gettempdir(), 'movies-bench.sqlite3')),
+    }
+}
+
+UPSTREAM_HTTP = dict(UPSTREAM_HTTP, URL=os.environ.get('BENCH_ITUNES', UPSTREAM_HTTP['URL']))
+
+# The stub is not throttled, limiting the calls would only measure the limiter
+UPSTREAM_GUARDS = dict(UPSTREAM_GUARDS, RATE_LIMIT=0)
+
+# Logging every request at DEBUG would measure the console. BENCH_LOG_LEVEL=profile keeps the level of the profile
+if os.environ.get('BENCH_LOG_LEVEL') != 'profile':
+    LOGGING = dict(LOGGING, root=dict(LOGGING['root'], level=os.environ.get('BENCH_LOG_LEVEL', 'WARNING')))
@@ -35,9 +35,11 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'movies_api',
 ]
 
 MIDDLEWARE = [
+    'movies_api.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -67,6 +69,10 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'movies.wsgi.application'
 
+# Serve the api with the non-blocking views. Turn this on when running under ASGI (movies.asgi), where a single worker
+# can then wait on many lookups at once. Under WSGI the blocking views are the better fit
+ASYNC_VIEWS = False
+
 # Database
 # https://docs.djangoproject.com/en/3.2/ref/settings/#databases
 
@@ -118,7 +124,7 @@ STATIC_URL = '/static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
-# Memcached storage
+# Memcached storage. LOCATION may list several nodes, as host:port, which keys are sharded over
 CACHES = {
     'default': {
         'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
@@ -127,7 +133,127 @@ CACHES = {
     }
 }
 
+# Clients of the memcached nodes. Each node has a pool of at most POOL_SIZE connections, timeouts are in seconds. A
+# node failing FAILURES calls in a row is ejected and its keys go to the other nodes, until it is retried RETRY_AFTER
+# seconds later. With NOREPLY_WRITES on, artists are stored without waiting for memcached to answer
+MEMCACHED = {
+    'POOL_SIZE': 10,
+    'CONNECT_TIMEOUT': 0.5,
+    'TIMEOUT': 0.5,
+    'FAILURES': 3,
+    'RETRY_AFTER': 30,
+    'NOREPLY_WRITES': True,
+}
+
+# Snapshot of the cached artists in the database, from which artists missing from memcached are served after a restart
+# or a flush. Artists stored in the cache are written to it by a background thread every INTERVAL seconds, or as soon
+# as MAX_BATCH of them are waiting
+SNAPSHOT = {
+    'ENABLED': True,
+    'INTERVAL': 1.0,
+    'MAX_BATCH': 500,
+}
+
+# Ages in seconds at which cached artists go stale, after which they are served while a single background refresh
+# goes to iTunes (SOFT_TTL), can no longer be served without waiting on iTunes (HARD_TTL) and can no longer be served
+# even while iTunes is failing (MAX_STALE). Entries are kept in memcached for MAX_STALE
+CACHE_FRESHNESS = {
+    'SOFT_TTL': 86400,
+    'HARD_TTL': 90000,
+    'MAX_STALE': 259200,
+}
+
+# Seconds for which failed lookups are remembered, so that requests for unknown artists, and requests made while iTunes
+# is failing, are answered without going to iTunes
+NEGATIVE_CACHE = {
+    'NOT_FOUND_TTL': 300,
+    'UPSTREAM_ERROR_TTL': 30,
+}
+
+# Cached artists are held in memcached in a compact binary format, compressed when they are at least
+# COMPRESS_MIN_BYTES
+CACHE_SERIALIZATION = {
+    'COMPRESS_MIN_BYTES': 1024,
+    'COMPRESS_LEVEL': 6,
+}
+
+# Cache held in each worker process in front of memcached. It is bounded by the number of entries and by their
+# estimated size in bytes. Entries are dropped after TTL seconds so that entries refreshed by other workers are seen
+LOCAL_CACHE = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 1000,
+    'MAX_BYTES': 64 * 1024 * 1024,
+    'TTL': 60,
+}
+
+# Cache of rendered responses held in each worker process, keyed by artist, genre and release year. Bodies of at least
+# COMPRESS_MIN_BYTES are also held gzipped, and brotli compressed if the brotli package is installed
+RESPONSE_CACHE = {
+    'ENABLED': True,
+    'MAX_ENTRIES': 5000,
+    'MAX_BYTES': 32 * 1024 * 1024,
+    'TTL': 3600,
+    'COMPRESS_MIN_BYTES': 512,
+}
+
+# Batch lookups: the most artists in one request, and the most of those fetched from iTunes at once
+BATCH = {
+    'MAX_SIZE': 50,
+    'MAX_PARALLELISM': 8,
+}
+
+# Coalescing of concurrent cache misses. The lease is a short-lived memcached entry that lets a single worker
+# process fetch an artist from the 3rd party api while the others poll the cache for the result
+SINGLE_FLIGHT = {
+    'LEASE_TIMEOUT': 10,
+    'POLL_INTERVAL': 0.05,
+}
+
+# Client for the iTunes search api. Connections are pooled and kept alive, timeouts are in seconds and failed
+# requests are retried with jittered exponential backoff. With HEDGE on, a second request is sent when the first has
+# not been answered within the p95 latency of recent requests
+UPSTREAM_HTTP = {
+    'URL': 'https://itunes.apple.com/search?term={}+{}&entity=movie',
+    'POOL_SIZE': 10,
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 10,
+    'RETRIES': 2,
+    'BACKOFF': 0.1,
+    'BACKOFF_MAX': 2,
+    'HEDGE': False,
+    'HEDGE_MIN_SAMPLES': 20,
+}
+
+# Guards around the calls to iTunes. At most RATE_LIMIT calls are made every RATE_PERIOD seconds by all worker
+# processes together, counted in memcached, 0 to not limit them. After FAILURE_THRESHOLD consecutive failures the
+# circuit opens: calls fail fast for RESET_TIMEOUT seconds, then HALF_OPEN_CALLS trial calls decide whether it closes
+UPSTREAM_GUARDS = {
+    'RATE_LIMIT': 20,
+    'RATE_PERIOD': 60,
+    'FAILURE_THRESHOLD': 5,
+    'RESET_TIMEOUT': 30,
+    'HALF_OPEN_CALLS': 1,
+}
+
+# Profiling of single requests with cProfile. A request is profiled when its X-Profile header holds TOKEN, None to
+# not profile on request, or at random with a chance of SAMPLE_RATE. Profiles are saved in DIRECTORY
+PROFILING = {
+    'TOKEN': None,
+    'SAMPLE_RATE': 0.0,
+    'DIRECTORY': '/tmp/movies-profiles',
+}
 
+# JSON codec of upstream responses and of our own responses. BACKEND is orjson, used when it is installed, stdlib, or
+# auto for orjson if it is installed. With PROJECTION on, upstream responses are parsed keeping only the fields that
+# are used, which holds less memory but is slower than a full parse with orjson. auto projects without orjson only
+JSON_CODEC = {
+    'BACKEND': 'auto',
+    'PROJECTION': 'auto',
+}
+
+# Log records are written to the console by a background thread, from a queue of at most 'capacity' records. The
+# 'sampling' filter keeps the given share of the records of a logger at INFO and below, for messages logged for every
+# movie or every request
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -137,10 +263,21 @@ LOGGING = {
             'style': '{',
         },
     },
+    'filters': {
+        'sampling': {
+            '()': 'movies_api.log.SamplingFilter',
+            'rates': {
+                'movies_api.models': 0.01,
+            },
+        },
+    },
     'handlers': {
         'console': {
-            'class': 'logging.StreamHandler',
+            '()': 'movies_api.log.QueuedHandler',
+            'handler': 'logging.StreamHandler',
+            'capacity': 10000,
             'formatter': 'verbose',
+            'filters': ['sampling'],
             'level': 'DEBUG'
         },
     },
@@ -0,0 +1,30 @@
+"""
+Settings for serving only the api, selected with DJANGO_SETTINGS_MODULE=movies.settings_api.
+
+The api has no templates, sessions or users, and its only model is the snapshot of the cached artists, so this profile
+leaves out the admin, auth, sessions, messages and static files apps and their middleware, which every request would
+otherwise go through, and routes the api straight to its views. Everything else is as in movies.settings.
+"""
+from .settings import *  # noqa: F401,F403
+from .settings import LOGGING
+
+INSTALLED_APPS = [
+    'movies_api',
+]
+
+# The api neither keeps sessions nor takes form posts, so CSRF, clickjacking and the other middleware of the full
+# profile have nothing to protect. Its routes are matched with and without their trailing slash instead of
+# CommonMiddleware redirecting
+MIDDLEWARE = [
+    'movies_api.middleware.ServerTimingMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+]
+
+ROOT_URLCONF = 'movies.urls_api'
+
+TEMPLATES = []
+
+USE_I18N = False
+
+# Logging every cache lookup at DEBUG would cost more than the lookup itself
+LOGGING = dict(LOGGING, root=dict(LOGGING['root'], level='INFO'))
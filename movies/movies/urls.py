@@ -17,6 +17,9 @@ from django.contrib import admin
 from django.urls import include
 from django.urls import path
 
+from movies_api import views
+
 urlpatterns = [
     path('api/v1/', include('movies_api.urls')),
+    path('metrics', views.metrics, name='metrics'),
 ]
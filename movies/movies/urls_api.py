@@ -0,0 +1,19 @@
+"""movies URL Configuration of the api profile, movies.settings_api
+
+The api views are routed directly rather than through an include, with and without their trailing slash, so that
+requests are matched in one step and never redirected.
+"""
+from django.conf import settings
+from django.urls import path
+
+from movies_api import views
+
+actor_movies = views.actor_movies_async if settings.ASYNC_VIEWS else views.actor_movies
+
+urlpatterns = [
+    path('api/v1/movies/', actor_movies, name='actor_movies'),
+    path('api/v1/movies', actor_movies),
+    path('api/v1/movies/batch/', views.batch_actor_movies, name='batch_actor_movies'),
+    path('api/v1/movies/batch', views.batch_actor_movies),
+    path('metrics', views.metrics, name='metrics'),
+]
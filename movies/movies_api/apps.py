@@ -1,6 +1,15 @@
+from importlib import import_module
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class MoviesApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'movies_api'
+
+    def ready(self):
+        # loads the non-blocking pipeline up front when its views are served, rather than on the event loop of the
+        # first request
+        if settings.ASYNC_VIEWS:
+            import_module('movies_api.async_movie_requests')
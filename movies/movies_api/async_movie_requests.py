@@ -0,0 +1,776 @@
+""" This file contains the non-blocking counterparts of movie_requests, used when the service runs under ASGI """
+import asyncio
+import random
+import time
+import weakref
+from collections import deque
+
+import httpx
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.http import HttpResponse
+from pymemcache.client.hash import normalize_server_spec
+from pymemcache.serde import pickle_serde
+
+from .memcached import NodeRing
+from .memcached import memcached_settings
+from .memcached import node_name
+from .models import Key
+from .models import Movies
+from .metrics import CACHE_LOOKUPS
+from .metrics import UPSTREAM_RESPONSES
+from .metrics import registry
+from .metrics import stage
+from .movie_requests import ArtistNotFound
+from .movie_requests import CacheEntry
+from .movie_requests import InMemoryStorage
+from .movie_requests import LocalCache
+from .movie_requests import NOT_FOUND
+from .movie_requests import NegativeEntry
+from .movie_requests import UPSTREAM_ERROR
+from .movie_requests import UpstreamError
+from .movie_requests import UpstreamUnavailable
+from .movie_requests import RETRY_STATUSES
+from .movie_requests import _cacheable_response
+from .movie_requests import _filtered
+from .movie_requests import _single_flight_settings
+from .movie_requests import as_cache_entry
+from .movie_requests import check_guards
+from .movie_requests import freshness_settings
+from .movie_requests import get_snapshot
+from .movie_requests import is_snapshot_entry
+from .movie_requests import from_stored
+from .movie_requests import lease_key
+from .movie_requests import local_cache_settings
+from .movie_requests import negative_cache_settings
+from .movie_requests import negative_key
+from .movie_requests import pipeline_stats
+from .movie_requests import raise_remembered_failure
+from .movie_requests import record_outcome
+from .movie_requests import streamed_movies
+from .movie_requests import third_party as blocking_third_party
+from .movie_requests import to_movies
+from .movie_requests import to_stored
+from .movie_requests import upstream_settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+# failures of a memcached node, including a connection it closed mid response
+NODE_ERRORS = (OSError, EOFError, asyncio.TimeoutError)
+
+
+class MemcachedProtocolError(ConnectionError):
+    """ A reply memcached was not expected to send, eg, ERROR or SERVER_ERROR. The node is counted as failing """
+
+
+class _PerLoop:
+    """ Holds a resource, such as a pool of connections, for each event loop: connections belong to the loop that
+        opened them, and eg each call through async_to_sync runs a loop of its own. A resource is made on first use
+        in a loop and closed when the loop shuts down its async generators, as asyncio.run does before closing it
+    """
+
+    def __init__(self, make, close):
+        """
+        :param make: Makes the resource
+        :param close: Coroutine function closing the resource
+        """
+        self.make = make
+        self.close = close
+        self.resources = weakref.WeakKeyDictionary()  # loop -> the resource and the generator owning it
+
+    async def get(self):
+        loop = asyncio.get_running_loop()
+        held = self.resources.get(loop)
+        if held is None:
+            owner = self._owner()
+            held = self.resources[loop] = (await owner.__anext__(), owner)
+        return held[0]
+
+    async def _owner(self):
+        resource = self.make()
+        try:
+            yield resource
+        finally:
+            await self.close(resource)
+
+
+def get_async_storage(in_memory):
+    if in_memory:
+        logger.info("Using in memory storage")
+        return AsyncInMemoryStorage()
+    shared = AsyncMemCached()
+    if get_snapshot() is not None:
+        logger.info("Keeping a snapshot of the cached artists in the database")
+        shared = AsyncSnapshotStorage(shared, get_snapshot())
+    config = local_cache_settings()
+    if config['ENABLED']:
+        logger.info("Using in real storage behind a local cache")
+        return AsyncTwoTierStorage(LocalCache(config['MAX_ENTRIES'], config['MAX_BYTES'], config['TTL']), shared)
+    logger.info("Using in real storage")
+    return shared
+
+
+class AsyncMemcacheClient:
+    """ A minimal non-blocking client for the memcached text protocol. Keys are spread over the servers the same
+        way the pymemcache client behind the django cache does it, so both clients read each other's entries. Nodes
+        failing are ejected as by the sync client, see memcached.NodeRing, and their keys are misses meanwhile
+    """
+
+    def __init__(self, servers, pool_size=10, timeout=1, failures=3, retry_after=30):
+        self.timeout = timeout
+        self.pool_size = pool_size
+        self.servers = {node_name(server): normalize_server_spec(server) for server in servers}
+        self.ring = NodeRing(self.servers, failures, retry_after)
+        self.pools = _PerLoop(dict, self._close_pools)  # node -> the idle connections and the slots to open one
+
+    @classmethod
+    def from_settings(cls, servers):
+        config = memcached_settings()
+        return cls(servers, config['POOL_SIZE'], config['TIMEOUT'], config['FAILURES'], config['RETRY_AFTER'])
+
+    async def get(self, key):
+        return await self._guarded(self._get(key), None)
+
+    async def set(self, key, value, exptime):
+        return await self._guarded(self._store(b'set', key, value, exptime), False)
+
+    async def add(self, key, value, exptime):
+        """ Returns True if the key was added, False if it is already held, None if its node is unavailable """
+        return await self._guarded(self._store(b'add', key, value, exptime), None)
+
+    async def delete(self, key):
+        return await self._guarded(self._delete(key), False)
+
+    @staticmethod
+    async def _guarded(call, default):
+        try:
+            return await call
+        except NODE_ERRORS:
+            return default
+
+    async def _get(self, key):
+        async with self._connection(key) as (reader, writer):
+            writer.write(b'get ' + key.encode() + b'\r\n')
+            header = await self._readline(reader)
+            if header == b'END':
+                return None
+            if not header.startswith(b'VALUE '):
+                raise MemcachedProtocolError(f"Unexpected reply from memcached: {header[:100]!r}")
+            _, _, flags, size = header.split()
+            value = await asyncio.wait_for(reader.readexactly(int(size) + 2), self.timeout)
+            await self._readline(reader)  # END
+            return pickle_serde.deserialize(key, value[:-2], int(flags))
+
+    async def _delete(self, key):
+        async with self._connection(key) as (reader, writer):
+            writer.write(b'delete ' + key.encode() + b'\r\n')
+            return await self._readline(reader) == b'DELETED'
+
+    async def _store(self, command, key, value, exptime):
+        data, flags = pickle_serde.serialize(key, value)
+        if isinstance(data, str):
+            data = data.encode()
+        async with self._connection(key) as (reader, writer):
+            writer.write(b'%s %s %d %d %d\r\n' % (command, key.encode(), flags, exptime, len(data)) + data + b'\r\n')
+            return await self._readline(reader) == b'STORED'
+
+    async def _readline(self, reader):
+        line = await asyncio.wait_for(reader.readline(), self.timeout)
+        if not line:
+            raise ConnectionError("Connection closed by memcached")
+        return line.rstrip(b'\r\n')
+
+    def _connection(self, key):
+        return _PooledConnection(self, self.ring.get_node(key))
+
+    async def _pool(self, node):
+        pools = await self.pools.get()
+        if node not in pools:
+            pools[node] = (asyncio.Queue(), asyncio.Semaphore(self.pool_size))
+        return pools[node]
+
+    @staticmethod
+    async def _close_pools(pools):
+        for idle, _ in pools.values():
+            while not idle.empty():
+                _, writer = idle.get_nowait()
+                writer.close()
+
+
+class _PooledConnection:
+    """ Borrows a connection to a memcached server from the pool, opening one if none is idle """
+
+    def __init__(self, client, node):
+        self.client = client
+        self.node = node
+        self.connection = None
+
+    async def __aenter__(self):
+        if self.node is None:
+            raise ConnectionError("Every memcached node is ejected")
+        self.idle, self.slots = await self.client._pool(self.node)
+        await self.slots.acquire()
+        try:
+            self.connection = self.idle.get_nowait()
+        except asyncio.QueueEmpty:
+            host, port = self.client.servers[self.node]
+            try:
+                self.connection = await asyncio.wait_for(asyncio.open_connection(host, port), self.client.timeout)
+            except Exception as e:
+                self.slots.release()
+                if isinstance(e, NODE_ERRORS):
+                    self.client.ring.failed(self.node)
+                raise
+        return self.connection
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.idle.put_nowait(self.connection)
+            self.client.ring.succeeded(self.node)
+        else:
+            self.connection[1].close()  # the connection may be mid response, so it is not reused
+            if issubclass(exc_type, NODE_ERRORS):
+                self.client.ring.failed(self.node)
+        self.slots.release()
+
+
+class AsyncMemCached:
+    def __init__(self):
+        self.memcached = caches['default']
+        self.client = AsyncMemcacheClient.from_settings(self.memcached._servers)
+        self.timeout = self.memcached.get_backend_timeout(freshness_settings()['MAX_STALE'])
+
+    async def put(self, key, details):
+        await self.client.set(self.memcached.make_key(key.as_key()), to_stored(details), self.timeout)
+
+    async def get(self, key):
+        return from_stored(await self.client.get(self.memcached.make_key(key.as_key())))
+
+    async def get_latest(self, key):
+        return await self.get(key)
+
+    async def delete(self, key):
+        await self.client.delete(self.memcached.make_key(key.as_key()))
+
+    async def put_negative(self, key, entry, timeout):
+        await self.client.set(self.memcached.make_key(negative_key(key)), entry,
+                              self.memcached.get_backend_timeout(timeout))
+
+    async def get_negative(self, key):
+        return await self.client.get(self.memcached.make_key(negative_key(key)))
+
+    async def acquire_lease(self, key, timeout):
+        return await self.client.add(self.memcached.make_key(lease_key(key)), 1,
+                                     self.memcached.get_backend_timeout(timeout)) is not False
+
+    async def release_lease(self, key):
+        await self.client.delete(self.memcached.make_key(lease_key(key)))
+
+    async def lease_held(self, key):
+        return await self.client.get(self.memcached.make_key(lease_key(key))) is not None
+
+    def node_stats(self):
+        return self.client.ring.stats()
+
+
+class AsyncSnapshotStorage:
+    """ Non-blocking counterpart of SnapshotStorage. The snapshot is read on a worker thread, writes to it are queued
+        and never block
+    """
+
+    def __init__(self, shared, snapshot):
+        self.shared = shared
+        self.snapshot = snapshot
+
+    async def put(self, key, details):
+        await self.shared.put(key, details)
+        if is_snapshot_entry(details):
+            self.snapshot.save(key.as_key(), details)
+
+    async def get(self, key):
+        details = await self.shared.get(key)
+        if details is None:
+            details = from_stored(await sync_to_async(self.snapshot.get, thread_sensitive=False)(key.as_key()))
+            if details is not None:
+                await self.shared.put(key, details)
+        return details
+
+    async def get_latest(self, key):
+        return await self.get(key)
+
+    async def delete(self, key):
+        await self.shared.delete(key)
+        self.snapshot.delete(key.as_key())
+
+    async def put_negative(self, key, entry, timeout):
+        await self.shared.put_negative(key, entry, timeout)
+
+    async def get_negative(self, key):
+        return await self.shared.get_negative(key)
+
+    async def acquire_lease(self, key, timeout):
+        return await self.shared.acquire_lease(key, timeout)
+
+    async def release_lease(self, key):
+        await self.shared.release_lease(key)
+
+    async def lease_held(self, key):
+        return await self.shared.lease_held(key)
+
+    def node_stats(self):
+        return self.shared.node_stats()
+
+
+class AsyncInMemoryStorage:
+    """ Non-blocking facade of the in memory storage. Mainly used for testing without starting up memcached """
+    def __init__(self):
+        self.storage = InMemoryStorage()
+
+    async def put(self, key, details):
+        self.storage.put(key, details)
+
+    async def get(self, key):
+        return self.storage.get(key)
+
+    async def get_latest(self, key):
+        return self.storage.get(key)
+
+    async def delete(self, key):
+        self.storage.delete(key)
+
+    async def put_negative(self, key, entry, timeout):
+        self.storage.put_negative(key, entry, timeout)
+
+    async def get_negative(self, key):
+        return self.storage.get_negative(key)
+
+    async def acquire_lease(self, key, timeout):
+        return self.storage.acquire_lease(key, timeout)
+
+    async def release_lease(self, key):
+        self.storage.release_lease(key)
+
+    async def lease_held(self, key):
+        return self.storage.lease_held(key)
+
+
+class AsyncTwoTierStorage:
+    """ Non-blocking counterpart of TwoTierStorage. The local cache never blocks, so it is used as is """
+
+    def __init__(self, local: LocalCache, shared):
+        self.local = local
+        self.shared = shared
+
+    async def put(self, key, details):
+        await self.shared.put(key, details)
+        self.local.put(key.as_key(), details)
+
+    async def get(self, key):
+        details = self.local.get(key.as_key())
+        if details is None:
+            details = await self.get_latest(key)
+        return details
+
+    async def get_latest(self, key):
+        details = await self.shared.get(key)
+        if details is not None:
+            self.local.put(key.as_key(), details)
+        return details
+
+    async def delete(self, key):
+        await self.shared.delete(key)
+        self.local.delete(key.as_key())
+
+    async def put_negative(self, key, entry, timeout):
+        await self.shared.put_negative(key, entry, timeout)
+        self.local.put(negative_key(key), entry)
+
+    async def get_negative(self, key):
+        entry = self.local.get(negative_key(key))
+        if entry is None:
+            entry = await self.shared.get_negative(key)
+            if entry is not None:
+                self.local.put(negative_key(key), entry)
+        return entry
+
+    async def acquire_lease(self, key, timeout):
+        return await self.shared.acquire_lease(key, timeout)
+
+    async def release_lease(self, key):
+        await self.shared.release_lease(key)
+
+    async def lease_held(self, key):
+        return await self.shared.lease_held(key)
+
+
+class AsyncCacheSpi:
+    """ This is a non-blocking service provider interface for the storage. Stale entries are served the same way as
+        by CacheSpi, with the refresh running as a task on the event loop
+    """
+    def __init__(self, in_memory=False, third_party=None):
+        self.storage = get_async_storage(in_memory)
+        self.third_party = third_party
+        self.refreshing = set()
+        self.refresh_tasks = set()  # the loop only holds weak references to its tasks
+        self.negative_counters = {'lookups': 0, f'{NOT_FOUND}_hits': 0, f'{UPSTREAM_ERROR}_hits': 0,
+                                  f'{NOT_FOUND}_stores': 0, f'{UPSTREAM_ERROR}_stores': 0}
+
+    async def storage_lookup(self, key: Key):
+        with stage('lookup'):
+            try:
+                entry = await self.entry_lookup(key)
+            except Exception:
+                CACHE_LOOKUPS.inc('error')
+                raise
+        if entry is None or entry.is_expired():
+            CACHE_LOOKUPS.inc('miss')
+            return None
+        if not entry.is_fresh():
+            CACHE_LOOKUPS.inc('stale')
+            logger.info("Movies for artist '%s' are stale, serving them while they are refreshed", key)
+            self.schedule_refresh(key)
+        else:
+            CACHE_LOOKUPS.inc('hit')
+        return entry.movies
+
+    async def entry_lookup(self, key: Key):
+        return as_cache_entry(await self.storage.get(key))
+
+    async def stale_lookup(self, key: Key):
+        entry = await self.entry_lookup(key)
+        if entry is None or entry.age() >= freshness_settings()['MAX_STALE']:
+            return None
+        return entry.movies
+
+    async def save_movies(self, key: Key, movies):
+        logger.info("Saving movies for artist '%s' in the cache and the database", key)
+        if isinstance(movies, Movies):
+            movies.build_index()
+            movies.version = movies.content_hash()
+        await self.storage.put(key, CacheEntry(movies))
+
+    async def negative_lookup(self, key: Key):
+        entry = await self.storage.get_negative(key)
+        kind = None if entry is None or entry.is_expired() else entry.kind
+        self.negative_counters['lookups'] += 1
+        if kind is not None:
+            self.negative_counters[f'{kind}_hits'] += 1
+        return kind
+
+    async def save_negative(self, key: Key, kind):
+        ttl = negative_cache_settings()[kind]
+        logger.info(f"Remembering that looking up artist '{key}' failed ({kind}) for {ttl}s")
+        await self.storage.put_negative(key, NegativeEntry(kind, ttl), ttl)
+        self.negative_counters[f'{kind}_stores'] += 1
+
+    def negative_stats(self):
+        """ Gets a snapshot of the negative cache counters along with the hit rate of each kind of failure """
+        stats = dict(self.negative_counters)
+        for kind in (NOT_FOUND, UPSTREAM_ERROR):
+            stats[f'{kind}_hit_rate'] = stats[f'{kind}_hits'] / stats['lookups'] if stats['lookups'] else 0.0
+        return stats
+
+    async def invalidate(self, key: Key):
+        logger.info(f"Removing movies for artist '{key}' from the cache")
+        await self.storage.delete(key)
+
+    def schedule_refresh(self, key: Key):
+        if self.third_party is None or key in self.refreshing:
+            return
+        self.refreshing.add(key)
+        task = asyncio.ensure_future(self._refresh(key))
+        self.refresh_tasks.add(task)
+        task.add_done_callback(self.refresh_tasks.discard)
+
+    async def _refresh(self, key: Key):
+        lease_timeout, _ = _single_flight_settings()
+        try:
+            if not await self.acquire_lease(key, lease_timeout):
+                return  # another worker process is refreshing it
+            try:
+                latest = as_cache_entry(await self.storage.get_latest(key))
+                if latest is None or not latest.is_fresh():  # or another worker process has already refreshed it
+                    await self.save_movies(key, await self.third_party.api_lookup(key))
+            finally:
+                await self.release_lease(key)
+        except Exception:
+            logger.exception(f"Failed to refresh movies for artist '{key}', serving stale movies meanwhile")
+        finally:
+            self.refreshing.discard(key)
+
+    async def acquire_lease(self, key: Key, timeout):
+        return await self.storage.acquire_lease(key, timeout)
+
+    async def release_lease(self, key: Key):
+        await self.storage.release_lease(key)
+
+    async def lease_held(self, key: Key):
+        return await self.storage.lease_held(key)
+
+
+class AsyncRequestResponse:
+    """ This class does the actual api request without blocking and returns the response to the caller. It is
+        configured by the same settings as RequestResponse
+    """
+    def __init__(self, config=None):
+        config = config or upstream_settings()
+        self.target_path = config['URL']
+        self.pool_size = config['POOL_SIZE']
+        self.timeout = httpx.Timeout(config['READ_TIMEOUT'], connect=config['CONNECT_TIMEOUT'])
+        self.retries = config['RETRIES']
+        self.backoff = config['BACKOFF']
+        self.backoff_max = config['BACKOFF_MAX']
+        self.hedge = config['HEDGE']
+        self.hedge_min_samples = config['HEDGE_MIN_SAMPLES']
+        self.latencies = deque(maxlen=1000)
+        self.clients = _PerLoop(self._new_client, lambda client: client.aclose())
+
+    async def response(self, key: Key):
+        url = self.target_path.format(key.get_firstname(), key.get_lastname())
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is None:
+            return await self._with_retries(url)
+        return await self._hedged(url, hedge_delay)
+
+    def hedge_delay(self):
+        if not self.hedge or len(self.latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    async def _hedged(self, url, hedge_delay):
+        first = asyncio.ensure_future(self._with_retries(url))
+        done, _ = await asyncio.wait([first], timeout=hedge_delay)
+        if done:
+            return first.result()
+
+        logger.info(f"No response after {hedge_delay:.3f}s, sending hedged request to {url}")
+        pending = {first, asyncio.ensure_future(self._with_retries(url))}
+        try:
+            while True:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                succeeded = [future for future in done if future.exception() is None]
+                if succeeded:
+                    return succeeded[0].result()
+                if not pending:
+                    return done.pop().result()  # every request failed, so this raises
+        finally:
+            for future in pending:
+                future.cancel()
+
+    async def _with_retries(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                response = await self._get(url)
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                logger.warning(f"Got status {response.status_code} from {url}, attempt {attempt + 1}")
+            except httpx.TransportError as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Request to {url} failed on attempt {attempt + 1}: {e}")
+            await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt)))
+
+    async def _get(self, url):
+        start = time.perf_counter()
+        response = await (await self.clients.get()).get(url)
+        self.latencies.append(time.perf_counter() - start)
+        return response
+
+    def _new_client(self):
+        return httpx.AsyncClient(timeout=self.timeout, limits=httpx.Limits(
+            max_connections=self.pool_size, max_keepalive_connections=self.pool_size))
+
+
+class AsyncThirdParty:
+    """ This class uses a third party API to lookup the requested information without blocking """
+
+    def __init__(self, request_response: AsyncRequestResponse, breaker=None, limiter=None):
+        """
+        :param request_response: Makes the requests
+        :param breaker: Stops calls while the api is failing, None to always call it
+        :param limiter: Limits the rate of calls, None to not limit it. Its counters are updated in a worker thread
+        """
+        self.request_response = request_response
+        self.breaker = breaker
+        self.limiter = limiter
+
+    async def api_lookup(self, key: Key):
+        if self.limiter is None:
+            check_guards(key, self.breaker, None)
+        else:  # taking a token is a round trip to memcached
+            await sync_to_async(check_guards, thread_sensitive=False)(key, self.breaker, self.limiter)
+        try:
+            with stage('upstream'):
+                response = await self.request_response.response(key)
+            UPSTREAM_RESPONSES.inc(str(response.status_code))
+            movies = to_movies(key, response.status_code, response.content)
+        except httpx.HTTPError as e:
+            UPSTREAM_RESPONSES.inc('error')
+            record_outcome(self.breaker, failed=True)
+            logger.error(f"Cannot reach the 3rd party api for {key}: {e}")
+            raise UpstreamError(f"Cannot get movies for {key}") from e
+        except UpstreamError:
+            record_outcome(self.breaker, failed=True)
+            raise
+        except ArtistNotFound:
+            record_outcome(self.breaker, failed=False)
+            raise
+        except Exception as e:  # a response that cannot be read, eg, not json
+            record_outcome(self.breaker, failed=True)
+            logger.error(f"Cannot read the response of the 3rd party api for {key}: {e!r}")
+            raise UpstreamError(f"Cannot get movies for {key}") from e
+        except asyncio.CancelledError:  # the call was not made to the end, give back its trial if it was one
+            if self.breaker is not None:
+                self.breaker.release()
+            raise
+        record_outcome(self.breaker, failed=False)
+        return movies
+
+
+class AsyncSingleFlight:
+    """ Collapses concurrent calls for the same key on an event loop into a single call whose result every caller
+        shares
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._counters = {'leaders': 0, 'coalesced': 0, 'lease_waits': 0, 'lease_hits': 0}
+
+    async def do(self, key, fn):
+        call = self._calls.get(key)
+        if call is not None:
+            self._counters['coalesced'] += 1
+            return await asyncio.shield(call)
+
+        self._counters['leaders'] += 1
+        call = asyncio.ensure_future(fn())
+        self._calls[key] = call
+        try:
+            return await asyncio.shield(call)
+        finally:
+            if call.done():
+                del self._calls[key]
+            else:
+                call.add_done_callback(lambda _: self._calls.pop(key, None))
+
+    def incr(self, counter):
+        self._counters[counter] += 1
+
+    def stats(self):
+        return dict(self._counters)
+
+
+async_single_flight = AsyncSingleFlight()
+
+
+class AsyncRequestHandler:
+    """ This class handles requests and responses without blocking. It is the entry and exit point of the api
+        under ASGI
+    """
+
+    def __init__(self, storage, third_party, coalescer=None):
+        self.storage = storage
+        self.third_party = third_party
+        self.coalescer = coalescer or async_single_flight
+
+    async def get_details(self, key):
+        """ This returns the details being looked up for based on the provided key
+            :param key: The lookup key
+        """
+        movies = await self.get_movies(key)
+        if isinstance(movies, HttpResponse):
+            return movies
+        return _filtered(movies, key)
+
+    async def get_movies(self, key):
+        """ This returns all the movies of the artist in the key, before any filtering
+            :param key: The lookup key
+        """
+        try:
+            movies = await self.storage.storage_lookup(key)
+        except Exception:
+            return HttpResponse("Internal server error", status=500)
+
+        if movies is None:
+            try:
+                movies = await self.coalescer.do(key.as_key(), lambda: self._fetch(key))
+            except ValueError as e:
+                movies = await self.storage.stale_lookup(key)
+                if movies is None:
+                    if isinstance(e, UpstreamError):
+                        return HttpResponse(f"Service unavailable for {key}", status=503)
+                    return HttpResponse(f"Resource not found for {key}", status=404)
+                logger.warning(f"Serving stale movies for artist '{key}', the 3rd party api lookup failed: {e}")
+        else:
+            logger.info("Returning details for artist '%s' from storage", key)
+        return movies
+
+    async def _fetch(self, key):
+        raise_remembered_failure(key, await self.storage.negative_lookup(key))
+        lease_timeout, poll_interval = _single_flight_settings()
+        leased = await self.storage.acquire_lease(key, lease_timeout)
+        if not leased:
+            movies = await self._wait_for_lease_holder(key, lease_timeout, poll_interval)
+            if movies is not None:
+                return movies
+        try:
+            logger.info("Looking up details for artist '%s' from 3rd party api", key)
+            movies = await self.third_party.api_lookup(key)
+            await self.storage.save_movies(key, movies)
+            return movies
+        except ArtistNotFound:
+            await self.storage.save_negative(key, NOT_FOUND)
+            raise
+        except UpstreamUnavailable:
+            raise
+        except UpstreamError:
+            await self.storage.save_negative(key, UPSTREAM_ERROR)
+            raise
+        finally:
+            if leased:
+                await self.storage.release_lease(key)
+
+    async def _wait_for_lease_holder(self, key, lease_timeout, poll_interval):
+        self.coalescer.incr('lease_waits')
+        deadline = time.monotonic() + lease_timeout
+        while time.monotonic() < deadline:
+            await asyncio.sleep(poll_interval)
+            if await self.storage.lease_held(key):
+                continue
+            movies = await self.storage.storage_lookup(key)
+            if movies is not None:
+                self.coalescer.incr('lease_hits')
+                return movies
+            raise_remembered_failure(key, await self.storage.negative_lookup(key))
+            logger.info("Lease for artist '%s' was released with nothing stored, looking it up", key)
+            return None
+        logger.warning(f"Lease for artist '{key}' expired before details were stored, looking them up")
+        return None
+
+
+async_request_response = AsyncRequestResponse()
+async_third_party = AsyncThirdParty(async_request_response, blocking_third_party.breaker,
+                                   blocking_third_party.limiter)
+async_cache_spi = AsyncCacheSpi(in_memory=False, third_party=async_third_party)
+registry.register_collector(pipeline_stats('async', async_cache_spi, async_single_flight))
+
+
+async def get_response_async(key, accept_encoding='', request=None):
+    try:
+        handler = AsyncRequestHandler(async_cache_spi, async_third_party)
+        movies = await handler.get_movies(key)
+        if isinstance(movies, HttpResponse):
+            return movies  # error responses are passed through as is
+        return _cacheable_response(key, movies, accept_encoding, request)
+    except AttributeError:
+        return HttpResponse("Internal server error", status=500)
+
+
+async def get_streaming_response_async(key):
+    handler = AsyncRequestHandler(async_cache_spi, async_third_party)
+    movies = await handler.get_movies(key)
+    if isinstance(movies, HttpResponse):
+        return movies  # error responses are passed through as is
+    return streamed_movies(_filtered(movies, key), key.get_fields())
@@ -0,0 +1,85 @@
+""" This file contains the JSON codec used for the responses of the 3rd party api and for our own responses. It uses
+    orjson when it is installed and the json module of the standard library otherwise, or the one named by
+    JSON_CODEC['BACKEND'].
+
+    Upstream responses can be parsed in projection mode, which keeps only the fields looked for in each result as the
+    response is parsed, so the whole response is never held as objects at once. Only the standard library decoder
+    can do that, through an object hook. Parsing the whole response with orjson is still faster, though it peaks at
+    a higher memory use, so by default orjson parses whole responses when it is installed and the standard library
+    projects them otherwise.
+"""
+import json
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the standard library is used without it
+    orjson = None
+
+STDLIB = 'stdlib'
+ORJSON = 'orjson'
+
+
+def json_codec_settings():
+    config = {'BACKEND': 'auto', 'PROJECTION': 'auto'}
+    config.update(getattr(settings, 'JSON_CODEC', {}))
+    return config
+
+
+def backend() -> str:
+    """ Gets the name of the codec in use, falling back to the standard library if orjson is asked for but missing """
+    name = json_codec_settings()['BACKEND']
+    if name == STDLIB or orjson is None:
+        return STDLIB
+    return ORJSON
+
+
+def projecting() -> bool:
+    projection = json_codec_settings()['PROJECTION']
+    return backend() == STDLIB if projection == 'auto' else bool(projection)
+
+
+def dumps(value) -> str:
+    if backend() == ORJSON:
+        return orjson.dumps(value).decode()
+    return json.dumps(value)
+
+
+def dumps_bytes(value) -> bytes:
+    if backend() == ORJSON:
+        return orjson.dumps(value)
+    return json.dumps(value).encode()
+
+
+def loads(data):
+    if backend() == ORJSON:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def load_results(data, fields, projection=None):
+    """ Parses the 'results' list of a response of the 3rd party api into a tuple of the values of the fields for
+        each result. Results missing any of the fields, or holding null for it, are left out
+        :param data: The body of the response
+        :param fields: The fields to keep, the first of which tells results apart from other objects
+        :param projection: Whether to drop the other fields while parsing, by default as set in JSON_CODEC
+    """
+    if projecting() if projection is None else projection:
+        results = json.loads(data, object_hook=_Projection(fields))['results']
+        return [result for result in results if type(result) is tuple and None not in result]
+    rows = [tuple(map(result.get, fields)) for result in loads(data)['results']]
+    return [row for row in rows if None not in row]
+
+
+class _Projection:
+    """ Object hook replacing each result by the tuple of the values of the fields as soon as it is parsed """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.marker = fields[0]
+
+    def __call__(self, obj):
+        if self.marker in obj:
+            return tuple(map(obj.get, self.fields))
+        return obj
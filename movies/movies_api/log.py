@@ -0,0 +1,146 @@
+""" This file contains the logging pipeline of the service, set up in LOGGING in settings.py.
+
+    Records are put on a bounded queue by the thread that logs them and written out by the handlers of a listener on
+    a background thread, so requests do not wait on formatting or on the console. Messages are passed as a format
+    string and its arguments, eg: logger.info("Returning details for artist '%s'", key), and only formatted on the
+    listener thread, and not at all when their level is disabled. The arguments should not change after they are
+    logged. The listener writes out all the records waiting on the queue at once, with a single write to the stream,
+    rather than one write and flush per record. When the queue is full, records are dropped and counted rather than
+    making requests wait.
+
+    High volume messages are sampled per logger: the SamplingFilter keeps one in every so many records of a logger at
+    or below a level.
+"""
+import itertools
+import logging
+import queue
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+
+from django.utils.module_loading import import_string
+
+from .metrics import registry
+
+LOG_RECORDS_DROPPED = registry.counter('movies_log_records_dropped_total',
+                                       "Log records dropped because the queue was full, or left out by sampling",
+                                       ('reason',))
+
+
+class BatchingListener(QueueListener):
+    """ Listener writing out the records waiting on the queue together, up to max_batch of them """
+    max_batch = 512
+
+    def _monitor(self):
+        q = self.queue
+        while True:
+            records = [q.get()]
+            try:
+                while len(records) < self.max_batch:
+                    records.append(q.get_nowait())
+            except queue.Empty:
+                pass
+            stopping = any(record is self._sentinel for record in records)
+            if stopping:
+                records = [record for record in records if record is not self._sentinel]
+            for handler in self.handlers:
+                self.write(handler, records)
+            if stopping:
+                return
+
+    @staticmethod
+    def write(handler, records):
+        if not isinstance(handler, logging.StreamHandler):
+            for record in records:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+            return
+        lines = []
+        for record in records:
+            if record.levelno >= handler.level and handler.filter(record):
+                try:
+                    lines.append(handler.format(record) + handler.terminator)
+                except Exception:
+                    handler.handleError(record)
+        if not lines:
+            return
+        with handler.lock:
+            try:
+                handler.stream.write(''.join(lines))
+                handler.flush()
+            except Exception:
+                handler.handleError(records[-1])
+
+
+class QueuedHandler(QueueHandler):
+    """ Puts records on a queue that a listener, started along with this handler, writes out with the target handler
+        on a background thread
+    """
+
+    def __init__(self, handler='logging.StreamHandler', capacity=10000, **kwargs):
+        """
+        :param handler: The dotted path of the target handler class
+        :param capacity: The most records waiting on the queue, beyond which they are dropped
+        :param kwargs: The arguments of the target handler
+        """
+        super().__init__(queue.SimpleQueue())
+        self.capacity = capacity
+        self.target = import_string(handler)(**kwargs)
+        self.listener = BatchingListener(self.queue, self.target)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        """ Sets the formatter of the target handler, which formats the records on the listener thread """
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        """ Leaves the message to be formatted by the listener. Only a traceback is rendered here, while the frames
+            it refers to are still those that raised
+        """
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.queue.qsize() >= self.capacity:
+            LOG_RECORDS_DROPPED.inc('full')
+        else:
+            self.queue.put(record)
+
+    def flush(self):
+        """ Waits for the records already queued to be written out """
+        if self.listener._thread is not None:
+            self.listener.stop()
+            self.listener.start()
+        self.target.flush()
+
+    def close(self):
+        if self.listener._thread is not None:
+            self.listener.stop()  # writes out the records still queued
+        self.target.close()
+        super().close()
+
+
+class SamplingFilter(logging.Filter):
+    """ Keeps one in every so many records of the given loggers at or below a level. Records of other loggers and
+        records above the level are all kept
+    """
+
+    def __init__(self, rates=None, level='INFO'):
+        """
+        :param rates: The share of records to keep by logger name, eg: {'movies_api.models': 0.01}
+        :param level: The highest level sampled
+        """
+        super().__init__()
+        self.every = {name: max(1, round(1 / rate)) if rate > 0 else 0 for name, rate in (rates or {}).items()}
+        self.level = level if isinstance(level, int) else logging.getLevelName(level)
+        self.counts = {name: itertools.count() for name in self.every}
+
+    def filter(self, record):
+        every = self.every.get(record.name)
+        if every is None or every == 1 or record.levelno > self.level:
+            return True
+        if every and next(self.counts[record.name]) % every == 0:
+            return True
+        LOG_RECORDS_DROPPED.inc('sampled')
+        return False
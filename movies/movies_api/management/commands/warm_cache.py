@@ -0,0 +1,122 @@
+""" This file contains the command that fills the cache with the movies of a list of artists, e.g. after a deploy or a
+    restart of memcached
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from django.core.management.base import BaseCommand
+
+from movies_api import movie_requests
+from movies_api.models import Key
+from movies_api.movie_requests import ArtistNotFound
+from movies_api.movie_requests import NOT_FOUND
+from movies_api.movie_requests import UpstreamError
+from movies_api.movie_requests import batch_settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+FETCHED = 'fetched'
+FRESH = 'fresh'
+MISSING = 'not_found'
+FAILED = 'failed'
+
+
+class Command(BaseCommand):
+    help = "Fills the cache with the movies of the artists listed one per line, as 'firstname lastname', in a file " \
+           "or on stdin. Artists already cached and fresh are skipped"
+
+    def add_arguments(self, parser):
+        parser.add_argument('artists', nargs='?', type=argparse.FileType('r'), default=sys.stdin,
+                            help="File listing the artists, stdin if not given or -")
+        parser.add_argument('--concurrency', type=int, default=batch_settings()['MAX_PARALLELISM'],
+                            help="The most artists looked up from iTunes at once")
+        parser.add_argument('--rate-wait', type=float, default=300,
+                            help="Seconds to wait for the rate limit to allow a lookup before giving up on the artist")
+        parser.add_argument('--force', action='store_true', help="Look up artists even if they are cached and fresh")
+        parser.add_argument('--progress-every', type=float, default=5, help="Seconds between progress reports")
+
+    def handle(self, *args, **options):
+        warmer = CacheWarmer(options['rate_wait'], options['force'])
+        progress = Progress(self.stdout, options['progress_every'])
+        concurrency = max(options['concurrency'], 1)
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = set()
+            for key in read_artists(options['artists']):
+                if len(pending) >= concurrency * 2:  # keeps the whole list from being read into memory at once
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    progress.add(future.result() for future in done)
+                pending.add(executor.submit(warmer.warm, key))
+            progress.add(future.result() for future in wait(pending).done)
+
+        progress.report(final=True)
+
+
+def read_artists(lines):
+    """ Reads the artists listed one per line, skipping blank lines and lines starting with # """
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        firstname, _, lastname = line.partition(' ')
+        yield Key(firstname, lastname.strip())
+
+
+class CacheWarmer:
+    """ Looks up artists from iTunes and stores them in the cache, through the same path as requests """
+
+    def __init__(self, rate_wait, force=False):
+        """
+        :param rate_wait: Seconds to wait for the rate limit to allow a lookup
+        :param force: Looks up artists even if they are cached and fresh
+        """
+        self.rate_wait = rate_wait
+        self.force = force
+
+    def warm(self, key: Key) -> str:
+        """ Fills the cache for the artist, returning what came of it """
+        storage = movie_requests.cache_spi
+        if not self.force:
+            entry = storage.entry_lookup(key)
+            if entry is not None and entry.is_fresh():
+                return FRESH
+        try:
+            storage.save_movies(key, movie_requests.third_party.api_lookup(key, wait=self.rate_wait))
+            return FETCHED
+        except ArtistNotFound:
+            storage.save_negative(key, NOT_FOUND)
+            return MISSING
+        except UpstreamError as e:
+            logger.warning(f"Cannot warm the cache for artist '{key}': {e}")
+            return FAILED
+
+
+class Progress:
+    """ Counts the outcomes of the lookups and reports them along with the throughput every so often """
+
+    def __init__(self, out, every):
+        self.out = out
+        self.every = every
+        self.counts = {FETCHED: 0, FRESH: 0, MISSING: 0, FAILED: 0}
+        self.started = self.reported = time.monotonic()
+
+    def add(self, outcomes):
+        for outcome in outcomes:
+            self.counts[outcome] += 1
+        if time.monotonic() - self.reported >= self.every:
+            self.report()
+
+    def report(self, final=False):
+        now = time.monotonic()
+        self.reported = now
+        done = sum(self.counts.values())
+        elapsed = now - self.started
+        rate = done / elapsed if elapsed else 0.0
+        counts = ', '.join(f'{count} {outcome.replace("_", " ")}' for outcome, count in self.counts.items())
+        self.out.write(f"{'Warmed' if final else 'Warming'} {done} artists ({counts}) in {elapsed:.1f}s, "
+                       f"{rate:.1f} artists/s")
@@ -0,0 +1,182 @@
+""" This file contains the client of the memcached nodes the cache is sharded over, the LOCATION of the default cache.
+
+    Keys are spread over the nodes by rendezvous hashing, the same way the pymemcache client behind the django cache
+    and the async client do it, so all of them read each other's entries. Each node has its own pool of connections.
+    A node that fails FAILURES calls in a row is ejected: its keys go to the other nodes, so only its share of the
+    keys is lost, until it is put back RETRY_AFTER seconds later. While a node cannot be reached, lookups of its keys
+    are misses and writes to it are dropped, rather than failing requests.
+"""
+import threading
+import time
+
+from django.conf import settings
+from pymemcache.client.base import PooledClient
+from pymemcache.client.hash import normalize_server_spec
+from pymemcache.client.rendezvous import RendezvousHash
+from pymemcache.exceptions import MemcacheUnexpectedCloseError
+from pymemcache.serde import pickle_serde
+
+import logging
+logger = logging.getLogger(__name__)
+
+# failures of a node rather than of a command
+NODE_ERRORS = (OSError, MemcacheUnexpectedCloseError)
+
+
+def memcached_settings():
+    config = {'POOL_SIZE': 10, 'CONNECT_TIMEOUT': 0.5, 'TIMEOUT': 0.5, 'FAILURES': 3, 'RETRY_AFTER': 30,
+              'NOREPLY_WRITES': True}
+    config.update(getattr(settings, 'MEMCACHED', {}))
+    return config
+
+
+def node_name(server) -> str:
+    host, port = normalize_server_spec(server)
+    return f'{host}:{port}'
+
+
+class NodeRing:
+    """ The nodes keys are spread over, without those that are ejected. A node that is put back after RETRY_AFTER
+        seconds is ejected again at its next failure
+    """
+
+    def __init__(self, nodes, failures=3, retry_after=30):
+        """
+        :param nodes: The names of the nodes, as host:port
+        :param failures: The failed calls in a row after which a node is ejected
+        :param retry_after: The seconds after which an ejected node is put back
+        """
+        self.nodes = list(nodes)
+        self.failures = failures
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.failed_calls = {}  # failed calls in a row by node
+        self.ejected = {}  # monotonic time at which each ejected node is put back
+        self.counters = {'ejections': 0, 'readmissions': 0}
+        self.hasher = self._hasher()
+
+    def get_node(self, key):
+        """ Gets the node holding the key, None if every node is ejected """
+        if self.ejected and time.monotonic() >= min(self.ejected.values(), default=float('inf')):
+            self._readmit()
+        return self.hasher.get_node(key)
+
+    def succeeded(self, node):
+        if self.failed_calls:
+            with self.lock:
+                self.failed_calls.pop(node, None)
+
+    def failed(self, node):
+        with self.lock:
+            failed_calls = self.failed_calls[node] = self.failed_calls.get(node, 0) + 1
+            if failed_calls < self.failures or node in self.ejected:
+                return
+            self.ejected[node] = time.monotonic() + self.retry_after
+            self.counters['ejections'] += 1
+            self.hasher = self._hasher()
+        logger.warning(f"Ejected memcached node {node} after {failed_calls} failed calls, retrying it in "
+                       f"{self.retry_after}s")
+
+    def _readmit(self):
+        now = time.monotonic()
+        with self.lock:
+            due = [node for node, retry_at in self.ejected.items() if retry_at <= now]
+            if not due:
+                return
+            for node in due:
+                del self.ejected[node]
+                self.failed_calls[node] = self.failures - 1
+                self.counters['readmissions'] += 1
+            self.hasher = self._hasher()
+        logger.info(f"Retrying memcached nodes {', '.join(due)}")
+
+    def _hasher(self):
+        """ Builds the hashing of the live nodes. It is replaced rather than changed, as other threads may be using it
+        """
+        hasher = RendezvousHash()
+        for node in self.nodes:
+            if node not in self.ejected:
+                hasher.add_node(node)
+        return hasher
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, nodes=len(self.nodes), ejected=len(self.ejected))
+
+
+class ShardedClient:
+    """ Memcached client for many nodes, with a pool of connections per node. It is safe to use from many threads, that
+        wait for a free connection when all those to a node are in use
+    """
+
+    def __init__(self, servers, pool_size=10, connect_timeout=0.5, timeout=0.5, failures=3, retry_after=30,
+                 noreply_writes=True):
+        """
+        :param servers: The memcached nodes, as host:port
+        :param pool_size: The most connections open to a node
+        :param connect_timeout: Seconds to wait for a connection to a node
+        :param timeout: Seconds to wait for a node to answer
+        :param failures: The failed calls in a row after which a node is ejected
+        :param retry_after: The seconds after which an ejected node is put back
+        :param noreply_writes: Whether set and delete send their command without waiting for the node to answer
+        """
+        self.clients = {}
+        for server in servers:
+            host, port = normalize_server_spec(server)
+            self.clients[node_name(server)] = PooledClient(
+                (host, port), serde=pickle_serde, connect_timeout=connect_timeout, timeout=timeout,
+                max_pool_size=pool_size, allow_unicode_keys=True, default_noreply=False)
+        self.slots = {node: threading.BoundedSemaphore(pool_size) for node in self.clients}
+        self.ring = NodeRing(self.clients, failures, retry_after)
+        self.noreply_writes = noreply_writes
+
+    @classmethod
+    def from_settings(cls, servers):
+        config = memcached_settings()
+        return cls(servers, config['POOL_SIZE'], config['CONNECT_TIMEOUT'], config['TIMEOUT'], config['FAILURES'],
+                   config['RETRY_AFTER'], config['NOREPLY_WRITES'])
+
+    def get(self, key):
+        return self._call(key, 'get', None, key)
+
+    def get_many(self, keys):
+        """ Gets the values found for the keys, with a single request to each node holding any of them """
+        by_node = {}
+        for key in keys:
+            by_node.setdefault(self.ring.get_node(key), []).append(key)
+        found = {}
+        for node, node_keys in by_node.items():
+            if node is not None:
+                found.update(self._on_node(node, 'get_many', {}, node_keys))
+        return found
+
+    def set(self, key, value, expire):
+        return self._call(key, 'set', False, key, value, expire, noreply=self.noreply_writes)
+
+    def add(self, key, value, expire):
+        """ Returns True if the key was added, False if it is already held, None if its node is unavailable """
+        return self._call(key, 'add', None, key, value, expire, noreply=False)
+
+    def delete(self, key):
+        return self._call(key, 'delete', False, key, noreply=self.noreply_writes)
+
+    def _call(self, key, command, default, *args, **kwargs):
+        node = self.ring.get_node(key)
+        if node is None:
+            return default
+        return self._on_node(node, command, default, *args, **kwargs)
+
+    def _on_node(self, node, command, default, *args, **kwargs):
+        try:
+            with self.slots[node]:  # the pool of the node raises rather than waits once it is exhausted
+                result = getattr(self.clients[node], command)(*args, **kwargs)
+        except NODE_ERRORS as e:
+            logger.warning(f"Memcached node {node} failed on {command}: {e!r}")
+            self.ring.failed(node)
+            return default
+        self.ring.succeeded(node)
+        return result
+
+    def close(self):
+        for client in self.clients.values():
+            client.close()
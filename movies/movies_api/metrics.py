@@ -0,0 +1,260 @@
+""" This file contains the metrics of the request pipeline, exposed in the Prometheus text exposition format.
+
+    Counters and histograms are recorded in a shard per thread, which only that thread writes to, so recording takes
+    no lock. Shards are only merged when the metrics are collected. The shard of a thread that ends is folded into
+    the values of all the ended threads, so threads that come and go do not add up. Values that other parts of the
+    service already keep, such as the stats() of the caches, are read by collectors at that time.
+
+    The stages of a request are also recorded for that request alone while it is being handled, so that the
+    ServerTimingMiddleware can report them.
+"""
+import contextvars
+import math
+import threading
+import time
+import weakref
+from bisect import bisect_left
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    """ Holds the metrics and the per thread shards their values are recorded in """
+
+    def __init__(self):
+        self._lock = threading.RLock()  # an ended thread may be folded in by whichever thread drops its last reference
+        self._local = threading.local()
+        self._shards = []
+        self._ended = {}  # the values of the threads that ended, summed
+        self._metrics = []
+        self._collectors = []
+
+    def shard(self):
+        """ Gets the values recorded by the current thread, keyed by metric name and label values """
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            # the owner is only held by the thread, and so is dropped when the thread ends
+            self._local.owner = owner = _ShardOwner()
+            weakref.finalize(owner, self._fold, shard)
+            with self._lock:  # once per thread
+                self._shards.append(shard)
+            return shard
+
+    def _fold(self, shard):
+        """ Adds the values of a thread that ended to those of the threads that ended before, and drops its shard """
+        with self._lock:
+            self._shards = [other for other in self._shards if other is not shard]
+            _add(self._ended, list(shard.items()))
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=STAGE_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """ Adds a function called on every collection, which returns (name, type, documentation, samples) tuples
+            where samples is a list of (labels, value) and labels is a dict
+        """
+        self._collectors.append(collector)
+
+    def merged(self, name):
+        """ Gets the values of a metric summed over all the shards, keyed by label values """
+        merged = {}
+        with self._lock:  # a shard is either still listed or already in the ended values, never both
+            shards = list(self._shards)
+            _add(merged, _of_metric(self._ended, name))
+        for shard in shards:
+            _add(merged, _of_metric(shard, name))
+        return merged
+
+    def render(self) -> str:
+        """ Gets all the metrics in the text exposition format """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.exposition())
+        collected = {}  # collectors may each report some of the samples of a metric
+        for collector in self._collectors:
+            for name, kind, documentation, samples in collector():
+                collected.setdefault(name, (kind, documentation, []))[2].extend(samples)
+        for name, (kind, documentation, samples) in collected.items():
+            lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{_labels(labels.items())} {_number(value)}' for labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+class _ShardOwner:
+    __slots__ = ('__weakref__',)
+
+
+def _add(totals, values):
+    """ Adds (key, value) pairs to the totals, where values are numbers or lists of them such as histogram buckets """
+    for key, value in values:
+        if isinstance(value, list):
+            total = totals.setdefault(key, [0] * len(value))
+            for i, v in enumerate(list(value)):
+                total[i] += v
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def _of_metric(shard, name):
+    """ Gets the (label values, value) pairs of a metric in a shard """
+    return [(labels, value) for (metric, labels), value in list(shard.items()) if metric == name]
+
+
+class Counter:
+    def __init__(self, registry, name, documentation, labelnames):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+
+    def inc(self, *labels, amount=1):
+        """ Adds to the count for the label values """
+        shard = self.registry.shard()
+        key = (self.name, labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def values(self):
+        return self.registry.merged(self.name)
+
+    def exposition(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        for labels, value in sorted(self.values().items()):
+            yield f'{self.name}{_labels(zip(self.labelnames, labels))} {_number(value)}'
+
+
+class Histogram:
+    def __init__(self, registry, name, documentation, labelnames, buckets):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        """ Records a value for the label values. A shard holds the count of each bucket, the last one being +Inf,
+            followed by the sum of the values
+        """
+        shard = self.registry.shard()
+        key = (self.name, labels)
+        counts = shard.get(key)
+        if counts is None:
+            counts = shard[key] = [0] * (len(self.buckets) + 2)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def time(self, *labels):
+        """ Records the seconds taken by a with block for the label values """
+        return _Timer(self, labels)
+
+    def values(self):
+        return self.registry.merged(self.name)
+
+    def exposition(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for labels, counts in sorted(self.values().items()):
+            named = list(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{_labels(named + [("le", _number(bound))])} {cumulative}'
+            yield f'{self.name}_sum{_labels(named)} {_number(counts[-1])}'
+            yield f'{self.name}_count{_labels(named)} {cumulative}'
+
+
+class _Timer:
+    """ Context manager timing a block, lighter than one made with contextlib """
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class _StageTimer(_Timer):
+    __slots__ = ('stage',)
+
+    def __init__(self, stage):
+        super().__init__(STAGE_SECONDS, (stage,))
+        self.stage = stage
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        self.histogram.observe(elapsed, self.stage)
+        stages = _request_stages.get()
+        if stages is not None:
+            stages[self.stage] = stages.get(self.stage, 0) + elapsed
+
+
+_request_stages = contextvars.ContextVar('request_stages', default=None)
+
+
+def stage(name):
+    """ Times a with block as a stage of looking up movies, for the metrics and for the request being handled """
+    return _StageTimer(name)
+
+
+def record_stages():
+    """ Starts recording the seconds the current request spends in each stage, returning the dict they are recorded
+        in and the token that stops recording them
+    """
+    stages = {}
+    return stages, _request_stages.set(stages)
+
+
+def stop_recording_stages(token):
+    _request_stages.reset(token)
+
+
+def add_stages(stages):
+    """ Adds stages recorded in another thread, eg by a worker of a pool, to the stages of the current request """
+    recorded = _request_stages.get()
+    if recorded is not None:
+        for name, seconds in stages.items():
+            recorded[name] = recorded.get(name, 0) + seconds
+
+
+def _labels(pairs) -> str:
+    pairs = list(pairs)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _number(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram('movies_stage_seconds', "Seconds spent in each stage of looking up movies",
+                                   ('stage',))
+CACHE_LOOKUPS = registry.counter('movies_cache_lookups_total',
+                                 "Lookups of artists in the cache by result: hit, stale, miss or error", ('result',))
+UPSTREAM_RESPONSES = registry.counter('movies_upstream_responses_total',
+                                      "Responses from the 3rd party api by status code, error when it was not reached",
+                                      ('status',))
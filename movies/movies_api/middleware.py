@@ -0,0 +1,98 @@
+""" This file contains the middleware reporting where the time of a request went, and profiling requests on demand """
+import asyncio
+import cProfile
+import random
+import re
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+
+from .metrics import record_stages
+from .metrics import stop_recording_stages
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def profiling_settings():
+    config = {'TOKEN': None, 'SAMPLE_RATE': 0.0, 'DIRECTORY': '/tmp/movies-profiles'}
+    config.update(getattr(settings, 'PROFILING', {}))
+    return config
+
+
+class ServerTimingMiddleware:
+    """ Adds a Server-Timing header to responses, holding the milliseconds the request spent in each stage of looking
+        up movies, in the view and in total. The total covers the middleware below this one, so it should come first.
+
+        Requests are also profiled with cProfile when they carry the X-Profile header set to the configured token,
+        or at random at the configured sample rate. The profile is saved for offline analysis, e.g. with
+        python -m pstats, and its file named in the X-Profile-Id header of the response. Only requests to the
+        blocking views are profiled, as a profile of a request on an event loop would hold the other requests on it
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        self.profiling = profiling_settings()
+        if self.is_async:
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stages, token = record_stages()
+        start = time.perf_counter()
+        try:
+            profiler = cProfile.Profile() if self.wants_profile(request) else None
+            if profiler is None:
+                response = self.get_response(request)
+            else:
+                response = profiler.runcall(self.get_response, request)
+                response['X-Profile-Id'] = self.save_profile(profiler, request)
+        finally:
+            stop_recording_stages(token)
+        return self.with_timings(request, response, stages, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        stages, token = record_stages()
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            stop_recording_stages(token)
+        return self.with_timings(request, response, stages, time.perf_counter() - start)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.view_started = time.perf_counter()
+
+    def wants_profile(self, request):
+        token = self.profiling['TOKEN']
+        if token and request.headers.get('X-Profile') == token:
+            return True
+        return random.random() < self.profiling['SAMPLE_RATE']
+
+    def save_profile(self, profiler, request):
+        directory = Path(self.profiling['DIRECTORY'])
+        directory.mkdir(parents=True, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '-', request.path).strip('-')
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{uuid.uuid4().hex[:8]}.prof"
+        profiler.dump_stats(directory / name)
+        logger.info(f"Saved the profile of {request.path} to {directory / name}")
+        return name
+
+    @staticmethod
+    def with_timings(request, response, stages, total):
+        """ Adds the Server-Timing header. The view is timed from when it is called until the response gets back
+            to this middleware
+        """
+        view_started = getattr(request, 'view_started', None)
+        metrics = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in stages.items()]
+        if view_started is not None:
+            metrics.append(f'view;dur={(time.perf_counter() - view_started) * 1000:.2f}')
+        metrics.append(f'total;dur={total * 1000:.2f}')
+        response['Server-Timing'] = ', '.join(metrics)
+        return response
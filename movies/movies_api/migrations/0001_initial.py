@@ -0,0 +1,22 @@
+# Generated by Django 3.2 on 2026-10-18 14:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArtistSnapshot',
+            fields=[
+                ('key', models.CharField(max_length=250, primary_key=True, serialize=False)),
+                ('entry', models.BinaryField()),
+                ('stored_at', models.FloatField(db_index=True)),
+            ],
+        ),
+    ]
@@ -1,50 +1,107 @@
-import json
+import hashlib
+import sys
+import unicodedata
+from functools import lru_cache
+from operator import itemgetter
 from typing import Dict
 from typing import List
 
 from django.db import models
+
+from .json_codec import dumps
 import datetime
 
 import logging
 logger = logging.getLogger(__name__)
 
 
-def equality_tester(self_, clazz, other) -> bool:
-    """ Returns True if instances of the same object are equal, False otherwise """
-    if isinstance(other, clazz):
-        for var in vars(self_):
-            var_of_self = getattr(self_, var)
-            var_of_other = getattr(other, var)
+ROW_FIELDS = ('name', 'release date', 'genre')
+
+_release_years = {}
+
+
+def movie_row(track_name: str, release_date: int, genre: str) -> tuple:
+    """ Makes the row a movie is held as: a (name, release year, genre) tuple. Genres and release years repeat across
+        movies and artists, so one copy of each is shared by all the rows
+    """
+    if type(genre) is str:
+        genre = sys.intern(genre)
+    return track_name, _release_years.setdefault(release_date, release_date), genre
+
+
+def shared_release_years(release_dates: List[int]) -> List[int]:
+    """ Gets the copies of the release years shared by all the rows, in the order of release_dates """
+    return [_release_years.setdefault(release_date, release_date) for release_date in release_dates]
+
+
+def pick(values, keys):
+    """ Gets the value for each of the keys, in a single call """
+    if len(keys) == 1:
+        return [values[keys[0]]]
+    return itemgetter(*keys)(values) if keys else ()
 
-            if var_of_self != var_of_other:
-                return False
-        return True
-    return False
+
+def canonical_name(name: str) -> str:
+    """ Canonicalizes a name so that its variants in case, spacing, Unicode form and accents are the same name,
+        eg, ' KEVIN  Hart' and 'kevin hart', or 'Beyoncé' and 'beyonce'. Only the accents of Latin letters are
+        removed: the marks of other scripts, such as the dakuten of ガ or the virama of Devanagari, tell names apart
+    """
+    if not name.isascii():
+        name = ''.join(map(_without_accent, unicodedata.normalize('NFKC', name)))
+    return ' '.join(unicodedata.normalize('NFKC', name).casefold().split())
+
+
+def key_part(name: str) -> str:
+    """ Escapes a canonical name for the key of an artist: memcached keys cannot hold spaces, so they become '+', and
+        the '%', '+' and '_' of the name itself are percent-encoded, so that eg 'a+b' and 'a b' get different keys
+    """
+    return name.replace('%', '%25').replace('+', '%2B').replace('_', '%5F').replace(' ', '+')
+
+
+@lru_cache(maxsize=4096)
+def _without_accent(char: str) -> str:
+    if not unicodedata.name(char, '').startswith('LATIN '):
+        return char
+    return ''.join(c for c in unicodedata.normalize('NFKD', char) if not unicodedata.combining(c))
 
 
 class Key:
     """ Encapsulates a search query object used for lookups """
+    __slots__ = ('firstname', 'lastname', 'genre', 'release_date', 'key', 'filter', 'offset', 'limit', 'fields',
+                 'paged')
 
-    def __init__(self, firstname: str, lastname: str, genre='all', release_date=9999):
+    def __init__(self, firstname: str, lastname: str, genre='all', release_date=9999, offset=0, limit=None,
+                 fields=None):
         """
         :param firstname: First name of an artist, eg, 'kevin' in 'Kevin Hart'
         :param lastname: Last name of an artist, eg, 'hart' in 'Kevin Hart'
+        :param offset: The number of matching movies to skip
+        :param limit: The most movies to return, None for all of them
+        :param fields: The details of each movie to return, out of ROW_FIELDS, None for all of them
         """
-        self.firstname = firstname
-        self.lastname = lastname
+        self.firstname = canonical_name(firstname)
+        self.lastname = canonical_name(lastname)
         self.genre = genre
         self.release_date = release_date
-        self.key = f'{firstname}_{lastname}'
+        self.key = f'{key_part(self.firstname)}_{key_part(self.lastname)}'
         self.filter = genre != 'all' or release_date != 9999
+        self.offset = offset
+        self.limit = limit
+        self.fields = None if fields is None else tuple(field for field in ROW_FIELDS if field in fields)
+        self.paged = offset != 0 or limit is not None
 
     def __eq__(self, other):
-        return equality_tester(self, Key, other)
+        if not isinstance(other, Key):
+            return False
+        return (self.key == other.key and self.firstname == other.firstname and self.lastname == other.lastname
+                and self.genre == other.genre and self.release_date == other.release_date
+                and self.offset == other.offset and self.limit == other.limit and self.fields == other.fields)
 
     def __hash__(self):
         return hash(self.key)
 
     def __str__(self):
-        return self.key.replace("_", " ")
+        return f'{self.firstname} {self.lastname}'
 
     def get_firstname(self):
         return self.firstname
@@ -64,6 +121,12 @@ class Key:
     def apply_filter(self):
         return self.filter
 
+    def apply_paging(self):
+        return self.paged
+
+    def get_fields(self):
+        return self.fields
+
     def filter_by_genre_only(self):
         return self.filter and self.genre != 'all' and self.release_date == 9999
 
@@ -73,6 +136,7 @@ class Key:
 
 class Movie:
     """ This holds details about a movie for an artist """
+    __slots__ = ('track_name', 'release_date', 'primary_genre_name')
 
     def __init__(self, track_name: str, release_date: str, primary_genre_name: str):
         """"
@@ -82,7 +146,11 @@ class Movie:
         """
         self.track_name = track_name
         self.release_date = extract_release_date(release_date)
-        self.primary_genre_name = primary_genre_name
+        self.primary_genre_name = sys.intern(primary_genre_name) if type(primary_genre_name) is str \
+            else primary_genre_name
+
+    def row(self) -> tuple:
+        return movie_row(self.track_name, self.release_date, self.primary_genre_name)
 
     def details(self) -> Dict[str, str]:
         """ Gets the details of an artists movies as a dict """
@@ -97,25 +165,106 @@ class Movie:
 
 
 class Movies:
-    """ This holds all the movies for an artist """
+    """ This holds all the movies for an artist, as rows made by movie_row """
+    __slots__ = ('key', 'rows', 'index', 'version', 'stored_at', 'fresh_until')
 
     def __init__(self, artist_name: Key):
         """
         :param artist_name: The name of the artist, held in a Key object
         """
         self.key = artist_name.__str__()
-        self.movies = {self.key: []}  # container that holds all the movies
+        self.rows = []  # container that holds all the movies
+        self.index = None
+        self.version = None  # content hash, set once the movies are cached
+        self.stored_at = None  # unix timestamps of when the cache entry holding the movies was stored and goes stale
+        self.fresh_until = None
+
+    @classmethod
+    def from_rows(cls, artist_name, rows: List[tuple]):
+        """ Creates the movies of an artist from rows made by movie_row
+            :param artist_name: The name of the artist, held in a Key object or as the canonical name it is cached as
+        """
+        movies = cls(artist_name)
+        movies.rows = list(rows)
+        return movies
+
+    def __setstate__(self, state):
+        """ Restores pickled movies, including those pickled before they were held as rows: as a dict with the
+            movie details of the artist in 'movies'
+        """
+        if isinstance(state, tuple):
+            state = dict(state[0] or {}, **state[1])
+        if 'movies' in state:
+            details = state.pop('movies').get(state['key'], [])
+            state['rows'] = [movie_row(*map(movie.get, ROW_FIELDS)) for movie in details]
+            state['index'] = None
+        for name in self.__slots__:
+            setattr(self, name, state.get(name))
 
     def add(self, movie: Movie):
-        logger.debug(f"Adding movie '{movie.__str__()}' for artist '{self.key.__str__()}'")
-        self.movies.get(self.key).append(movie.details())
+        logger.debug("Adding movie '%s' for artist '%s'", movie, self.key)
+        self.rows.append(movie.row())
+        self.index = None
 
-    def all_movies(self) -> List[Dict[str, str]]:
-        """ Gets a list of movie details for an artist """
-        return self.movies.get(self.key)
+    def build_index(self):
+        """ Indexes the movies by lower case genre, by release year and by both, so that filtering them costs the
+            size of the result rather than a scan of every movie
+        """
+        by_genre, by_release_date, by_both = {}, {}, {}
+        for row in self.rows:
+            _, release_date, genre = row
+            genre = genre.lower()
+            by_genre.setdefault(genre, []).append(row)
+            by_release_date.setdefault(release_date, []).append(row)
+            by_both.setdefault((genre, release_date), []).append(row)
+        self.index = MoviesIndex(by_genre, by_release_date, by_both)
+        return self.index
+
+    def matching(self, genre=None, release_date=None) -> List[tuple]:
+        """ Gets the rows of the movies matching a genre, a release year or both, as held by the index. They are not
+            to be changed
+            :param genre: The genre to match, in any case
+            :param release_date: The release year to match
+        """
+        index = self.index or self.build_index()
+        if genre is not None and release_date is not None:
+            return index.by_both.get((genre.lower(), release_date), [])
+        elif genre is not None:
+            return index.by_genre.get(genre.lower(), [])
+        return index.by_release_date.get(release_date, [])
+
+    def select(self, artist_name: Key, genre=None, release_date=None):
+        """ Gets the movies matching a genre, a release year or both
+            :param artist_name: The key the selection is made for
+            :param genre: The genre to match, in any case
+            :param release_date: The release year to match
+        """
+        return Movies.from_rows(artist_name, self.matching(genre, release_date))
 
-    def details(self):
-        return json.dumps(self.movies)
+    def all_movies(self, fields=None) -> List[Dict[str, str]]:
+        """ Gets a list of movie details for an artist
+            :param fields: The details of each movie to get, out of ROW_FIELDS, None for all of them
+        """
+        if fields is None:
+            return [dict(zip(ROW_FIELDS, row)) for row in self.rows]
+        positions = [(field, ROW_FIELDS.index(field)) for field in fields]
+        return [{field: row[position] for field, position in positions} for row in self.rows]
+
+    def details(self, fields=None):
+        return dumps({self.key: self.all_movies(fields)})
+
+    def content_hash(self) -> str:
+        """ Gets a hash of the movies, which changes whenever any of them does """
+        return hashlib.sha1(self.details().encode()).hexdigest()
+
+
+class MoviesIndex:
+    """ The movies of an artist grouped by lower case genre, by release year and by (genre, release year) """
+
+    def __init__(self, by_genre, by_release_date, by_both):
+        self.by_genre = by_genre
+        self.by_release_date = by_release_date
+        self.by_both = by_both
 
 
 def extract_release_date(as_string: str) -> int:
@@ -126,3 +275,10 @@ def extract_release_date(as_string: str) -> int:
     except (AttributeError, ValueError):
         # todo: this can be handled better
         return int(as_string)
+
+
+class ArtistSnapshot(models.Model):
+    """ The cached entry of an artist as last stored, encoded as it is in memcached. See snapshot.Snapshot """
+    key = models.CharField(max_length=250, primary_key=True)
+    entry = models.BinaryField()
+    stored_at = models.FloatField(db_index=True)
@@ -1,178 +1,1274 @@
 """ This file contains the functionality to make requests and how to handle responses and errors """
-import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
 
 import requests
 import pickle
+from requests.adapters import HTTPAdapter
+from django.conf import settings
 from django.http import HttpResponse
+from django.http import StreamingHttpResponse
+from django.core.cache import cache
 from django.core.cache import caches
 from .models import Key, Movies, Movie
-from bson.binary import Binary
-from bson.binary import USER_DEFINED_SUBTYPE
+from .json_codec import dumps_bytes
+from .json_codec import load_results
+from .memcached import ShardedClient
+from .metrics import CACHE_LOOKUPS
+from .metrics import UPSTREAM_RESPONSES
+from .metrics import add_stages
+from .metrics import record_stages
+from .metrics import registry
+from .metrics import stage
+from .metrics import stop_recording_stages
+from .resilience import CircuitBreaker
+from .resilience import RateLimiter
+from .resilience import guard_settings
+from .responses import RenderedResponse
+from .responses import ResponseCache
+from .responses import Validators
+from .responses import response_cache_settings
+from .serialization import decode_entry
+from .serialization import encode_entry
+from .serialization import is_encoded
+from .snapshot import Snapshot
+from .snapshot import snapshot_settings
 
 import logging
 logger = logging.getLogger(__name__)
 
 
+class ArtistNotFound(ValueError):
+    """ Raised when the 3rd party api has no movies for an artist """
+
+
+class UpstreamError(ValueError):
+    """ Raised when the 3rd party api fails or cannot be reached """
+
+
+class UpstreamUnavailable(UpstreamError):
+    """ Raised without calling the 3rd party api, while its circuit is open or its rate limit is reached """
+
+
 def get_storage(in_memory):
     if in_memory:
         logger.info("Using in memory storage")
         return InMemoryStorage()
+    shared = MemCached()
+    if get_snapshot() is not None:
+        logger.info("Keeping a snapshot of the cached artists in the database")
+        shared = SnapshotStorage(shared, get_snapshot())
+    config = local_cache_settings()
+    if config['ENABLED']:
+        logger.info("Using in real storage behind a local cache")
+        return TwoTierStorage(LocalCache(config['MAX_ENTRIES'], config['MAX_BYTES'], config['TTL']), shared)
     logger.info("Using in real storage")
-    return MemCached()
+    return shared
+
+
+_snapshot = None
 
 
-def to_binary(movies: Movies):
-    return Binary(pickle.dumps(movies), USER_DEFINED_SUBTYPE)
+def get_snapshot():
+    """ Gets the snapshot of the cached artists that the pipelines of the worker process share, None if it is off """
+    global _snapshot
+    config = snapshot_settings()
+    if not config['ENABLED']:
+        return None
+    if _snapshot is None:
+        _snapshot = Snapshot(freshness_settings()['MAX_STALE'], config['INTERVAL'], config['MAX_BATCH'])
+    return _snapshot
+
+
+def local_cache_settings():
+    config = {'ENABLED': True, 'MAX_ENTRIES': 1000, 'MAX_BYTES': 64 * 1024 * 1024, 'TTL': 60}
+    config.update(getattr(settings, 'LOCAL_CACHE', {}))
+    return config
 
 
 class MemCached:
+    """ The memcached nodes in the LOCATION of the default cache, which keys are sharded over, see ShardedClient.
+        Keys and expiry times follow the django cache, so that entries are shared with the async pipeline
+    """
+
     def __init__(self):
         self.memcached = caches['default']
+        self.client = ShardedClient.from_settings(self.memcached._servers)
+        # entries outlive their freshness so stale ones can still be served, see CacheSpi
+        self.timeout = self.memcached.get_backend_timeout(freshness_settings()['MAX_STALE'])
 
     def put(self, key, details):
-        self.memcached.add(key.as_key(), details)
+        self.client.set(self.memcached.make_key(key.as_key()), to_stored(details), self.timeout)
 
     def get(self, key):
-        return self.memcached.get(key.as_key())
+        return from_stored(self.client.get(self.memcached.make_key(key.as_key())))
+
+    def get_many(self, keys):
+        names = {self.memcached.make_key(key): key for key in (key.as_key() for key in keys)}
+        found = self.client.get_many(list(names))
+        return {names[name]: from_stored(value) for name, value in found.items()}
+
+    def get_latest(self, key):
+        return self.get(key)
+
+    def delete(self, key):
+        self.client.delete(self.memcached.make_key(key.as_key()))
+
+    def put_negative(self, key, entry, timeout):
+        self.client.set(self.memcached.make_key(negative_key(key)), entry, self.memcached.get_backend_timeout(timeout))
+
+    def get_negative(self, key):
+        return self.client.get(self.memcached.make_key(negative_key(key)))
+
+    def acquire_lease(self, key, timeout):
+        """ Returns True if this process now holds the short-lived fetch lease for the key. When the node of the lease
+            is unavailable every process holds it, rather than none
+        """
+        return self.client.add(self.memcached.make_key(lease_key(key)), 1,
+                               self.memcached.get_backend_timeout(timeout)) is not False
+
+    def release_lease(self, key):
+        self.client.delete(self.memcached.make_key(lease_key(key)))
+
+    def lease_held(self, key):
+        """ Returns True while a process holds the fetch lease for the key, False once it is released or runs out """
+        return self.client.get(self.memcached.make_key(lease_key(key))) is not None
+
+    def node_stats(self):
+        return self.client.ring.stats()
+
+
+def to_stored(details):
+    """ Encodes cache entries of movies to the compact binary format, anything else is left to the cache to pickle """
+    if isinstance(details, CacheEntry) and isinstance(details.movies, Movies):
+        return encode_entry(details)
+    return details
+
+
+def from_stored(value):
+    if not is_encoded(value):
+        return value
+    with stage('decode'):
+        decoded = decode_entry(value)
+    if decoded is None:
+        return None
+    movies, stored_at, soft_expiry, hard_expiry = decoded
+    return CacheEntry(movies, stored_at, soft_ttl=soft_expiry - stored_at, hard_ttl=hard_expiry - stored_at)
 
 
 class InMemoryStorage:
     """ This uses a python dictionary for storage. Mainly used for testing without starting up memcached """
     def __init__(self):
         self.storage = {}
+        self.leases = {}
+
+    def put(self, key, details):
+        self.storage[key.as_key()] = details
+
+    def get(self, key):
+        return self.storage.get(key.as_key())
+
+    def get_many(self, keys):
+        return {key.as_key(): self.storage[key.as_key()] for key in keys if key.as_key() in self.storage}
+
+    def get_latest(self, key):
+        return self.get(key)
+
+    def delete(self, key):
+        self.storage.pop(key.as_key(), None)
+
+    def put_negative(self, key, entry, timeout):
+        self.storage[negative_key(key)] = entry
+
+    def get_negative(self, key):
+        return self.storage.get(negative_key(key))
+
+    def acquire_lease(self, key, timeout):
+        now = time.monotonic()
+        if self.leases.get(lease_key(key), 0) > now:
+            return False
+        self.leases[lease_key(key)] = now + timeout
+        return True
+
+    def release_lease(self, key):
+        self.leases.pop(lease_key(key), None)
+
+    def lease_held(self, key):
+        return self.leases.get(lease_key(key), 0) > time.monotonic()
+
+
+class LocalCache:
+    """ A least recently used cache held in the memory of the worker process. It is bounded by both the number of
+        entries and their estimated size in bytes, and entries expire after a time to live
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, sizeof=None):
+        """
+        :param max_entries: The most entries held before the least recently used ones are evicted
+        :param max_bytes: The memory budget of the held entries
+        :param ttl: The seconds after which an entry is no longer served
+        :param sizeof: Estimates the size in bytes of a value, estimated_size by default
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof or estimated_size
+        self.entries = OrderedDict()  # key -> (value, size, expires at)
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            value, _, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.counters['expirations'] += 1
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (value, size, time.monotonic() + self.ttl)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+                self.counters['evictions'] += 1
+
+    def delete(self, key):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.bytes -= size
+
+    def stats(self):
+        """ Gets a snapshot of the hit, miss and eviction counters along with the current usage """
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.bytes)
+
+
+# memory held by a decoded and indexed entry of movies and by each of its movies, see benchmarks.memory_benchmark
+ENTRY_BYTES = 4400
+MOVIE_BYTES = 320
+
+
+def estimated_size(value):
+    """ Estimates the memory a value held in a local cache takes. Entries of movies are estimated from their number
+        of movies, as pickling them to measure them would cost about as much as decoding them. Other values, which are
+        small, are measured by their pickled size
+    """
+    if isinstance(value, CacheEntry) and isinstance(value.movies, Movies):
+        return ENTRY_BYTES + MOVIE_BYTES * len(value.movies.rows)
+    return len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+class TwoTierStorage:
+    """ Keeps the entries of a shared storage in a local cache, so hot entries are served without a network round
+        trip. Writes and deletes go to both tiers. Entries written by other worker processes are seen once the local
+        copy expires, so the local time to live bounds how long a worker can serve an outdated entry
+    """
+
+    def __init__(self, local: LocalCache, shared):
+        self.local = local
+        self.shared = shared
 
     def put(self, key, details):
-        self.storage[key] = details
+        self.shared.put(key, details)
+        self.local.put(key.as_key(), details)
 
     def get(self, key):
-        return self.storage.get(key)
+        details = self.local.get(key.as_key())
+        if details is None:
+            details = self.get_latest(key)
+        return details
+
+    def get_many(self, keys):
+        found, missing = {}, []
+        for key in keys:
+            details = self.local.get(key.as_key())
+            if details is None:
+                missing.append(key)
+            else:
+                found[key.as_key()] = details
+        if missing:
+            shared = self.shared.get_many(missing)
+            for key, details in shared.items():
+                self.local.put(key, details)
+            found.update(shared)
+        return found
+
+    def get_latest(self, key):
+        """ Gets the entry from the shared storage, bypassing the local copy """
+        details = self.shared.get(key)
+        if details is not None:
+            self.local.put(key.as_key(), details)
+        return details
+
+    def delete(self, key):
+        self.shared.delete(key)
+        self.local.delete(key.as_key())
+
+    def put_negative(self, key, entry, timeout):
+        self.shared.put_negative(key, entry, timeout)
+        self.local.put(negative_key(key), entry)
+
+    def get_negative(self, key):
+        entry = self.local.get(negative_key(key))
+        if entry is None:
+            entry = self.shared.get_negative(key)
+            if entry is not None:
+                self.local.put(negative_key(key), entry)
+        return entry
+
+    def acquire_lease(self, key, timeout):
+        return self.shared.acquire_lease(key, timeout)
+
+    def release_lease(self, key):
+        self.shared.release_lease(key)
+
+    def lease_held(self, key):
+        return self.shared.lease_held(key)
+
+
+class SnapshotStorage:
+    """ Keeps the artists stored in memcached in the snapshot too, see snapshot.Snapshot. Artists missing from memcached
+        after a restart or a flush are served from the snapshot and put back in memcached. They keep when they were
+        stored, so CacheSpi serves them stale, refreshes them or looks them up again as it would have from memcached
+    """
+
+    def __init__(self, shared, snapshot: Snapshot):
+        self.shared = shared
+        self.snapshot = snapshot
+
+    def put(self, key, details):
+        self.shared.put(key, details)
+        if is_snapshot_entry(details):
+            self.snapshot.save(key.as_key(), details)
+
+    def get(self, key):
+        details = self.shared.get(key)
+        if details is None:
+            details = self.restore({key.as_key(): key}).get(key.as_key())
+        return details
+
+    def get_many(self, keys):
+        found = self.shared.get_many(keys)
+        missing = {key.as_key(): key for key in keys if key.as_key() not in found}
+        if missing:
+            found.update(self.restore(missing))
+        return found
+
+    def restore(self, keys):
+        """ Gets the entries of the snapshot for the keys, putting them back in memcached
+            :param keys: The keys by Key.as_key()
+        """
+        restored = {}
+        for name, value in self.snapshot.get_many(list(keys)).items():
+            details = from_stored(value)
+            if details is not None:
+                self.shared.put(keys[name], details)
+                restored[name] = details
+        return restored
+
+    def get_latest(self, key):
+        return self.get(key)
+
+    def delete(self, key):
+        self.shared.delete(key)
+        self.snapshot.delete(key.as_key())
+
+    def put_negative(self, key, entry, timeout):
+        self.shared.put_negative(key, entry, timeout)
+
+    def get_negative(self, key):
+        return self.shared.get_negative(key)
+
+    def acquire_lease(self, key, timeout):
+        return self.shared.acquire_lease(key, timeout)
+
+    def release_lease(self, key):
+        self.shared.release_lease(key)
+
+    def lease_held(self, key):
+        return self.shared.lease_held(key)
+
+    def node_stats(self):
+        return self.shared.node_stats()
+
+
+def is_snapshot_entry(details):
+    """ Returns True for the entries kept in the snapshot, those of movies """
+    return isinstance(details, CacheEntry) and isinstance(details.movies, Movies)
+
+
+def lease_key(key: Key):
+    return f'lease:{key.as_key()}'
+
+
+def negative_key(key: Key):
+    return f'negative:{key.as_key()}'
+
+
+def freshness_settings():
+    """ Gets the ages in seconds at which cached entries go stale (SOFT_TTL), can no longer be served while they are
+        refreshed (HARD_TTL) and can no longer be served even if the 3rd party api is failing (MAX_STALE)
+    """
+    config = {'SOFT_TTL': 86400, 'HARD_TTL': 90000, 'MAX_STALE': 259200}
+    config.update(getattr(settings, 'CACHE_FRESHNESS', {}))
+    return config
+
+
+class CacheEntry:
+    """ The movies of an artist as they are stored in the cache, along with when they go stale """
+
+    def __init__(self, movies, stored_at=None, soft_ttl=None, hard_ttl=None):
+        """
+        :param movies: The cached movies
+        :param stored_at: When the movies were stored, as a unix timestamp. Defaults to now
+        """
+        config = freshness_settings()
+        self.movies = movies
+        self.stored_at = time.time() if stored_at is None else stored_at
+        self.soft_expiry = self.stored_at + (config['SOFT_TTL'] if soft_ttl is None else soft_ttl)
+        self.hard_expiry = self.stored_at + (config['HARD_TTL'] if hard_ttl is None else hard_ttl)
+        if isinstance(movies, Movies):  # for the cache headers of responses rendered from them
+            movies.stored_at, movies.fresh_until = self.stored_at, self.soft_expiry
+
+    def is_fresh(self, now=None):
+        return (now or time.time()) < self.soft_expiry
+
+    def is_expired(self, now=None):
+        """ Returns True if the entry is too old to be served while it is refreshed in the background """
+        return (now or time.time()) >= self.hard_expiry
+
+    def age(self, now=None):
+        return (now or time.time()) - self.stored_at
+
+
+def as_cache_entry(value):
+    """ Gets a stored value as a cache entry. Values stored before entries carried their expiry are taken as fresh """
+    if value is None or isinstance(value, CacheEntry):
+        return value
+    return CacheEntry(value)
+
+
+NOT_FOUND = 'not_found'
+UPSTREAM_ERROR = 'upstream_error'
+
+
+def negative_cache_settings():
+    """ Gets how many seconds failed lookups are remembered for, by kind of failure """
+    config = {'NOT_FOUND_TTL': 300, 'UPSTREAM_ERROR_TTL': 30}
+    config.update(getattr(settings, 'NEGATIVE_CACHE', {}))
+    return {NOT_FOUND: config['NOT_FOUND_TTL'], UPSTREAM_ERROR: config['UPSTREAM_ERROR_TTL']}
+
+
+class NegativeEntry:
+    """ Remembers that looking up the movies of an artist failed, and how """
+
+    def __init__(self, kind, ttl):
+        """
+        :param kind: NOT_FOUND or UPSTREAM_ERROR
+        :param ttl: The seconds for which the failure is remembered
+        """
+        self.kind = kind
+        self.expires_at = time.time() + ttl
+
+    def is_expired(self):
+        return time.time() >= self.expires_at
 
 
 class CacheSpi:
-    """ This is a service provider interface for the storage"""
-    def __init__(self, in_memory=False):
+    """ This is a service provider interface for the storage. Entries past their soft expiry are served stale while a
+        single background refresh goes to the 3rd party api, entries past their hard expiry are not served
+    """
+    def __init__(self, in_memory=False, third_party=None):
+        """
+        :param in_memory: Whether to use the in memory storage rather than memcached
+        :param third_party: Used to refresh stale entries. Stale entries are not refreshed without it
+        """
         self.storage = get_storage(in_memory)
+        self.third_party = third_party
+        self.refreshing = set()
+        self.refresh_lock = threading.Lock()
+        self.refresh_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cache-refresh')
+        self.negative_lock = threading.Lock()
+        self.negative_counters = {'lookups': 0, f'{NOT_FOUND}_hits': 0, f'{UPSTREAM_ERROR}_hits': 0,
+                                  f'{NOT_FOUND}_stores': 0, f'{UPSTREAM_ERROR}_stores': 0}
 
     def storage_lookup(self, key: Key):
+        with stage('lookup'):
+            try:
+                entry = self.entry_lookup(key)
+            except Exception:
+                CACHE_LOOKUPS.inc('error')
+                raise
+        if entry is None or entry.is_expired():
+            CACHE_LOOKUPS.inc('miss')
+            return None
+        if not entry.is_fresh():
+            CACHE_LOOKUPS.inc('stale')
+            logger.info("Movies for artist '%s' are stale, serving them while they are refreshed", key)
+            self.schedule_refresh(key)
+        else:
+            CACHE_LOOKUPS.inc('hit')
+        return entry.movies
+
+    def storage_lookup_many(self, keys):
+        """ Looks up many keys in a single storage request, returning the movies found keyed by Key.as_key() """
+        with stage('lookup'):
+            try:
+                entries = self.storage.get_many(keys)
+            except Exception:
+                CACHE_LOOKUPS.inc('error', amount=len(keys))
+                raise
+        found = {}
+        for key in keys:
+            entry = as_cache_entry(entries.get(key.as_key()))
+            if entry is None or entry.is_expired():
+                CACHE_LOOKUPS.inc('miss')
+                continue
+            if not entry.is_fresh():
+                CACHE_LOOKUPS.inc('stale')
+                self.schedule_refresh(key)
+            else:
+                CACHE_LOOKUPS.inc('hit')
+            found[key.as_key()] = entry.movies
+        return found
+
+    def entry_lookup(self, key: Key):
+        return as_cache_entry(self.storage.get(key))
+
+    def stale_lookup(self, key: Key):
+        """ Gets the movies for the key however old they are, as long as they are not older than the max stale age.
+            Used when the 3rd party api is failing
+        """
+        entry = self.entry_lookup(key)
+        if entry is None or entry.age() >= freshness_settings()['MAX_STALE']:
+            return None
+        return entry.movies
+
+    def save_movies(self, key: Key, movies):
+        logger.info("Saving movies for artist '%s' in the cache and the database", key)
+        if isinstance(movies, Movies):
+            movies.build_index()
+            movies.version = movies.content_hash()
+        self.storage.put(key, CacheEntry(movies))
+
+    def negative_lookup(self, key: Key):
+        """ Gets the kind of failure remembered for the key, NOT_FOUND or UPSTREAM_ERROR, or None if there is none """
+        entry = self.storage.get_negative(key)
+        kind = None if entry is None or entry.is_expired() else entry.kind
+        with self.negative_lock:
+            self.negative_counters['lookups'] += 1
+            if kind is not None:
+                self.negative_counters[f'{kind}_hits'] += 1
+        return kind
+
+    def save_negative(self, key: Key, kind):
+        """ Remembers that looking up the key failed, for the time to live configured for the kind of failure """
+        ttl = negative_cache_settings()[kind]
+        logger.info(f"Remembering that looking up artist '{key}' failed ({kind}) for {ttl}s")
+        self.storage.put_negative(key, NegativeEntry(kind, ttl), ttl)
+        with self.negative_lock:
+            self.negative_counters[f'{kind}_stores'] += 1
+
+    def negative_stats(self):
+        """ Gets a snapshot of the negative cache counters along with the hit rate of each kind of failure """
+        with self.negative_lock:
+            stats = dict(self.negative_counters)
+        for kind in (NOT_FOUND, UPSTREAM_ERROR):
+            stats[f'{kind}_hit_rate'] = stats[f'{kind}_hits'] / stats['lookups'] if stats['lookups'] else 0.0
+        return stats
+
+    def invalidate(self, key: Key):
+        logger.info(f"Removing movies for artist '{key}' from the cache")
+        self.storage.delete(key)
+
+    def schedule_refresh(self, key: Key):
+        """ Refreshes the movies for the key in the background, unless a refresh for it is already under way """
+        if self.third_party is None:
+            return
+        with self.refresh_lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+        self.refresh_pool.submit(self._refresh, key)
+
+    def _refresh(self, key: Key):
+        lease_timeout, _ = _single_flight_settings()
         try:
-            return self.storage.get(key)
+            if not self.acquire_lease(key, lease_timeout):
+                return  # another worker process is refreshing it
+            try:
+                latest = as_cache_entry(self.storage.get_latest(key))
+                if latest is None or not latest.is_fresh():  # or another worker process has already refreshed it
+                    self.save_movies(key, self.third_party.api_lookup(key))
+            finally:
+                self.release_lease(key)
         except Exception:
-            raise
+            logger.exception(f"Failed to refresh movies for artist '{key}', serving stale movies meanwhile")
+        finally:
+            with self.refresh_lock:
+                self.refreshing.discard(key)
 
-    def save_movies(self, key: Key, movies):
-        logger.info(f"Saving movies for artist '{key.__str__()}' in the cache and the database")
-        self.storage.put(key, movies)
+    def acquire_lease(self, key: Key, timeout):
+        return self.storage.acquire_lease(key, timeout)
+
+    def release_lease(self, key: Key):
+        self.storage.release_lease(key)
+
+    def lease_held(self, key: Key):
+        return self.storage.lease_held(key)
+
+
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+
+
+def upstream_settings():
+    """ Gets the settings of the 3rd party api client, falling back to defaults for anything not configured """
+    config = {
+        'URL': 'https://itunes.apple.com/search?term={}+{}&entity=movie',
+        'POOL_SIZE': 10,
+        'CONNECT_TIMEOUT': 3.05,
+        'READ_TIMEOUT': 10,
+        'RETRIES': 2,
+        'BACKOFF': 0.1,
+        'BACKOFF_MAX': 2,
+        'HEDGE': False,
+        'HEDGE_MIN_SAMPLES': 20,
+    }
+    config.update(getattr(settings, 'UPSTREAM_HTTP', {}))
+    return config
 
 
 class RequestResponse:
-    """ This class does the actual api request and returns the response to the caller """
-    def __init__(self):
-        self.target_path = "https://itunes.apple.com/search?term={}+{}&entity=movie"
+    """ This class does the actual api request and returns the response to the caller. Connections to the 3rd party
+        api are pooled and kept alive, every request is bounded by timeouts and failed requests are retried
+    """
+    def __init__(self, config=None):
+        config = config or upstream_settings()
+        self.target_path = config['URL']
+        self.timeout = (config['CONNECT_TIMEOUT'], config['READ_TIMEOUT'])
+        self.retries = config['RETRIES']
+        self.backoff = config['BACKOFF']
+        self.backoff_max = config['BACKOFF_MAX']
+        self.hedge = config['HEDGE']
+        self.hedge_min_samples = config['HEDGE_MIN_SAMPLES']
+        self.latencies = deque(maxlen=1000)
+        self.hedge_pool = ThreadPoolExecutor(max_workers=config['POOL_SIZE'] * 2) if self.hedge else None
+        # requests are only handed to the pool while a worker is free, so none waits behind the losers of earlier races
+        self.hedge_slots = threading.BoundedSemaphore(config['POOL_SIZE'] * 2)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config['POOL_SIZE'])
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
 
     def response(self, key: Key):
-        return requests.get(self.target_path.format(key.get_firstname(), key.get_lastname()))
+        url = self.target_path.format(key.get_firstname(), key.get_lastname())
+        hedge_delay = self.hedge_delay()
+        if hedge_delay is None:
+            return self._with_retries(url)
+        return self._hedged(url, hedge_delay)
+
+    def hedge_delay(self):
+        """ Gets how long to wait for a response before sending a hedged request, which is the p95 latency of the
+            recent requests. None is returned if hedging is disabled or there are too few samples to go by
+        """
+        if not self.hedge or len(self.latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))]
+
+    def _hedged(self, url, hedge_delay):
+        """ Races a second request against the first once it is slower than the hedge delay. While every worker of
+            the pool is busy, which is when the 3rd party api is slow, requests are not hedged
+        """
+        first = self._submit(url)
+        if first is None:
+            return self._with_retries(url)
+        done, _ = wait([first], timeout=hedge_delay)
+        if done:
+            return first.result()
+
+        second = self._submit(url)
+        if second is None:
+            return first.result()
+        logger.info(f"No response after {hedge_delay:.3f}s, sending hedged request to {url}")
+        pending = {first, second}
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded:
+                return succeeded[0].result()
+            if not pending:
+                return done.pop().result()  # every request failed, so this raises
+
+    def _submit(self, url):
+        """ Sends a request on the pool, or returns None if no worker is free """
+        if not self.hedge_slots.acquire(blocking=False):
+            return None
+        future = self.hedge_pool.submit(self._with_retries, url)
+        future.add_done_callback(lambda _: self.hedge_slots.release())
+        return future
+
+    def _with_retries(self, url):
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._get(url)
+                if response.status_code not in RETRY_STATUSES or attempt == self.retries:
+                    return response
+                logger.warning(f"Got status {response.status_code} from {url}, attempt {attempt + 1}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning(f"Request to {url} failed on attempt {attempt + 1}: {e}")
+            time.sleep(self._backoff(attempt))
+
+    def _backoff(self, attempt):
+        """ Exponential backoff with full jitter """
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def _get(self, url):
+        start = time.perf_counter()
+        response = self.session.get(url, timeout=self.timeout)
+        self.latencies.append(time.perf_counter() - start)
+        return response
 
 
 class ThirdParty:
     """ This class uses a third party API to lookup the requested information """
 
-    def __init__(self, request_response: RequestResponse):
+    def __init__(self, request_response: RequestResponse, breaker: CircuitBreaker = None, limiter: RateLimiter = None):
+        """
+        :param request_response: Makes the requests
+        :param breaker: Stops calls while the api is failing, None to always call it
+        :param limiter: Limits the rate of calls, None to not limit it
+        """
         self.request_response = request_response
+        self.breaker = breaker
+        self.limiter = limiter
+
+    def api_lookup(self, key: Key, wait=0) -> Movies:
+        """ Looks up the movies of the artist
+            :param key: The artist
+            :param wait: Seconds to wait for the rate limit to allow the call, rather than failing straight away
+        """
+        check_guards(key, self.breaker, self.limiter, wait)
+        try:
+            with stage('upstream'):
+                response = self.request_response.response(key)
+            UPSTREAM_RESPONSES.inc(str(response.status_code))
+            movies = to_movies(key, response.status_code, response.content)
+        except requests.RequestException as e:
+            UPSTREAM_RESPONSES.inc('error')
+            record_outcome(self.breaker, failed=True)
+            logger.error(f"Cannot reach the 3rd party api for {key}: {e}")
+            raise UpstreamError(f"Cannot get movies for {key}") from e
+        except UpstreamError:
+            record_outcome(self.breaker, failed=True)
+            raise
+        except ArtistNotFound:
+            record_outcome(self.breaker, failed=False)
+            raise
+        except Exception as e:  # a response that cannot be read, eg, not json
+            record_outcome(self.breaker, failed=True)
+            logger.error(f"Cannot read the response of the 3rd party api for {key}: {e!r}")
+            raise UpstreamError(f"Cannot get movies for {key}") from e
+        record_outcome(self.breaker, failed=False)
+        return movies
+
+    def stats(self):
+        """ Gets the state of the circuit and the saturation of the rate limit """
+        return {'breaker': self.breaker.stats() if self.breaker else None,
+                'limiter': self.limiter.stats() if self.limiter else None}
+
+
+def get_guards():
+    """ Gets the circuit breaker and the rate limiter, None if RATE_LIMIT is 0, for the calls to the 3rd party api """
+    config = guard_settings()
+    breaker = CircuitBreaker(config['FAILURE_THRESHOLD'], config['RESET_TIMEOUT'], config['HALF_OPEN_CALLS'])
+    limiter = None
+    if config['RATE_LIMIT']:
+        limiter = RateLimiter(cache, config['RATE_LIMIT'], config['RATE_PERIOD'])
+    return breaker, limiter
+
+
+def check_guards(key: Key, breaker, limiter, wait=0):
+    """ Raises UpstreamUnavailable if the circuit is open or the rate limit is reached, after waiting up to wait
+        seconds for it to allow the call
+    """
+    if breaker is not None and not breaker.allow():
+        raise UpstreamUnavailable(f"Circuit to the 3rd party api is open, not looking up {key}")
+    if limiter is not None and not (limiter.acquire(wait) if wait else limiter.try_acquire()):
+        if breaker is not None:
+            breaker.release()
+        logger.warning(f"Rate limit of the 3rd party api is reached, not looking up {key}")
+        raise UpstreamUnavailable(f"Rate limit of the 3rd party api is reached, not looking up {key}")
+
 
-    def api_lookup(self, key: Key) -> Movies:
-        response = self.request_response.response(key)
-        movies = Movies(artist_name=key)
-        if response.ok:
-            api_movies = json.loads(response.content)['results']
+def record_outcome(breaker, failed):
+    if breaker is not None:
+        breaker.record_failure() if failed else breaker.record_success()
+
+
+API_FIELDS = ('trackName', 'releaseDate', 'primaryGenreName')
+
+
+def to_movies(key: Key, status_code: int, content) -> Movies:
+    """ Transforms a response of the 3rd party api to the movies of an artist
+        :param key: The key the lookup was made for
+        :param status_code: The http status of the response
+        :param content: The body of the response
+    """
+    movies = Movies(artist_name=key)
+    if status_code < 400:
+        with stage('parse'):
+            api_movies = load_results(content, API_FIELDS)
             count = len(api_movies)
-            logger.debug(f"Found '{count}' movies for artist: {key}")
-            for api_movie in api_movies:
-                track_name = api_movie['trackName']
-                release_date = api_movie['releaseDate']
-                genre = api_movie['primaryGenreName']
+            logger.debug("Found '%d' movies for artist: %s", count, key)
+            if not count:  # the api answers an unknown artist with no results rather than a 404
+                raise ArtistNotFound(f"Cannot get movies for {key}, the 3rd party api has none")
+            for track_name, release_date, genre in api_movies:
                 movies.add(Movie(track_name=track_name, release_date=release_date, primary_genre_name=genre))
-        else:
-            logger.error(f"Cannot get movies for {key}")
-            raise ValueError(f"Cannot get movies for {key}")
-        return movies
+    elif status_code in RETRY_STATUSES or status_code >= 500:
+        logger.error(f"Cannot get movies for {key}, the 3rd party api failed with status {status_code}")
+        raise UpstreamError(f"Cannot get movies for {key}")
+    else:
+        logger.error(f"Cannot get movies for {key}")
+        raise ArtistNotFound(f"Cannot get movies for {key}")
+    return movies
 
 
 def _filtered(movies, key):
-    if not key.apply_filter():
-        return movies
-    else:
-        filtered_movies = Movies(key)
-        if key.filter_by_genre_only():
-            _filter_by_genre(filtered_movies, key, movies)
+    """ Gets the movies matching the query, or the page of them asked for. Only the movies returned are copied """
+    with stage('filter'):
+        if not key.apply_filter():
+            if not key.apply_paging():
+                return movies
+            rows = movies.rows
+        elif key.filter_by_genre_only():
+            rows = movies.matching(genre=key.get_genre())
         elif key.filter_by_release_date_only():
-            _filter_by_release_date(filtered_movies, key, movies)
+            rows = movies.matching(release_date=key.get_release_date())
         else:
-            _filter_by_genre_and_release_date(filtered_movies, key, movies)
-        return filtered_movies
+            rows = movies.matching(genre=key.get_genre(), release_date=key.get_release_date())
+        if key.apply_paging():
+            rows = rows[key.offset:None if key.limit is None else key.offset + key.limit]
+        return Movies.from_rows(key, rows)
+
+
+def _rendered(movies, key) -> str:
+    """ Gets the body of the response to the query from all the movies of the artist """
+    filtered = _filtered(movies, key)
+    with stage('serialize'):
+        return filtered.details(key.get_fields())
+
+
+class _Call:
+    """ An in-flight call whose outcome is shared by every caller waiting on it """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Collapses concurrent calls for the same key into a single call whose result every caller shares """
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._counters = {'leaders': 0, 'coalesced': 0, 'lease_waits': 0, 'lease_hits': 0}
+
+    def do(self, key, fn):
+        """ Runs fn for the key, unless a call for the same key is already in flight in which case its result is
+            awaited and returned instead
+            :param key: The key identifying the call
+            :param fn: The function to run when this caller is the leader for the key
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self._counters['leaders'] += 1
+            else:
+                self._counters['coalesced'] += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
 
-def _filter_by_genre_and_release_date(filtered_movies, key, movies):
-    # filter by both genre and release date
-    for movie in movies.all_movies():
-        track_name, release_date, genre = _details(movie)
-        if genre.lower() == key.get_genre().lower() and release_date == key.get_release_date():
-            filtered_movies.add(Movie(track_name, release_date, genre))
+    def incr(self, counter):
+        with self._lock:
+            self._counters[counter] += 1
 
+    def stats(self):
+        """ Gets a snapshot of the coalescing counters """
+        with self._lock:
+            return dict(self._counters)
 
-def _filter_by_release_date(filtered_movies, key, movies):
-    for movie in movies.all_movies():
-        track_name, release_date, genre = _details(movie)
-        if release_date == key.get_release_date():
-            filtered_movies.add(Movie(track_name, release_date, genre))
 
+def _single_flight_settings():
+    config = getattr(settings, 'SINGLE_FLIGHT', {})
+    return config.get('LEASE_TIMEOUT', 10), config.get('POLL_INTERVAL', 0.05)
 
-def _filter_by_genre(filtered_movies, key, movies):
-    for movie in movies.all_movies():
-        track_name, release_date, genre = _details(movie)
-        if genre.lower() == key.get_genre().lower():
-            filtered_movies.add(Movie(track_name, release_date, genre))
 
+single_flight = SingleFlight()
 
-def _details(movie):
-    return movie['name'], movie['release date'], movie['genre']
+
+def raise_remembered_failure(key: Key, kind):
+    """ Raises the error of a failed lookup remembered in the negative cache, if there is one """
+    if kind == NOT_FOUND:
+        raise ArtistNotFound(f"Cannot get movies for {key}, remembered from an earlier lookup")
+    if kind == UPSTREAM_ERROR:
+        raise UpstreamError(f"Cannot get movies for {key}, remembered from an earlier lookup")
 
 
 class RequestHandler:
     """ This class handles requests and responses. It is the entry and exit point of the api """
 
-    def __init__(self, storage, third_party):
+    def __init__(self, storage, third_party, coalescer=None):
         self.storage = storage
         self.third_party = third_party
+        self.coalescer = coalescer or single_flight
 
     def get_details(self, key):
         """ This returns the details being looked up for based on the provided key
             :param key: The lookup key
         """
+        movies = self.get_movies(key)
+        if isinstance(movies, HttpResponse):
+            return movies
+        return _filtered(movies, key)
+
+    def get_movies(self, key):
+        """ This returns all the movies of the artist in the key, before any filtering
+            :param key: The lookup key
+        """
         try:
             movies = self.storage.storage_lookup(key)
         except Exception:
-            return HttpResponse("Internal server error", 500)
+            return HttpResponse("Internal server error", status=500)
 
         if movies is None:
-            try:
-                logger.info(f"Looking up details for artist '{key}' from 3rd party api")
-                movies = self.third_party.api_lookup(key)
-                self.storage.save_movies(key, movies)
-            except ValueError:
-                return HttpResponse(f"Resource not found for {key}", 404)
-        else:
-            logger.info(f"Returning details for artist '{key}' from storage")
-        return _filtered(movies, key)
+            return self._get_missing(key)
+        logger.info("Returning details for artist '%s' from storage", key)
+        return movies
+
+    def get_many(self, keys, max_parallelism):
+        """ This returns all the movies of the artists in the keys, keyed by Key.as_key(). The keys are looked up in
+            the storage at once, and the ones it misses are fetched concurrently
+            :param keys: The lookup keys
+            :param max_parallelism: The most keys fetched from the 3rd party api at once
+        """
+        return dict(self.iter_many(keys, max_parallelism))
+
+    def iter_many(self, keys, max_parallelism):
+        """ This yields (Key.as_key(), movies) pairs for the artists in the keys as soon as their movies are available:
+            first the ones found in the storage, then the ones fetched from the 3rd party api as they arrive
+            :param keys: The lookup keys
+            :param max_parallelism: The most keys fetched from the 3rd party api at once
+        """
+        try:
+            found = self.storage.storage_lookup_many(keys)
+        except Exception:
+            logger.exception("Cannot look up artists in storage")
+            for key in {key.as_key() for key in keys}:
+                yield key, HttpResponse("Internal server error", status=500)
+            return
+        yield from found.items()
+
+        missing = {key.as_key(): key for key in keys if key.as_key() not in found}
+        if missing:
+            logger.info("Looking up %d of %d artists from 3rd party api", len(missing), len(keys))
+            with ThreadPoolExecutor(max_workers=min(max_parallelism, len(missing))) as pool:
+                futures = {pool.submit(self._get_missing_in_worker, key): as_key for as_key, key in missing.items()}
+                for future in as_completed(futures):
+                    movies, stages = future.result()
+                    add_stages(stages)
+                    yield futures[future], movies
+
+    def _get_missing_in_worker(self, key):
+        """ Gets the movies for a missed key on a worker of a pool, along with the stages it took. A worker does not
+            see the stages of the request it works for, so they are added to them by the thread handling the request
+        """
+        stages, token = record_stages()
+        try:
+            return self._get_missing(key), stages
+        finally:
+            stop_recording_stages(token)
+
+    def _get_missing(self, key):
+        """ Gets the movies for a key the storage has missed, serving stale movies if the 3rd party api fails """
+        try:
+            return self.coalescer.do(key.as_key(), lambda: self._fetch(key))
+        except ValueError as e:
+            movies = self.storage.stale_lookup(key)
+            if movies is None:
+                if isinstance(e, UpstreamError):
+                    return HttpResponse(f"Service unavailable for {key}", status=503)
+                return HttpResponse(f"Resource not found for {key}", status=404)
+            logger.warning(f"Serving stale movies for artist '{key}', the 3rd party api lookup failed: {e}")
+            return movies
+
+    def _fetch(self, key):
+        """ Fetches the details from the 3rd party api, unless another process holds the lease for the key and
+            stores the details before the lease runs out
+        """
+        raise_remembered_failure(key, self.storage.negative_lookup(key))
+        lease_timeout, poll_interval = _single_flight_settings()
+        leased = self.storage.acquire_lease(key, lease_timeout)
+        if not leased:
+            movies = self._wait_for_lease_holder(key, lease_timeout, poll_interval)
+            if movies is not None:
+                return movies
+        try:
+            logger.info("Looking up details for artist '%s' from 3rd party api", key)
+            movies = self.third_party.api_lookup(key)
+            self.storage.save_movies(key, movies)
+            return movies
+        except ArtistNotFound:
+            self.storage.save_negative(key, NOT_FOUND)
+            raise
+        except UpstreamUnavailable:  # the api was not called, there is no failure of it to share
+            raise
+        except UpstreamError:
+            self.storage.save_negative(key, UPSTREAM_ERROR)
+            raise
+        finally:
+            if leased:
+                self.storage.release_lease(key)
+
+    def _wait_for_lease_holder(self, key, lease_timeout, poll_interval):
+        """ Waits for the worker process holding the lease for the key to release it, and gets the movies or the
+            failure it stored. Returns None if it stored neither or the lease ran out, for the caller to look them up
+        """
+        self.coalescer.incr('lease_waits')
+        deadline = time.monotonic() + lease_timeout
+        while time.monotonic() < deadline:
+            time.sleep(poll_interval)
+            if self.storage.lease_held(key):
+                continue
+            movies = self.storage.storage_lookup(key)
+            if movies is not None:
+                self.coalescer.incr('lease_hits')
+                return movies
+            raise_remembered_failure(key, self.storage.negative_lookup(key))
+            logger.info("Lease for artist '%s' was released with nothing stored, looking it up", key)
+            return None
+        logger.warning(f"Lease for artist '{key}' expired before details were stored, looking them up")
+        return None
 
 
 request_response = RequestResponse()
-third_party = ThirdParty(request_response)
-cache_spi = CacheSpi(in_memory=False)
+third_party = ThirdParty(request_response, *get_guards())
+cache_spi = CacheSpi(in_memory=False, third_party=third_party)
+
 
+def batch_settings():
+    config = {'MAX_SIZE': 50, 'MAX_PARALLELISM': 8}
+    config.update(getattr(settings, 'BATCH', {}))
+    return config
 
-def get_response(key):
+
+def get_response_cache():
+    config = response_cache_settings()
+    if not config['ENABLED']:
+        return ResponseCache(None, config['COMPRESS_MIN_BYTES'])
+    return ResponseCache(LocalCache(config['MAX_ENTRIES'], config['MAX_BYTES'], config['TTL'],
+                                    sizeof=RenderedResponse.size), config['COMPRESS_MIN_BYTES'])
+
+
+response_cache = get_response_cache()
+
+
+def get_response(key, accept_encoding='', request=None):
+    """ This returns the http response for the lookup key
+        :param key: The lookup key
+        :param accept_encoding: The Accept-Encoding header of the request
+        :param request: The request, for its conditional headers. A client that has the current response is answered
+        with a 304 without rendering it
+    """
     try:
         handler = RequestHandler(cache_spi, third_party)
-        return HttpResponse(handler.get_details(key).details())
+        movies = handler.get_movies(key)
+        if isinstance(movies, HttpResponse):
+            return movies  # error responses are passed through as is
+        return _cacheable_response(key, movies, accept_encoding, request)
     except AttributeError:
-        return HttpResponse("Internal server error", 500)
+        return HttpResponse("Internal server error", status=500)
+
+
+def _cacheable_response(key, movies, accept_encoding, request):
+    validators = Validators.of(movies)
+    if validators is None:
+        return response_cache.render(key, movies, lambda: _rendered(movies, key)).as_http_response(accept_encoding)
+    if request is not None:
+        not_modified = validators.not_modified(request)
+        if not_modified is not None:
+            return not_modified
+    rendered = response_cache.render(key, movies, lambda: _rendered(movies, key))
+    return validators.apply(rendered.as_http_response(accept_encoding))
+
+
+def get_batch_response(keys):
+    """ This returns the http response for many lookup keys, holding the result or the error for each in order
+        :param keys: The lookup keys
+    """
+    handler = RequestHandler(cache_spi, third_party)
+    found = handler.get_many(keys, batch_settings()['MAX_PARALLELISM'])
+    return HttpResponse(dumps_bytes({'results': [batch_result(key, found[key.as_key()]) for key in keys]}),
+                        content_type='application/json')
+
+
+NDJSON = 'application/x-ndjson'
+
+
+def get_streaming_response(key):
+    """ This returns the http response for the lookup key as newline delimited json, one movie per line
+        :param key: The lookup key
+    """
+    handler = RequestHandler(cache_spi, third_party)
+    movies = handler.get_movies(key)
+    if isinstance(movies, HttpResponse):
+        return movies  # error responses are passed through as is
+    return streamed_movies(_filtered(movies, key), key.get_fields())
+
+
+def streamed_movies(movies, fields=None):
+    lines = (dumps_bytes(movie) + b'\n' for movie in movies.all_movies(fields))
+    return StreamingHttpResponse(lines, content_type=NDJSON)
+
+
+def get_batch_streaming_response(keys):
+    """ This returns the http response for many lookup keys as newline delimited json, one artist per line. Each line
+        is sent as soon as the movies of the artist are available, so lines come in no particular order and carry the
+        index of the artist in the request
+        :param keys: The lookup keys
+    """
+    handler = RequestHandler(cache_spi, third_party)
+    positions = {}
+    for index, key in enumerate(keys):
+        positions.setdefault(key.as_key(), []).append(index)
+
+    def lines():
+        for as_key, movies in handler.iter_many(keys, batch_settings()['MAX_PARALLELISM']):
+            for index in positions[as_key]:
+                yield dumps_bytes(dict(batch_result(keys[index], movies), index=index)) + b'\n'
+
+    return StreamingHttpResponse(lines(), content_type=NDJSON)
+
+
+def batch_result(key, movies):
+    result = {'artist': str(key), 'genre': key.get_genre(), 'releaseDate': key.get_release_date()}
+    if isinstance(movies, HttpResponse):
+        result.update(status=movies.status_code, error=movies.content.decode())
+    else:
+        result.update(status=200, movies=_filtered(movies, key).all_movies(key.get_fields()))
+    return result
+
+
+def pipeline_stats(pipeline, spi, coalescer):
+    """ Gets a metrics collector reading the counters kept by the cache and the coalescing of lookups of a pipeline
+        :param pipeline: Labels the metrics, sync or async
+        :param spi: The CacheSpi of the pipeline
+        :param coalescer: The SingleFlight of the pipeline
+    """
+    def collect():
+        local = getattr(spi.storage, 'local', None)
+        if isinstance(local, LocalCache):
+            yield from local_cache_stats([({'cache': 'artists', 'pipeline': pipeline}, local.stats())])
+        shared = getattr(spi.storage, 'shared', spi.storage)
+        if hasattr(shared, 'node_stats'):
+            nodes = shared.node_stats()
+            yield ('movies_memcached_nodes', 'gauge', "Memcached nodes keys are sharded over, live and ejected",
+                   [({'state': 'live', 'pipeline': pipeline}, nodes['nodes'] - nodes['ejected']),
+                    ({'state': 'ejected', 'pipeline': pipeline}, nodes['ejected'])])
+            yield ('movies_memcached_node_events_total', 'counter', "Memcached nodes ejected after failing and retried",
+                   [({'event': event, 'pipeline': pipeline}, nodes[event]) for event in ('ejections', 'readmissions')])
+        yield ('movies_negative_cache_events_total', 'counter', "Lookups, hits and stores of remembered failures",
+               [({'event': event, 'pipeline': pipeline}, value) for event, value in spi.negative_stats().items()
+                if not event.endswith('_rate')])
+        yield ('movies_single_flight_events_total', 'counter', "Coalesced lookups and waits on leases of other workers",
+               [({'event': event, 'pipeline': pipeline}, value) for event, value in coalescer.stats().items()])
+    return collect
+
+
+def local_cache_stats(caches_stats):
+    yield ('movies_local_cache_events_total', 'counter', "Hits, misses, evictions and expirations of the local caches",
+           [(dict(labels, event=event), stats[event]) for labels, stats in caches_stats
+            for event in ('hits', 'misses', 'evictions', 'expirations')])
+    yield ('movies_local_cache_entries', 'gauge', "Entries held in the local caches",
+           [(labels, stats['entries']) for labels, stats in caches_stats])
+    yield ('movies_local_cache_bytes', 'gauge', "Estimated bytes held in the local caches",
+           [(labels, stats['bytes']) for labels, stats in caches_stats])
+
+
+def shared_stats():
+    """ Metrics collector reading the counters of the response cache and of the guards around the 3rd party api,
+        which both pipelines share
+    """
+    if response_cache.local_cache is not None:
+        yield from local_cache_stats([({'cache': 'responses', 'pipeline': 'shared'},
+                                       response_cache.local_cache.stats())])
+    if _snapshot is not None:
+        yield ('movies_snapshot_events_total', 'counter', "Artists found and missed in the snapshot, written, deleted "
+                                                          "and failed reads or writes",
+               [({'event': event}, value) for event, value in _snapshot.stats().items() if event != 'queued'])
+        yield ('movies_snapshot_queued', 'gauge', "Artists queued to be written to the snapshot",
+               [({}, _snapshot.stats()['queued'])])
+    guards = third_party.stats()
+    if guards['breaker'] is not None:
+        state = guards['breaker']['state']
+        yield ('movies_upstream_circuit_state', 'gauge', "State of the circuit to the 3rd party api, 1 for the current",
+               [({'state': name}, int(name == state)) for name in ('closed', 'open', 'half_open')])
+        yield ('movies_upstream_circuit_events_total', 'counter', "Times the circuit opened and calls it rejected",
+               [({'event': event}, guards['breaker'][event]) for event in ('opened', 'rejected')])
+    if guards['limiter'] is not None:
+        yield ('movies_upstream_rate_limit_total', 'counter', "Calls to the 3rd party api allowed and throttled",
+               [({'result': result}, guards['limiter'][result]) for result in ('allowed', 'throttled', 'errors')])
+        yield ('movies_upstream_rate_limit_saturation', 'gauge', "Share of the current rate limit period taken",
+               [({}, guards['limiter']['saturation'])])
+
+
+registry.register_collector(pipeline_stats('sync', cache_spi, single_flight))
+registry.register_collector(shared_stats)
@@ -0,0 +1,156 @@
+""" This file contains the guards around calls to the 3rd party api: a rate limiter shared by all worker processes
+    and a circuit breaker
+"""
+import math
+import threading
+import time
+
+from django.conf import settings
+
+import logging
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+def guard_settings():
+    config = {'RATE_LIMIT': 20, 'RATE_PERIOD': 60, 'FAILURE_THRESHOLD': 5, 'RESET_TIMEOUT': 30, 'HALF_OPEN_CALLS': 1}
+    config.update(getattr(settings, 'UPSTREAM_GUARDS', {}))
+    return config
+
+
+class RateLimiter:
+    """ A token bucket holding RATE_LIMIT tokens that is refilled every period, shared by all worker processes
+        through counters in the cache. The django cache api has no compare and swap, so rather than dripping tokens
+        back in continuously the bucket is refilled whole at the start of each period: the tokens taken in a period
+        are counted with an atomic increment of a counter that expires with the period
+    """
+
+    def __init__(self, cache, rate, period, name='itunes'):
+        """
+        :param cache: The django cache holding the counters
+        :param rate: The most calls allowed per period
+        :param period: The length of a period in seconds
+        :param name: Names the counters, so limiters of different apis don't share them
+        """
+        self.cache = cache
+        self.rate = rate
+        self.period = period
+        self.name = name
+        self.lock = threading.Lock()
+        self.counters = {'allowed': 0, 'throttled': 0, 'errors': 0}
+        self.taken = 0  # tokens taken from the bucket of the latest period, by any worker process
+
+    def try_acquire(self) -> bool:
+        """ Takes a token from the bucket, returning False if it is empty """
+        window = int(time.time() // self.period)
+        key = f'ratelimit:{self.name}:{window}'
+        try:
+            self.cache.add(key, 0, math.ceil(self.period) + 1)
+            taken = self.cache.incr(key)
+        except ValueError:  # the counter expired between add and incr
+            taken = 1
+            self.cache.set(key, taken, math.ceil(self.period) + 1)
+        except Exception:
+            logger.warning("Cannot reach the rate limit counter, allowing the call")
+            self._count('errors')
+            return True
+
+        allowed = taken <= self.rate
+        with self.lock:
+            self.taken = taken
+            self.counters['allowed' if allowed else 'throttled'] += 1
+        return allowed
+
+    def acquire(self, timeout) -> bool:
+        """ Takes a token from the bucket, waiting up to timeout seconds for it to be refilled if it is empty """
+        deadline = time.monotonic() + timeout
+        while not self.try_acquire():
+            wait = self.period - time.time() % self.period
+            if time.monotonic() + wait > deadline:
+                return False
+            time.sleep(wait)
+        return True
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        """ Gets the allowed and throttled counts along with how much of the latest bucket is taken """
+        with self.lock:
+            return dict(self.counters, saturation=min(self.taken / self.rate, 1.0) if self.rate else 1.0)
+
+
+class CircuitBreaker:
+    """ Stops calls to a failing api. The circuit opens after a number of consecutive failures, and calls then fail
+        fast until the reset timeout has passed. The circuit is then half open: a few trial calls are let through,
+        and it closes again if they succeed or opens again if any of them fails. Trial calls whose outcome is not
+        recorded within the reset timeout are given up on, and new ones are let through
+    """
+
+    def __init__(self, failure_threshold, reset_timeout, half_open_calls=1):
+        """
+        :param failure_threshold: The consecutive failures that open the circuit
+        :param reset_timeout: The seconds the circuit stays open before trial calls are let through
+        :param half_open_calls: The trial calls let through while the circuit is half open
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_calls = half_open_calls
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self.trial_calls = 0
+        self.trial_at = 0  # monotonic time the last trial call was let through
+        self.counters = {'opened': 0, 'rejected': 0}
+
+    def allow(self) -> bool:
+        """ Returns True if a call may go through """
+        with self.lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                logger.info("Circuit is half open, letting trial calls through")
+                self.state = HALF_OPEN
+                self.trial_calls = 0
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and self.trial_calls and time.monotonic() - self.trial_at >= self.reset_timeout:
+                logger.warning(f"No outcome of {self.trial_calls} trial calls after {self.reset_timeout}s, "
+                               f"letting new ones through")
+                self.trial_calls = 0
+            if self.state == HALF_OPEN and self.trial_calls < self.half_open_calls:
+                self.trial_calls += 1
+                self.trial_at = time.monotonic()
+                return True
+            self.counters['rejected'] += 1
+            return False
+
+    def release(self):
+        """ Gives back a trial call that was allowed but not made """
+        with self.lock:
+            if self.state == HALF_OPEN and self.trial_calls:
+                self.trial_calls -= 1
+
+    def record_success(self):
+        with self.lock:
+            if self.state != CLOSED:
+                logger.info("Circuit is closed")
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                logger.warning(f"Circuit is open after {self.failures} consecutive failures")
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                self.counters['opened'] += 1
+
+    def stats(self):
+        """ Gets the state of the circuit along with how often it opened and how many calls it rejected """
+        with self.lock:
+            return dict(self.counters, state=self.state, failures=self.failures)
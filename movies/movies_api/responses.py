@@ -0,0 +1,137 @@
+""" This file contains the cache of rendered responses, which holds the finished and compressed bodies of responses """
+import gzip
+import time
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .models import Key
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, responses are only offered gzipped without it
+    brotli = None
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def response_cache_settings():
+    config = {'ENABLED': True, 'MAX_ENTRIES': 5000, 'MAX_BYTES': 32 * 1024 * 1024, 'TTL': 3600,
+              'COMPRESS_MIN_BYTES': 512}
+    config.update(getattr(settings, 'RESPONSE_CACHE', {}))
+    return config
+
+
+class RenderedResponse:
+    """ The body of a response along with its compressed variants, keyed by content coding """
+
+    def __init__(self, body: bytes, compress_min_bytes=512):
+        """
+        :param body: The uncompressed body
+        :param compress_min_bytes: Bodies smaller than this are not worth compressing
+        """
+        self.variants = {'identity': body}
+        if len(body) >= compress_min_bytes:
+            self.variants['gzip'] = gzip.compress(body, compresslevel=6)
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(body)
+
+    def size(self):
+        return sum(len(variant) for variant in self.variants.values())
+
+    def as_http_response(self, accept_encoding=''):
+        """ Gets the variant best suited to the Accept-Encoding header of the request as an http response """
+        encoding = negotiate_encoding(accept_encoding, self.variants)
+        response = HttpResponse(self.variants[encoding])
+        if encoding != 'identity':
+            response['Content-Encoding'] = encoding
+        if len(self.variants) > 1:
+            response['Vary'] = 'Accept-Encoding'
+        return response
+
+
+class Validators:
+    """ The cache headers of responses rendered from the cached movies of an artist: the content hash of the movies as
+        ETag, when they were stored as Last-Modified, and for how much longer they are fresh as the max-age that
+        clients and shared caches may keep the response for
+    """
+
+    def __init__(self, version, stored_at=None, fresh_until=None):
+        self.etag = f'W/"{version}"'  # weak, as the gzip and brotli variants share it
+        self.last_modified = None if stored_at is None else int(stored_at)
+        self.fresh_until = fresh_until
+
+    @classmethod
+    def of(cls, movies):
+        """ Gets the validators of the movies, None if they are not cached and so have no version """
+        version = getattr(movies, 'version', None)
+        if version is None:
+            return None
+        return cls(version, getattr(movies, 'stored_at', None), getattr(movies, 'fresh_until', None))
+
+    def not_modified(self, request):
+        """ Gets a 304 response if the client has the current response, as told by its If-None-Match or
+            If-Modified-Since header, None otherwise
+        """
+        response = get_conditional_response(request, etag=self.etag, last_modified=self.last_modified)
+        return None if response is None else self.apply(response)
+
+    def apply(self, response):
+        response['ETag'] = self.etag
+        if self.last_modified is not None:
+            response['Last-Modified'] = http_date(self.last_modified)
+        if self.fresh_until is not None:
+            response['Cache-Control'] = f'public, max-age={max(0, int(self.fresh_until - time.time()))}'
+        return response
+
+
+PREFERRED_ENCODINGS = ('br', 'gzip')
+
+
+def negotiate_encoding(accept_encoding: str, available) -> str:
+    """ Picks the smallest available content coding the client accepts, falling back to no coding """
+    accepted = set()
+    for coding in accept_encoding.lower().split(','):
+        name, _, params = coding.strip().partition(';')
+        if params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            accepted.add(name.strip())
+    for encoding in PREFERRED_ENCODINGS:
+        if encoding in available and (encoding in accepted or '*' in accepted):
+            return encoding
+    return 'identity'
+
+
+class ResponseCache:
+    """ Holds rendered responses keyed by the canonical query: artist, genre, release year, page and fields. Keys also
+        carry the version of the cached artist entry they were rendered from, so responses are dropped along with the
+        entry: once the entry is replaced or removed, responses rendered from it can no longer be looked up and age out
+    """
+
+    def __init__(self, local_cache, compress_min_bytes=512):
+        """
+        :param local_cache: The LocalCache holding the rendered responses, None to not cache them
+        :param compress_min_bytes: Bodies smaller than this are not compressed
+        """
+        self.local_cache = local_cache
+        self.compress_min_bytes = compress_min_bytes
+
+    def render(self, key: Key, movies, render) -> RenderedResponse:
+        """ Gets the rendered response for the query, rendering and caching it if it is not cached
+            :param key: The query
+            :param movies: All the cached movies of the artist
+            :param render: Renders the body of the response
+        """
+        version = getattr(movies, 'version', None)
+        if version is None or self.local_cache is None:  # a response from an uncached entry has nothing to key it
+            return RenderedResponse(render().encode(), self.compress_min_bytes)
+
+        cache_key = (key.as_key(), version, key.get_genre().lower(), key.get_release_date(), key.offset, key.limit,
+                     key.get_fields())
+        rendered = self.local_cache.get(cache_key)
+        if rendered is None:
+            rendered = RenderedResponse(render().encode(), self.compress_min_bytes)
+            self.local_cache.put(cache_key, rendered)
+        return rendered
@@ -0,0 +1,129 @@
+""" This file contains the compact binary encoding of cached artist entries, used for the values held in memcached.
+
+    An encoded entry is a 4 byte header, the magic b'MV', the format version and flags, followed by a body that is
+    zlib compressed when the COMPRESSED flag is set. The body holds the timestamps of the entry and the counts of
+    movies, genres and release years, then the movies in columns: the genre and the release year of every movie as
+    indexes into the distinct genres and release years, and the distinct release years as a packed int array. Last
+    come the titles, the distinct genres, the artist and the content hash as one UTF-8 string, separated by NUL so that
+    decoding splits them in a single call. When any of them holds a NUL itself the LENGTHS flag is set, and the string
+    is rather preceded by a packed array of their lengths.
+"""
+import struct
+import sys
+import zlib
+from array import array
+from itertools import accumulate
+
+from django.conf import settings
+
+from .models import Movies, pick, shared_release_years
+
+import logging
+logger = logging.getLogger(__name__)
+
+MAGIC = b'MV'
+FORMAT_VERSION = 2
+COMPRESSED = 0x01
+LENGTHS = 0x02
+SEPARATOR = '\x00'
+
+_HEADER = struct.Struct('<2sBB')
+_FIXED = struct.Struct('<dddIHH')
+
+
+def serialization_settings():
+    config = {'COMPRESS_MIN_BYTES': 1024, 'COMPRESS_LEVEL': 6}
+    config.update(getattr(settings, 'CACHE_SERIALIZATION', {}))
+    return config
+
+
+def is_encoded(value) -> bool:
+    return isinstance(value, bytes) and value[:2] == MAGIC
+
+
+def encode_entry(entry, compress_min_bytes=None, compress_level=None) -> bytes:
+    """ Encodes a cache entry of movies to bytes
+        :param entry: The CacheEntry to encode. Its movies need to be a Movies object
+        :param compress_min_bytes: Bodies at least this big are compressed
+        :param compress_level: The zlib compression level
+    """
+    config = serialization_settings()
+    compress_min_bytes = config['COMPRESS_MIN_BYTES'] if compress_min_bytes is None else compress_min_bytes
+    compress_level = config['COMPRESS_LEVEL'] if compress_level is None else compress_level
+    movies = entry.movies
+    rows = movies.rows
+
+    titles, release_dates, row_genres = zip(*rows) if rows else ((), (), ())
+    genres = {}
+    genre_ids = array('H', [genres.setdefault(genre, len(genres)) for genre in row_genres])
+    years = {}
+    year_ids = array('H', [years.setdefault(release_date, len(years)) for release_date in release_dates])
+    columns = [genre_ids, year_ids, array('i', years)]
+
+    names = [*titles, *genres, movies.key, movies.version or '']
+    all_names = SEPARATOR.join(names)
+    flags = 0
+    if all_names.count(SEPARATOR) > len(names) - 1:
+        flags |= LENGTHS
+        all_names = ''.join(names)
+        columns.append(array('I', [len(name) for name in names]))
+
+    parts = [_FIXED.pack(entry.stored_at, entry.soft_expiry, entry.hard_expiry, len(rows), len(genres), len(years))]
+    parts.extend(_little_endian(column) for column in columns)
+    parts.append(all_names.encode('utf-8'))
+    body = b''.join(parts)
+
+    if len(body) >= compress_min_bytes:
+        body = zlib.compress(body, compress_level)
+        flags |= COMPRESSED
+    return _HEADER.pack(MAGIC, FORMAT_VERSION, flags) + body
+
+
+def decode_entry(data: bytes):
+    """ Decodes bytes made by encode_entry back to the movies and the stored at, soft expiry and hard expiry
+        timestamps of the entry, or returns None if they are of an unknown format
+    """
+    magic, version, flags = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        logger.warning(f"Cannot decode cached entry of format version {version}, ignoring it")
+        return None
+    body = memoryview(data)[_HEADER.size:]
+    if flags & COMPRESSED:
+        body = memoryview(zlib.decompress(body))
+
+    stored_at, soft_expiry, hard_expiry, count, genre_count, year_count = _FIXED.unpack_from(body)
+    genre_ids, offset = _read_array('H', body, _FIXED.size, count)
+    year_ids, offset = _read_array('H', body, offset, count)
+    years, offset = _read_array('i', body, offset, year_count)
+    if flags & LENGTHS:
+        lengths, offset = _read_array('I', body, offset, count + genre_count + 2)
+        all_names = str(body[offset:], 'utf-8')
+        ends = list(accumulate(lengths))
+        names = list(map(all_names.__getitem__, map(slice, [0] + ends, ends)))
+    else:
+        names = str(body[offset:], 'utf-8').split(SEPARATOR)
+    artist, content_hash = names[-2:]
+    genres = [sys.intern(genre) for genre in names[count:-2]]
+    del names[count:]
+
+    # the rows movie_row would make, built column by column rather than a movie at a time
+    rows = zip(names, pick(shared_release_years(years.tolist()), year_ids), pick(genres, genre_ids))
+    movies = Movies.from_rows(artist, rows)  # the artist is stored canonical already
+    movies.version = content_hash or None
+    return movies, stored_at, soft_expiry, hard_expiry
+
+
+def _little_endian(column: array) -> bytes:
+    if sys.byteorder == 'big':
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _read_array(typecode, body, offset, count):
+    column = array(typecode)
+    end = offset + column.itemsize * count
+    column.frombytes(body[offset:end])
+    if sys.byteorder == 'big':
+        column.byteswap()
+    return column, end
@@ -0,0 +1,124 @@
+""" This file contains the snapshot of the cached artists kept in the database, so that a worker restarted or a
+    memcached flushed does not leave the service cold.
+
+    Every artist stored in the cache is queued for the snapshot and written out by a background thread, in batches
+    every INTERVAL seconds, so requests never wait on the database. An artist stored again before its batch is written
+    is written once, as last stored. Nothing is loaded at startup: an artist missing from memcached is looked up in the
+    snapshot when it is requested, see movie_requests.SnapshotStorage. Entries keep when they were stored, so they go
+    stale as they would have in memcached, and entries older than MAX_STALE are neither served nor kept.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import transaction
+
+from .models import ArtistSnapshot
+from .serialization import encode_entry
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+def snapshot_settings():
+    config = {'ENABLED': False, 'INTERVAL': 1.0, 'MAX_BATCH': 500}
+    config.update(getattr(settings, 'SNAPSHOT', {}))
+    return config
+
+
+class Snapshot:
+    """ Reads the snapshot of the cached artists and queues writes to it for a background thread """
+
+    def __init__(self, max_age, interval=1.0, max_batch=500):
+        """
+        :param max_age: The seconds after they were stored beyond which entries are neither served nor kept
+        :param interval: The seconds between writes of the queued entries
+        :param max_batch: The most entries written in a transaction. A batch is written early once this many are
+                          queued
+        """
+        self.max_age = max_age
+        self.interval = interval
+        self.max_batch = max_batch
+        self.lock = threading.Lock()  # guards the queued entries
+        self.write_lock = threading.Lock()  # batches are written one at a time, in the order they were queued
+        self.queued = {}  # key -> the cache entry to write, or None to delete it
+        self.wakeup = threading.Event()
+        self.writer = None
+        self.counters = {'hits': 0, 'misses': 0, 'writes': 0, 'deletes': 0, 'errors': 0}
+
+    def get(self, key):
+        """ Gets the encoded entry for the key, or None """
+        return self.get_many([key]).get(key)
+
+    def get_many(self, keys):
+        """ Gets the encoded entries found for the keys, keyed by key """
+        try:
+            rows = ArtistSnapshot.objects.filter(key__in=keys, stored_at__gt=time.time() - self.max_age) \
+                .values_list('key', 'entry')
+            found = {key: bytes(entry) for key, entry in rows}
+        except DatabaseError as e:
+            logger.warning("Cannot read artists from the snapshot: %r", e)
+            self._count('errors')
+            return {}
+        with self.lock:
+            self.counters['hits'] += len(found)
+            self.counters['misses'] += len(keys) - len(found)
+        return found
+
+    def save(self, key, entry):
+        """ Queues the cache entry for the key to be written. Its movies need to be a Movies object """
+        self._queue(key, entry)
+
+    def delete(self, key):
+        self._queue(key, None)
+
+    def _queue(self, key, entry):
+        with self.lock:
+            self.queued[key] = entry
+            if self.writer is None:
+                self.writer = threading.Thread(target=self._write_periodically, name='snapshot-writer', daemon=True)
+                self.writer.start()
+            full = len(self.queued) >= self.max_batch
+        if full:
+            self.wakeup.set()
+
+    def _write_periodically(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """ Writes out the entries queued so far, waiting for a batch being written to finish first """
+        with self.write_lock:
+            with self.lock:
+                queued, self.queued = self.queued, {}
+            items = list(queued.items())
+            for start in range(0, len(items), self.max_batch):
+                batch = items[start:start + self.max_batch]
+                try:
+                    self._write(batch)
+                except Exception:
+                    logger.exception("Cannot write %d artists to the snapshot", len(batch))
+                    self._count('errors')
+
+    def _write(self, batch):
+        rows = [ArtistSnapshot(key=key, entry=encode_entry(entry), stored_at=entry.stored_at)
+                for key, entry in batch if entry is not None]
+        with transaction.atomic():
+            ArtistSnapshot.objects.filter(key__in=[key for key, _ in batch]).delete()
+            ArtistSnapshot.objects.filter(stored_at__lte=time.time() - self.max_age).delete()
+            ArtistSnapshot.objects.bulk_create(rows)
+        with self.lock:
+            self.counters['writes'] += len(rows)
+            self.counters['deletes'] += len(batch) - len(rows)
+
+    def _count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        """ Gets the counters along with the number of entries queued """
+        with self.lock:
+            return dict(self.counters, queued=len(self.queued))
@@ -0,0 +1 @@
+""" Local stand-ins for iTunes and memcached, used by the tests and the benchmarks """
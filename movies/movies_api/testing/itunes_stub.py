@@ -0,0 +1,113 @@
+""" A stub of the iTunes search api, for benchmarks and tests that must not depend on iTunes. It answers
+    /search?term=firstname+lastname&entity=movie with made up movies, the same ones for the same term every time.
+
+    The latency, the share of requests failing with a 503, the number of movies per artist and the share of artists
+    that are unknown are configurable. Run it on its own with:
+    python -m movies_api.testing.itunes_stub --port 8001 --latency 0.05 --error-rate 0.01 --results 50
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+
+GENRES = ['Comedy', 'Drama', 'Thriller', 'Action & Adventure', 'Kids & Family', 'Romance', 'Horror', 'Documentary']
+WORDS = ['the', 'secret', 'life', 'of', 'pets', 'central', 'intelligence', 'jumanji', 'next', 'level', 'ride', 'along']
+
+
+class ITunesStub(ThreadingHTTPServer):
+    """ The stub server. Its address is known once it is created, port 0 picks a free one """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0, results=50,
+                 not_found_rate=0.0, seed=0):
+        """
+        :param latency: Seconds each response is delayed by
+        :param jitter: Up to this many seconds are added to the latency at random
+        :param error_rate: Share of requests answered with a 503
+        :param results: Movies per artist
+        :param not_found_rate: Share of artists with no movies, answered with no results as iTunes does
+        :param seed: Seeds the made up movies and the failures
+        """
+        super().__init__((host, port), _Handler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.results = results
+        self.not_found_rate = not_found_rate
+        self.seed = seed
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    @property
+    def url(self):
+        """ The url of the search api in the form of the URL of UPSTREAM_HTTP """
+        return f'http://{self.server_address[0]}:{self.server_address[1]}/search?term={{}}+{{}}&entity=movie'
+
+    def start(self):
+        """ Serves in a background thread, returning the server """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def answer(self, term):
+        """ Gets the status and the body of the response for the search term """
+        with self.lock:
+            self.requests += 1
+            delay = self.latency + self.random.uniform(0, self.jitter)
+            failed = self.random.random() < self.error_rate
+        time.sleep(delay)
+        if failed:
+            return 503, b''
+        rng = random.Random(zlib.crc32(term.encode()) ^ self.seed)
+        found = rng.random() >= self.not_found_rate
+        movies = [{'trackName': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 5))).title(),
+                   'releaseDate': f'{rng.randint(1990, 2021)}-07-03T07:00:00Z',
+                   'primaryGenreName': rng.choice(GENRES)} for _ in range(self.results if found else 0)]
+        return 200, json.dumps({'resultCount': len(movies), 'results': movies}).encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        term = parse_qs(url.query).get('term', [''])[0]
+        status, body = self.server.answer(term) if url.path == '/search' else (404, b'')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/javascript; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a stub of the iTunes search api")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8001)
+    parser.add_argument('--latency', type=float, default=0.05, help="Seconds each response is delayed by")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Up to this many seconds added to the latency")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of requests answered with a 503")
+    parser.add_argument('--not-found-rate', type=float, default=0.0, help="Share of artists answered with no results")
+    parser.add_argument('--results', type=int, default=50, help="Movies per artist")
+    args = parser.parse_args()
+    server = ITunesStub(args.host, args.port, args.latency, args.jitter, args.error_rate, args.results,
+                        args.not_found_rate)
+    print(f"iTunes stub serving {server.url}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
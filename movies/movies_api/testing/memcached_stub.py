@@ -0,0 +1,207 @@
+""" A stand-in for memcached speaking its text protocol, for benchmarks and tests on machines without memcached.
+    It keeps the entries in a dict and supports the commands the service uses: get, gets, set, add, replace, cas,
+    delete, incr, decr, touch, flush_all and version, with expiry times and noreply. There is no eviction.
+
+    Run it on its own with: python -m movies_api.testing.memcached_stub --port 11211
+"""
+import argparse
+import socket
+import socketserver
+import threading
+import time
+
+MAX_RELATIVE_EXPIRY = 60 * 60 * 24 * 30  # larger expiry times are unix timestamps
+
+
+class MemcachedStub(socketserver.ThreadingTCPServer):
+    """ The stand-in server. Its address is known once it is created, port 0 picks a free one """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__((host, port), _Handler)
+        self.lock = threading.Lock()
+        self.entries = {}  # key -> (flags, value, expires at or None, cas unique)
+        self.next_cas = 1
+        self.commands = 0
+        self.connections = set()
+
+    @property
+    def location(self):
+        return f'{self.server_address[0]}:{self.server_address[1]}'
+
+    def start(self):
+        """ Serves in a background thread, returning the server """
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        """ Stops serving and drops the open connections, as memcached going down would """
+        self.shutdown()
+        self.server_close()
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def live(self, key):
+        """ Gets the entry for the key unless it expired. Callers hold the lock """
+        entry = self.entries.get(key)
+        if entry is not None and entry[2] is not None and entry[2] <= time.time():
+            del self.entries[key]
+            return None
+        return entry
+
+    def store(self, key, flags, value, expiry):
+        """ Stores an entry. Callers hold the lock """
+        self.entries[key] = (flags, value, expires_at(expiry), self.next_cas)
+        self.next_cas += 1
+
+
+def expires_at(expiry):
+    if expiry == 0:
+        return None
+    if expiry < 0:
+        return 0
+    return expiry if expiry > MAX_RELATIVE_EXPIRY else time.time() + expiry
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections.add(self.connection)
+
+    def finish(self):
+        with self.server.lock:
+            self.server.connections.discard(self.connection)
+        super().finish()
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                continue
+            command, args = parts[0].decode(), parts[1:]
+            noreply = bool(args) and args[-1] == b'noreply'
+            if noreply:
+                args = args[:-1]
+            self.server.commands += 1
+            handler = getattr(self, f'do_{command}', None)
+            if handler is None:
+                self.wfile.write(b'ERROR\r\n')
+                continue
+            if command == 'quit':
+                return
+            reply = handler(args)
+            if reply and not noreply:
+                self.wfile.write(reply)
+
+    def do_get(self, keys, with_cas=False):
+        server = self.server
+        parts = []
+        with server.lock:
+            for key in keys:
+                entry = server.live(key)
+                if entry is None:
+                    continue
+                flags, value, _, cas = entry
+                header = b'VALUE %s %d %d %d\r\n' % (key, flags, len(value), cas) if with_cas else \
+                    b'VALUE %s %d %d\r\n' % (key, flags, len(value))
+                parts.extend((header, value, b'\r\n'))
+        parts.append(b'END\r\n')
+        return b''.join(parts)
+
+    def do_gets(self, keys):
+        return self.do_get(keys, with_cas=True)
+
+    def _read_value(self, length):
+        return self.rfile.read(length + 2)[:-2]
+
+    def do_set(self, args, mode='set'):
+        key, flags, expiry, length = args[0], int(args[1]), int(args[2]), int(args[3])
+        value = self._read_value(length)
+        server = self.server
+        with server.lock:
+            entry = server.live(key)
+            if mode == 'add' and entry is not None or mode == 'replace' and entry is None:
+                return b'NOT_STORED\r\n'
+            if mode == 'cas':
+                if entry is None:
+                    return b'NOT_FOUND\r\n'
+                if entry[3] != int(args[4]):
+                    return b'EXISTS\r\n'
+            server.store(key, flags, value, expiry)
+        return b'STORED\r\n'
+
+    def do_add(self, args):
+        return self.do_set(args, mode='add')
+
+    def do_replace(self, args):
+        return self.do_set(args, mode='replace')
+
+    def do_cas(self, args):
+        return self.do_set(args, mode='cas')
+
+    def do_delete(self, args):
+        with self.server.lock:
+            found = self.server.live(args[0]) is not None
+            self.server.entries.pop(args[0], None)
+        return b'DELETED\r\n' if found else b'NOT_FOUND\r\n'
+
+    def do_incr(self, args, sign=1):
+        key, delta = args[0], int(args[1])
+        server = self.server
+        with server.lock:
+            entry = server.live(key)
+            if entry is None:
+                return b'NOT_FOUND\r\n'
+            flags, value, expires, _ = entry
+            number = max(int(value) + sign * delta, 0) % 2 ** 64
+            server.entries[key] = (flags, str(number).encode(), expires, server.next_cas)
+            server.next_cas += 1
+        return b'%d\r\n' % number
+
+    def do_decr(self, args):
+        return self.do_incr(args, sign=-1)
+
+    def do_touch(self, args):
+        server = self.server
+        with server.lock:
+            entry = server.live(args[0])
+            if entry is None:
+                return b'NOT_FOUND\r\n'
+            server.entries[args[0]] = entry[:2] + (expires_at(int(args[1])),) + entry[3:]
+        return b'TOUCHED\r\n'
+
+    def do_flush_all(self, args):
+        with self.server.lock:
+            self.server.entries.clear()
+        return b'OK\r\n'
+
+    def do_version(self, args):
+        return b'VERSION 1.6.0-stub\r\n'
+
+    def do_quit(self, args):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a stand-in for memcached")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=11211)
+    args = parser.parse_args()
+    server = MemcachedStub(args.host, args.port)
+    print(f"memcached stand-in listening on {server.location}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,50 @@
+import asyncio
+import gc
+import gzip
+import io
 import json
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.http import HttpResponse
 from django.test import TestCase
+from django.test import TransactionTestCase
+from django.utils.http import parse_http_date
+from django.test import override_settings
+from django.core.cache.backends.locmem import LocMemCache
 from unittest import mock
+from unittest import skipIf
 
 
 from .movie_requests import *
-from .models import Key, Movies, Movie
+from .movie_requests import _filtered
+from .async_movie_requests import *
+from .responses import *
+from .serialization import *
+from .resilience import *
+from . import json_codec
+from .metrics import Registry
+from .metrics import CACHE_LOOKUPS
+from .metrics import STAGE_SECONDS
+from .metrics import stage
+from .log import LOG_RECORDS_DROPPED
+from .log import QueuedHandler
+from .log import SamplingFilter
+from .memcached import NodeRing
+from .snapshot import Snapshot
+from .middleware import ServerTimingMiddleware
+from .models import ArtistSnapshot, Key, Movies, Movie
+from movies import settings_api
+from .testing.itunes_stub import ITunesStub
+from .testing.memcached_stub import MemcachedStub
 
 kevin_key = Key('kevin', 'hart')
 test_movies = [
@@ -24,6 +64,42 @@ class KeyTests(TestCase):
         key_2 = Key('brad', 'pitt')
         self.assertNotEqual(kevin_key, key_2, "Keys with different firstname and lastname need to be unequal")
 
+    def test_keys_with_spelling_variants_of_same_name_are_equal(self):
+        for firstname, lastname in [('Kevin', 'Hart'), ('KEVIN', 'hart'), (' kevin ', 'hart  '), ('Ｋevin', 'Härt')]:
+            key_2 = Key(firstname, lastname)
+            self.assertEqual(kevin_key, key_2, f"Key for '{firstname} {lastname}' needs to equal 'kevin hart'")
+            self.assertEqual(hash(kevin_key), hash(key_2))
+            self.assertEqual(kevin_key.as_key(), key_2.as_key())
+
+    def test_keys_keep_the_marks_of_other_scripts_than_latin(self):
+        self.assertNotEqual(Key('ガッキー', '新垣'), Key('カッキー', '新垣'))
+        self.assertNotEqual(Key('हिन्दी', 'kumar'), Key('हिनदी', 'kumar'))
+        self.assertEqual(Key('ｶﾞｯｷｰ', '新垣'), Key('ガッキー', '新垣'))
+        self.assertEqual('ガッキー 新垣', str(Key('ガッキー', '新垣')))
+
+    def test_keys_with_different_filters_are_not_equal(self):
+        self.assertNotEqual(Key('kevin', 'hart', genre='comedy'), Key('kevin', 'hart', genre='drama'))
+        self.assertNotEqual(Key('kevin', 'hart', release_date=2013), kevin_key)
+        self.assertEqual(Key('kevin', 'hart', genre='comedy'), Key('kevin', 'hart', genre='comedy'))
+
+    def test_keys_are_valid_memcached_keys(self):
+        key = Key('Samuel  L.', 'Jackson')
+
+        self.assertEqual('samuel+l._jackson', key.as_key())
+        self.assertEqual('samuel l. jackson', str(key))
+
+    def test_keys_of_names_holding_key_characters_do_not_collide(self):
+        self.assertNotEqual(Key('a+b', 'c').as_key(), Key('a b', 'c').as_key())
+        self.assertNotEqual(Key('a_b', 'c').as_key(), Key('a', 'b_c').as_key())
+        self.assertNotEqual(Key('a%2Bb', 'c').as_key(), Key('a+b', 'c').as_key())
+        self.assertEqual('a%2Bb_c', Key('a+b', 'c').as_key())
+
+    def test_storage_is_shared_by_spelling_variants(self):
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, 'movies')
+
+        self.assertEqual('movies', in_mem_cache.storage_lookup(Key('Kevin ', 'HART')))
+
 
 class RequestHandlerTests(TestCase):
 
@@ -121,52 +197,1932 @@ class RequestHandlerTests(TestCase):
         self.assertTrue(details.all_movies()[0]['name'] == 'title_1')
 
 
-class MockResponse:
-    def __init__(self, json_data, status_code):
-        self.json_data = json_data
-        self.status_code = status_code
-        self.ok = status_code < 400
-        self.content = json_data
+class SingleFlightTests(TestCase):
 
+    def __init__(self, *args, **kwargs):
+        super(SingleFlightTests, self).__init__(*args, **kwargs)
+        self.movies = Movies(artist_name=kevin_key)
 
-class ThirdPartyTests(TestCase):
+        for test_movie in test_movies:
+            self.movies.add(test_movie)
 
-    @mock.patch('movies_api.movie_requests.RequestResponse')
-    def test_returns_results_when_request_ok(self, request_response):
+    def test_concurrent_misses_for_same_key_make_one_upstream_call(self):
         # given
-        request_response.response.return_value = MockResponse(json.dumps({"results": [
-            {"trackName": "title_1", "releaseDate": 2020, "primaryGenreName": 'Drama'}
-        ]}), 200)
+        release = threading.Event()
+        third_party = mock.Mock()
+        third_party.api_lookup.side_effect = lambda key: release.wait(5) and self.movies
+        coalescer = SingleFlight()
+        in_mem_cache = CacheSpi(in_memory=True)
+        results = []
+
+        def request():
+            handler = RequestHandler(in_mem_cache, third_party, coalescer)
+            results.append(handler.get_details(kevin_key))
 
         # when
-        third_party = ThirdParty(request_response)
+        threads = [threading.Thread(target=request) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        while coalescer.stats()['coalesced'] < 4:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
 
         # then
-        self.assertIsNotNone(third_party.api_lookup(kevin_key))
+        third_party.api_lookup.assert_called_once_with(kevin_key)
+        self.assertEqual([self.movies] * 5, results)
+        self.assertEqual(1, coalescer.stats()['leaders'])
 
-    @mock.patch('movies_api.movie_requests.RequestResponse')
-    def test_throws_value_error_if_response_not_ok(self, request_response):
+    def test_should_return_not_found_when_coalesced_lookup_fails(self):
         # given
-        request_response.response.return_value = MockResponse({}, 400)
+        third_party = mock.Mock()
+        third_party.api_lookup.side_effect = ValueError('not found')
+        handler = RequestHandler(CacheSpi(in_memory=True), third_party, SingleFlight())
 
         # when
-        third_party = ThirdParty(request_response)
+        response = handler.get_details(kevin_key)
 
         # then
-        self.assertRaises(ValueError, third_party.api_lookup, kevin_key)
+        self.assertEqual(404, response.status_code)
 
+    def test_should_use_details_stored_by_lease_holder(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.acquire_lease(kevin_key, 10)  # held by another worker process
+        third_party = mock.Mock()
+        coalescer = SingleFlight()
+        handler = RequestHandler(in_mem_cache, third_party, coalescer)
 
-class MoviesTests(TestCase):
+        def store_and_release():
+            in_mem_cache.save_movies(kevin_key, self.movies)
+            in_mem_cache.release_lease(kevin_key)
 
-    def test_should_add_movies(self):
-        movies = Movies(artist_name=kevin_key)
-        test_movies = [
-            Movie('title_1', '2013-07-03T07:00:00Z', 'Comedy'),
-            Movie('title_2', '2017-07-03T07:00:00Z', 'Drama'),
-            Movie('title_3', '2020-07-03T07:00:00Z', 'Thriller')
-        ]
+        threading.Timer(0.1, store_and_release).start()
+
+        # when
+        details = handler.get_details(kevin_key)
+
+        # then
+        third_party.api_lookup.assert_not_called()
+        self.assertEqual(self.movies, details)
+        self.assertEqual(1, coalescer.stats()['lease_hits'])
+
+    def test_stops_waiting_once_lease_is_released_with_nothing_stored(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.acquire_lease(kevin_key, 10)  # held by another worker process, whose lookup fails
+        third_party = mock.Mock()
+        third_party.api_lookup.return_value = self.movies
+        handler = RequestHandler(in_mem_cache, third_party, SingleFlight())
+        threading.Timer(0.1, in_mem_cache.release_lease, (kevin_key,)).start()
+
+        # when
+        started = time.monotonic()
+        details = handler.get_details(kevin_key)
+
+        # then
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(self.movies, details)
+        third_party.api_lookup.assert_called_once_with(kevin_key)
+
+
+class StaleWhileRevalidateTests(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(StaleWhileRevalidateTests, self).__init__(*args, **kwargs)
+        self.movies = Movies(artist_name=kevin_key)
+
+        for test_movie in test_movies:
+            self.movies.add(test_movie)
+
+        self.refreshed_movies = Movies(artist_name=kevin_key)
+        self.refreshed_movies.add(test_movies[0])
+
+    def cache_with_entry_aged(self, age, third_party):
+        in_mem_cache = CacheSpi(in_memory=True, third_party=third_party)
+        in_mem_cache.storage.put(kevin_key, CacheEntry(self.movies, stored_at=time.time() - age))
+        return in_mem_cache
+
+    def test_serves_stale_movies_and_refreshes_them_once_in_background(self):
+        # given
+        lookups_done = threading.Event()
+        third_party = mock.Mock()
+        third_party.api_lookup.side_effect = lambda key: lookups_done.wait(5) and self.refreshed_movies
+        in_mem_cache = self.cache_with_entry_aged(freshness_settings()['SOFT_TTL'] + 1, third_party)
+
+        # when
+        details = [in_mem_cache.storage_lookup(kevin_key) for _ in range(3)]
+        lookups_done.set()
+        in_mem_cache.refresh_pool.shutdown(wait=True)
+
+        # then
+        self.assertEqual([self.movies] * 3, details)
+        third_party.api_lookup.assert_called_once_with(kevin_key)
+        self.assertEqual(self.refreshed_movies, in_mem_cache.storage_lookup(kevin_key))
+
+    def test_blocks_on_upstream_when_past_hard_expiry(self):
+        # given
+        third_party = mock.Mock()
+        third_party.api_lookup.return_value = self.refreshed_movies
+        in_mem_cache = self.cache_with_entry_aged(freshness_settings()['HARD_TTL'] + 1, third_party)
+        handler = RequestHandler(in_mem_cache, third_party, SingleFlight())
+
+        # when
+        details = handler.get_details(kevin_key)
+
+        # then
+        self.assertEqual(self.refreshed_movies, details)
+
+    def test_serves_stale_movies_while_upstream_is_failing(self):
+        # given
+        third_party = mock.Mock()
+        third_party.api_lookup.side_effect = UpstreamError('iTunes is down')
+        in_mem_cache = self.cache_with_entry_aged(freshness_settings()['HARD_TTL'] + 1, third_party)
+        handler = RequestHandler(in_mem_cache, third_party, SingleFlight())
+
+        # when
+        details = handler.get_details(kevin_key)
+
+        # then
+        self.assertEqual(self.movies, details)
+
+    def test_does_not_serve_movies_past_max_stale_age(self):
+        # given
+        third_party = mock.Mock()
+        third_party.api_lookup.side_effect = ValueError('Cannot get movies')
+        in_mem_cache = self.cache_with_entry_aged(freshness_settings()['MAX_STALE'] + 1, third_party)
+        handler = RequestHandler(in_mem_cache, third_party, SingleFlight())
+
+        # when
+        response = handler.get_details(kevin_key)
+
+        # then
+        self.assertEqual(404, response.status_code)
+
+
+class LocalCacheTests(TestCase):
 
+    def test_evicts_least_recently_used_entries_beyond_max_entries(self):
+        # given
+        local = LocalCache(max_entries=2, max_bytes=1000, ttl=60, sizeof=len)
+        local.put('a', 'a')
+        local.put('b', 'b')
+        local.get('a')
+
+        # when
+        local.put('c', 'c')
+
+        # then
+        self.assertIsNone(local.get('b'))
+        self.assertEqual('a', local.get('a'))
+        self.assertEqual(1, local.stats()['evictions'])
+
+    def test_evicts_entries_beyond_memory_budget(self):
+        # given
+        local = LocalCache(max_entries=10, max_bytes=10, ttl=60, sizeof=len)
+        local.put('a', 'x' * 6)
+
+        # when
+        local.put('b', 'x' * 6)
+
+        # then
+        self.assertIsNone(local.get('a'))
+        self.assertEqual(6, local.stats()['bytes'])
+
+    def test_estimates_entries_of_movies_without_pickling_them(self):
+        # given
+        movies = Movies(artist_name=kevin_key)
         for test_movie in test_movies:
             movies.add(test_movie)
+        local = LocalCache(max_entries=10, max_bytes=100000, ttl=60)
 
-        self.assertTrue(len(movies.all_movies()) == 3)
+        # when
+        with mock.patch('movies_api.movie_requests.pickle.dumps') as dumps:
+            local.put('kevin_hart', CacheEntry(movies))
+
+        # then
+        dumps.assert_not_called()
+        self.assertEqual(ENTRY_BYTES + 3 * MOVIE_BYTES, local.stats()['bytes'])
+
+    def test_does_not_serve_expired_entries(self):
+        # given
+        local = LocalCache(max_entries=10, max_bytes=1000, ttl=0, sizeof=len)
+        local.put('a', 'a')
+
+        # then
+        self.assertIsNone(local.get('a'))
+        self.assertEqual(1, local.stats()['expirations'])
+
+    def test_two_tier_storage_serves_shared_entries_locally_and_invalidates_both(self):
+        # given
+        shared = InMemoryStorage()
+        shared.put(kevin_key, 'movies')
+        storage = TwoTierStorage(LocalCache(max_entries=10, max_bytes=1000, ttl=60, sizeof=len), shared)
+        storage.get(kevin_key)
+        shared.storage.clear()
+
+        # when
+        from_local = storage.get(kevin_key)
+        storage.delete(kevin_key)
+
+        # then
+        self.assertEqual('movies', from_local)
+        self.assertIsNone(storage.get(kevin_key))
+        self.assertEqual(1, storage.local.stats()['hits'])
+
+
+class ResponseCacheTests(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(ResponseCacheTests, self).__init__(*args, **kwargs)
+        self.movies = Movies(artist_name=kevin_key)
+
+        for test_movie in test_movies * 10:
+            self.movies.add(test_movie)
+        self.movies.version = self.movies.content_hash()
+
+    def test_renders_each_query_once_per_entry_version(self):
+        # given
+        response_cache = ResponseCache(LocalCache(10, 100000, 60, sizeof=RenderedResponse.size))
+        render = mock.Mock(return_value='{}')
+        key_with_genre = Key('kevin', 'hart', genre='COMEDY')
+
+        # when
+        response_cache.render(Key('kevin', 'hart', genre='comedy'), self.movies, render)
+        response_cache.render(key_with_genre, self.movies, render)
+        self.movies.version = 'refreshed'
+        response_cache.render(key_with_genre, self.movies, render)
+
+        # then
+        self.assertEqual(2, render.call_count)
+
+    def test_negotiates_content_coding(self):
+        available = {'identity': b'', 'gzip': b''}
+
+        self.assertEqual('gzip', negotiate_encoding('deflate, gzip;q=0.8', available))
+        self.assertEqual('identity', negotiate_encoding('gzip;q=0', available))
+        self.assertEqual('identity', negotiate_encoding('', available))
+
+    def test_serves_gzipped_response_when_accepted(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+
+        # when
+        with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache):
+            response = self.client.get('/api/v1/movies/', {'firstname': 'kevin', 'lastname': 'hart'},
+                                       HTTP_ACCEPT_ENCODING='gzip, deflate')
+
+        # then
+        self.assertEqual('gzip', response['Content-Encoding'])
+        self.assertEqual(30, len(json.loads(gzip.decompress(response.content))['kevin hart']))
+
+
+class ConditionalRequestTests(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(ConditionalRequestTests, self).__init__(*args, **kwargs)
+        self.movies = Movies(artist_name=kevin_key)
+
+        for test_movie in test_movies:
+            self.movies.add(test_movie)
+
+    def get(self, in_mem_cache, **headers):
+        with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache):
+            return self.client.get('/api/v1/movies/', {'firstname': 'kevin', 'lastname': 'hart'}, **headers)
+
+    def test_sets_cache_headers_from_the_cached_entry(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+
+        # when
+        response = self.get(in_mem_cache)
+
+        # then
+        self.assertEqual(f'W/"{self.movies.version}"', response['ETag'])
+        self.assertEqual(int(self.movies.stored_at), parse_http_date(response['Last-Modified']))
+        max_age = int(response['Cache-Control'].split('max-age=')[1])
+        self.assertAlmostEqual(freshness_settings()['SOFT_TTL'], max_age, delta=2)
+
+    def test_answers_matching_etag_with_not_modified_without_rendering(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+        etag = self.get(in_mem_cache)['ETag']
+
+        # when
+        with mock.patch('movies_api.movie_requests.response_cache') as response_cache:
+            response = self.get(in_mem_cache, HTTP_IF_NONE_MATCH=etag)
+
+        # then
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b'', response.content)
+        self.assertEqual(etag, response['ETag'])
+        response_cache.render.assert_not_called()
+
+    def test_answers_with_new_movies_once_they_are_refreshed(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+        etag = self.get(in_mem_cache)['ETag']
+        refreshed = Movies(artist_name=kevin_key)
+        refreshed.add(Movie('title_4', '2021-07-03T07:00:00Z', 'Comedy'))
+        in_mem_cache.save_movies(kevin_key, refreshed)
+
+        # when
+        response = self.get(in_mem_cache, HTTP_IF_NONE_MATCH=etag)
+
+        # then
+        self.assertEqual(200, response.status_code)
+        self.assertNotEqual(etag, response['ETag'])
+
+    def test_stale_movies_are_not_to_be_kept(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.storage.put(kevin_key, CacheEntry(self.movies, stored_at=time.time() - 86500))
+        self.movies.version = self.movies.content_hash()
+
+        # when
+        with mock.patch.object(in_mem_cache, 'schedule_refresh'):
+            response = self.get(in_mem_cache)
+
+        # then
+        self.assertEqual('public, max-age=0', response['Cache-Control'])
+
+
+class SerializationTests(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(SerializationTests, self).__init__(*args, **kwargs)
+        self.movies = Movies(artist_name=Key('beyoncé', 'knowles'))
+
+        for test_movie in test_movies + [Movie('Dreamgirls ✨', '2006-12-25T08:00:00Z', 'Drama')]:
+            self.movies.add(test_movie)
+        self.movies.version = self.movies.content_hash()
+
+    def test_round_trips_cached_entries(self):
+        for compress_min_bytes in (0, 100000):
+            # given
+            entry = CacheEntry(self.movies, stored_at=1600000000.5)
+
+            # when
+            encoded = encode_entry(entry, compress_min_bytes=compress_min_bytes)
+            decoded = from_stored(encoded)
+
+            # then
+            self.assertEqual(self.movies.details(), decoded.movies.details())
+            self.assertEqual(self.movies.version, decoded.movies.version)
+            self.assertEqual((entry.stored_at, entry.soft_expiry, entry.hard_expiry),
+                             (decoded.stored_at, decoded.soft_expiry, decoded.hard_expiry))
+
+    def test_round_trips_titles_holding_the_separator(self):
+        for titles in ([], ['Lemonade'], ['Lemon\x00ade', '\x00', '']):
+            # given
+            movies = Movies(artist_name=Key('beyoncé', 'knowles'))
+            for title in titles:
+                movies.add(Movie(title, '2016-04-23T07:00:00Z', 'Music'))
+
+            # when
+            decoded = from_stored(encode_entry(CacheEntry(movies), compress_min_bytes=100000))
+
+            # then
+            self.assertEqual(movies.rows, decoded.movies.rows)
+            self.assertEqual('beyonce knowles', decoded.movies.key)
+
+    def test_encoding_is_smaller_than_pickle(self):
+        entry = CacheEntry(self.movies)
+
+        self.assertLess(len(encode_entry(entry, compress_min_bytes=100000)), len(pickle.dumps(entry)))
+
+    def test_decoded_artists_share_their_genres(self):
+        # given
+        brad_movies = Movies(artist_name=Key('brad', 'pitt'))
+        brad_movies.add(Movie('Moneyball', '2011-09-23T07:00:00Z', 'Dra' + 'ma'))
+
+        # when
+        decoded = [from_stored(encode_entry(CacheEntry(movies))).movies for movies in (self.movies, brad_movies)]
+
+        # then
+        dramas = [genre for movies in decoded for _, _, genre in movies.rows if genre == 'Drama']
+        self.assertEqual(3, len(dramas))
+        self.assertTrue(all(genre is dramas[0] for genre in dramas))
+
+    def test_restores_movies_pickled_before_they_were_held_as_rows(self):
+        # given
+        state = {'key': self.movies.key, 'movies': json.loads(self.movies.details()), 'index': None,
+                 'version': self.movies.version}
+
+        # when
+        movies = Movies.__new__(Movies)
+        movies.__setstate__(state)
+
+        # then
+        self.assertEqual(self.movies.details(), movies.details())
+        self.assertEqual(self.movies.version, movies.version)
+        self.assertEqual(1, len(movies.select(Key('beyoncé', 'knowles'), genre='comedy').all_movies()))
+
+    def test_ignores_entries_of_unknown_format_version(self):
+        encoded = bytearray(encode_entry(CacheEntry(self.movies)))
+        encoded[2] = FORMAT_VERSION + 1
+
+        self.assertIsNone(from_stored(bytes(encoded)))
+
+
+class NegativeCacheTests(TestCase):
+
+    def test_remembers_unknown_artists(self):
+        # given
+        third_party = mock.Mock()
+        third_party.api_lookup.side_effect = ArtistNotFound('Cannot get movies')
+        in_mem_cache = CacheSpi(in_memory=True)
+        handler = RequestHandler(in_mem_cache, third_party, SingleFlight())
+
+        # when
+        responses = [handler.get_details(kevin_key) for _ in range(3)]
+
+        # then
+        self.assertEqual([404] * 3, [response.status_code for response in responses])
+        third_party.api_lookup.assert_called_once_with(kevin_key)
+        self.assertEqual(2, in_mem_cache.negative_stats()['not_found_hits'])
+
+    @mock.patch('movies_api.movie_requests.RequestResponse')
+    def test_remembers_artists_the_api_has_no_results_for(self, request_response):
+        # given
+        request_response.response.return_value = MockResponse(json.dumps({'resultCount': 0, 'results': []}), 200)
+        in_mem_cache = CacheSpi(in_memory=True)
+        handler = RequestHandler(in_mem_cache, ThirdParty(request_response), SingleFlight())
+
+        # when
+        responses = [handler.get_details(kevin_key) for _ in range(2)]
+
+        # then
+        self.assertEqual([404] * 2, [response.status_code for response in responses])
+        request_response.response.assert_called_once()
+        self.assertEqual(1, in_mem_cache.negative_stats()['not_found_hits'])
+
+    def test_remembers_upstream_errors_separately(self):
+        # given
+        third_party = mock.Mock()
+        third_party.api_lookup.side_effect = UpstreamError('iTunes is down')
+        in_mem_cache = CacheSpi(in_memory=True)
+        handler = RequestHandler(in_mem_cache, third_party, SingleFlight())
+
+        # when
+        responses = [handler.get_details(kevin_key) for _ in range(2)]
+
+        # then
+        self.assertEqual([503] * 2, [response.status_code for response in responses])
+        third_party.api_lookup.assert_called_once_with(kevin_key)
+        self.assertEqual(1, in_mem_cache.negative_stats()['upstream_error_hits'])
+        self.assertEqual(0, in_mem_cache.negative_stats()['not_found_hits'])
+
+    @override_settings(NEGATIVE_CACHE={'UPSTREAM_ERROR_TTL': 0})
+    def test_goes_upstream_again_once_failure_expires(self):
+        # given
+        third_party = mock.Mock()
+        third_party.api_lookup.side_effect = UpstreamError('iTunes is down')
+        handler = RequestHandler(CacheSpi(in_memory=True), third_party, SingleFlight())
+
+        # when
+        handler.get_details(kevin_key)
+        handler.get_details(kevin_key)
+
+        # then
+        self.assertEqual(2, third_party.api_lookup.call_count)
+
+
+class BatchTests(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(BatchTests, self).__init__(*args, **kwargs)
+        self.movies = Movies(artist_name=kevin_key)
+
+        for test_movie in test_movies:
+            self.movies.add(test_movie)
+
+    def post_batch(self, artists, in_mem_cache, third_party):
+        with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache), \
+                mock.patch('movies_api.movie_requests.third_party', third_party):
+            return self.client.post('/api/v1/movies/batch/', json.dumps({'artists': artists}),
+                                    content_type='application/json')
+
+    def test_returns_results_and_errors_per_artist_in_order(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+        brad_movies = Movies(artist_name=Key('brad', 'pitt'))
+        brad_movies.add(Movie('title_4', '2019-07-03T07:00:00Z', 'Drama'))
+        third_party = mock.Mock()
+
+        def api_lookup(key):
+            if key == Key('brad', 'pitt'):
+                return brad_movies
+            raise ArtistNotFound(f'Cannot get movies for {key}')
+
+        third_party.api_lookup.side_effect = api_lookup
+        artists = [{'firstname': 'kevin', 'lastname': 'hart', 'genre': 'drama'},
+                   {'firstname': 'brad', 'lastname': 'pitt'},
+                   {'firstname': 'nobody', 'lastname': 'known'}]
+
+        # when
+        with mock.patch.object(in_mem_cache.storage, 'get_many', wraps=in_mem_cache.storage.get_many) as get_many:
+            response = self.post_batch(artists, in_mem_cache, third_party)
+
+        # then
+        results = json.loads(response.content)['results']
+        self.assertEqual(['kevin hart', 'brad pitt', 'nobody known'], [result['artist'] for result in results])
+        self.assertEqual(['title_2'], [movie['name'] for movie in results[0]['movies']])
+        self.assertEqual(['title_4'], [movie['name'] for movie in results[1]['movies']])
+        self.assertEqual(404, results[2]['status'])
+        get_many.assert_called_once()
+        self.assertEqual(2, third_party.api_lookup.call_count)
+
+    def test_null_offset_and_limit_page_from_the_first_movie(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+        artists = [{'firstname': 'kevin', 'lastname': 'hart', 'offset': None, 'limit': None},
+                   {'firstname': 'kevin', 'lastname': 'hart', 'offset': None, 'limit': 1}]
+
+        # when
+        response = self.post_batch(artists, in_mem_cache, mock.Mock())
+
+        # then
+        self.assertEqual(200, response.status_code)
+        results = json.loads(response.content)['results']
+        self.assertEqual([len(self.movies.rows), 1], [len(result['movies']) for result in results])
+
+    def test_rejects_malformed_batches(self):
+        kevin = {'firstname': 'kevin', 'lastname': 'hart'}
+        for artists in ([], [{'firstname': 'kevin'}], ['kevin hart'], [{'firstname': 'kevin', 'lastname': 1}],
+                        [dict(kevin, releaseDate=None)], [dict(kevin, releaseDate=[2013])],
+                        [dict(kevin, fields=[['name']])], [dict(kevin, fields=[{'name': 1}])]):
+            response = self.post_batch(artists, CacheSpi(in_memory=True), mock.Mock())
+            self.assertEqual(400, response.status_code, f'{artists} needs to be rejected')
+
+
+class WarmCacheTests(TestCase):
+
+    def warm(self, lines, in_mem_cache, third_party, *args):
+        out = io.StringIO()
+        with tempfile.NamedTemporaryFile('w', suffix='.txt') as artists:
+            artists.write('\n'.join(lines))
+            artists.flush()
+            with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache), \
+                    mock.patch('movies_api.movie_requests.third_party', third_party):
+                call_command('warm_cache', artists.name, *args, stdout=out)
+        return out.getvalue()
+
+    def test_fills_cache_and_skips_fresh_artists(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        kevin_movies = Movies(artist_name=kevin_key)
+        kevin_movies.add(test_movies[0])
+        in_mem_cache.save_movies(kevin_key, kevin_movies)
+        brad_movies = Movies(artist_name=Key('brad', 'pitt'))
+        brad_movies.add(test_movies[1])
+        third_party = mock.Mock()
+
+        def api_lookup(key, wait=0):
+            if key == Key('brad', 'pitt'):
+                return brad_movies
+            if key == Key('tom', 'hanks'):
+                raise UpstreamUnavailable('open')
+            raise ArtistNotFound(f'Cannot get movies for {key}')
+
+        third_party.api_lookup.side_effect = api_lookup
+
+        # when
+        output = self.warm(['# artists', 'Kevin Hart', '', 'brad pitt', 'nobody known', 'tom hanks'],
+                           in_mem_cache, third_party, '--concurrency', '2')
+
+        # then
+        self.assertEqual(3, third_party.api_lookup.call_count)
+        self.assertIs(in_mem_cache.storage_lookup(Key('brad', 'pitt')), brad_movies)
+        self.assertEqual(NOT_FOUND, in_mem_cache.negative_lookup(Key('nobody', 'known')))
+        self.assertIn('Warmed 4 artists (1 fetched, 1 fresh, 1 not found, 1 failed)', output)
+
+    def test_force_looks_up_fresh_artists(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        kevin_movies = Movies(artist_name=kevin_key)
+        kevin_movies.add(test_movies[0])
+        in_mem_cache.save_movies(kevin_key, kevin_movies)
+        third_party = mock.Mock()
+        third_party.api_lookup.return_value = kevin_movies
+
+        # when
+        output = self.warm(['kevin hart'], in_mem_cache, third_party, '--force', '--rate-wait', '1')
+
+        # then
+        third_party.api_lookup.assert_called_once_with(kevin_key, wait=1.0)
+        self.assertIn('1 fetched', output)
+
+
+class StreamingTests(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(StreamingTests, self).__init__(*args, **kwargs)
+        self.movies = Movies(artist_name=kevin_key)
+
+        for test_movie in test_movies:
+            self.movies.add(test_movie)
+
+    def test_streams_one_movie_per_line(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+
+        # when
+        with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache):
+            response = self.client.get('/api/v1/movies/',
+                                       {'firstname': 'kevin', 'lastname': 'hart', 'format': 'ndjson'})
+            lines = b''.join(response.streaming_content).decode().splitlines()
+
+        # then
+        self.assertEqual(NDJSON, response['Content-Type'])
+        self.assertEqual(['title_1', 'title_2', 'title_3'], [json.loads(line)['name'] for line in lines])
+
+    def test_streams_one_artist_per_line_in_batch_mode(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+        third_party = mock.Mock()
+        third_party.api_lookup.side_effect = ArtistNotFound('Cannot get movies')
+        artists = [{'firstname': 'nobody', 'lastname': 'known'}, {'firstname': 'kevin', 'lastname': 'hart'},
+                   {'firstname': 'Kevin', 'lastname': 'Hart', 'releaseDate': '2020'}]
+
+        # when
+        with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache), \
+                mock.patch('movies_api.movie_requests.third_party', third_party):
+            response = self.client.post('/api/v1/movies/batch/', json.dumps({'artists': artists}),
+                                        content_type='application/json', HTTP_ACCEPT=NDJSON)
+            results = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+
+        # then
+        results_by_index = {result['index']: result for result in results}
+        self.assertEqual([1, 2, 0], [result['index'] for result in results])  # cached artists come first
+        self.assertEqual(404, results_by_index[0]['status'])
+        self.assertEqual(3, len(results_by_index[1]['movies']))
+        self.assertEqual(['title_3'], [movie['name'] for movie in results_by_index[2]['movies']])
+
+
+class PaginationTests(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(PaginationTests, self).__init__(*args, **kwargs)
+        self.movies = Movies(artist_name=kevin_key)
+
+        for test_movie in test_movies * 10:
+            self.movies.add(test_movie)
+        self.movies.version = self.movies.content_hash()
+
+    def get(self, **query):
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+        with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache):
+            return self.client.get('/api/v1/movies/', dict({'firstname': 'kevin', 'lastname': 'hart'}, **query))
+
+    def test_returns_page_of_movies_with_fields_asked_for(self):
+        # when
+        response = self.get(genre='drama', offset='2', limit='3', fields='name,releaseDate')
+
+        # then
+        self.assertEqual([{'name': 'title_2', 'release date': 2017}] * 3, json.loads(response.content)['kevin hart'])
+
+    def test_pages_are_cached_apart(self):
+        # when
+        first = json.loads(self.get(limit='2').content)['kevin hart']
+        second = json.loads(self.get(offset='2', limit='2').content)['kevin hart']
+        names = json.loads(self.get(offset='2', limit='2', fields='name').content)['kevin hart']
+        past_the_end = json.loads(self.get(offset='30').content)['kevin hart']
+
+        # then
+        self.assertEqual(['title_1', 'title_2'], [movie['name'] for movie in first])
+        self.assertEqual(['title_3', 'title_1'], [movie['name'] for movie in second])
+        self.assertEqual([{'name': 'title_3'}, {'name': 'title_1'}], names)
+        self.assertEqual([], past_the_end)
+
+    def test_pages_do_not_copy_the_cached_movies(self):
+        # given
+        page = Key('kevin', 'hart', genre='comedy', offset=1, limit=2)
+        self.movies.build_index()
+
+        # when
+        with mock.patch.object(Movies, 'all_movies') as all_movies:
+            paged = _filtered(self.movies, page)
+
+        # then
+        all_movies.assert_not_called()
+        self.assertEqual(2, len(paged.rows))
+        self.assertIs(self.movies.rows[3], paged.rows[0])
+
+    def test_rejects_malformed_pages_and_fields(self):
+        for query in ({'limit': '-1'}, {'offset': 'ten'}, {'fields': 'name,year'}, {'fields': ''}):
+            self.assertEqual(400, self.get(**query).status_code, query)
+
+    def test_pages_each_artist_of_a_batch(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+        body = {'artists': [{'firstname': 'kevin', 'lastname': 'hart', 'limit': 1, 'fields': ['genre']}]}
+
+        # when
+        with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache):
+            response = self.client.post('/api/v1/movies/batch/', json.dumps(body), content_type='application/json')
+
+        # then
+        self.assertEqual([{'genre': 'Comedy'}], json.loads(response.content)['results'][0]['movies'])
+
+
+class StubServer:
+    """ A local stand in for the iTunes search api. Each request is answered with the next scripted
+        (delay, status) pair, the last one being repeated once the script runs out
+    """
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.requests = 0
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with stub.lock:
+                    delay, status = stub.script[min(stub.requests, len(stub.script) - 1)]
+                    stub.requests += 1
+                time.sleep(delay)
+                body = json.dumps({"results": [
+                    {"trackName": "title_1", "releaseDate": "2020-07-03T07:00:00Z", "primaryGenreName": 'Drama'}
+                ]}).encode()
+                try:
+                    self.send_response(status)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass  # the client gave up on the request, eg it timed out or lost a hedged race
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def config(self, **overrides):
+        config = upstream_settings()
+        config.update({'URL': f'http://127.0.0.1:{self.server.server_port}/search?term={{}}+{{}}',
+                       'BACKOFF': 0.01, 'CONNECT_TIMEOUT': 0.5, 'READ_TIMEOUT': 0.5})
+        config.update(overrides)
+        return config
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class RequestResponseTests(TestCase):
+
+    def test_retries_failed_requests(self):
+        # given
+        stub = StubServer([(0, 503), (0, 503), (0, 200)])
+        self.addCleanup(stub.close)
+
+        # when
+        response = RequestResponse(stub.config(RETRIES=2)).response(kevin_key)
+
+        # then
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(3, stub.requests)
+
+    def test_gives_up_when_upstream_does_not_answer_in_time(self):
+        # given
+        stub = StubServer([(1, 200)])
+        self.addCleanup(stub.close)
+        request_response = RequestResponse(stub.config(RETRIES=1, READ_TIMEOUT=0.1))
+
+        # then
+        self.assertRaises(requests.Timeout, request_response.response, kevin_key)
+        self.assertEqual(2, stub.requests)
+
+    def test_sends_hedged_request_when_first_is_slower_than_p95(self):
+        # given
+        stub = StubServer([(0.5, 200), (0, 200)])
+        self.addCleanup(stub.close)
+        request_response = RequestResponse(stub.config(RETRIES=0, READ_TIMEOUT=1, HEDGE=True, HEDGE_MIN_SAMPLES=1))
+        request_response.latencies.append(0.05)
+
+        # when
+        start = time.perf_counter()
+        response = request_response.response(kevin_key)
+
+        # then
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, stub.requests)
+        self.assertLess(time.perf_counter() - start, 0.4)
+
+    def test_hedged_request_succeeds_when_the_other_fails_in_the_same_wait(self):
+        # given
+        request_response = RequestResponse(upstream_settings())
+        failed, succeeded = Future(), Future()
+        failed.set_exception(requests.ConnectionError("connection reset"))
+        succeeded.set_result(HttpResponse(status=200))
+        waits = [(set(), {failed}), ([failed, succeeded], set())]
+
+        # when
+        with mock.patch.object(request_response, '_submit', side_effect=[failed, succeeded]), \
+                mock.patch('movies_api.movie_requests.wait', side_effect=waits):
+            response = request_response._hedged('url', 0.01)
+
+        # then
+        self.assertEqual(200, response.status_code)
+
+    def test_hedged_request_raises_when_every_request_fails(self):
+        # given
+        request_response = RequestResponse(upstream_settings())
+        first, second = Future(), Future()
+        first.set_exception(requests.ConnectionError("connection reset"))
+        second.set_exception(requests.ConnectionError("connection reset"))
+        waits = [(set(), {first}), ([first, second], set())]
+
+        # when
+        with mock.patch.object(request_response, '_submit', side_effect=[first, second]), \
+                mock.patch('movies_api.movie_requests.wait', side_effect=waits):
+
+            # then
+            self.assertRaises(requests.ConnectionError, request_response._hedged, 'url', 0.01)
+
+    def test_does_not_hedge_while_the_pool_is_busy_with_earlier_requests(self):
+        # given
+        stub = StubServer([(0.2, 200)])
+        self.addCleanup(stub.close)
+        request_response = RequestResponse(stub.config(RETRIES=0, READ_TIMEOUT=1, HEDGE=True, HEDGE_MIN_SAMPLES=1,
+                                                       POOL_SIZE=1))
+        request_response.latencies.append(0.01)
+        request_response.hedge_slots.acquire()  # held by the loser of an earlier race
+
+        # when
+        response = request_response.response(kevin_key)
+
+        # then
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, stub.requests)
+
+    def test_async_client_keeps_a_bounded_window_of_latencies(self):
+        # given
+        request_response = AsyncRequestResponse(upstream_settings())
+
+        # when
+        request_response.latencies.extend([0.01] * 1500)
+
+        # then
+        self.assertEqual(1000, len(request_response.latencies))
+
+
+class AsyncRequestHandlerTests(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncRequestHandlerTests, self).__init__(*args, **kwargs)
+        self.movies = Movies(artist_name=kevin_key)
+
+        for test_movie in test_movies:
+            self.movies.add(test_movie)
+
+    def test_concurrent_misses_for_same_key_make_one_upstream_call(self):
+        # given
+        third_party = mock.Mock()
+
+        async def api_lookup(key):
+            await asyncio.sleep(0.05)
+            return self.movies
+
+        third_party.api_lookup.side_effect = api_lookup
+        coalescer = AsyncSingleFlight()
+        handler = AsyncRequestHandler(AsyncCacheSpi(in_memory=True), third_party, coalescer)
+
+        async def requests_for_kevin():
+            return await asyncio.gather(*[handler.get_details(kevin_key) for _ in range(100)])
+
+        # when
+        results = async_to_sync(requests_for_kevin)()
+
+        # then
+        third_party.api_lookup.assert_called_once_with(kevin_key)
+        self.assertEqual([self.movies] * 100, results)
+        self.assertEqual(99, coalescer.stats()['coalesced'])
+
+    def test_should_not_lookup_details_from_third_party_if_in_storage(self):
+        # given
+        in_mem_cache = AsyncCacheSpi(in_memory=True)
+        async_to_sync(in_mem_cache.save_movies)(kevin_key, self.movies)
+        third_party = mock.Mock()
+        handler = AsyncRequestHandler(in_mem_cache, third_party, AsyncSingleFlight())
+
+        # when
+        details = async_to_sync(handler.get_details)(kevin_key)
+
+        # then
+        third_party.api_lookup.assert_not_called()
+        self.assertEqual(self.movies, details)
+
+    def test_looks_up_movies_from_upstream_without_blocking(self):
+        # given
+        stub = StubServer([(0, 200)])
+        self.addCleanup(stub.close)
+        third_party = AsyncThirdParty(AsyncRequestResponse(stub.config()))
+
+        # when
+        movies = async_to_sync(third_party.api_lookup)(kevin_key)
+
+        # then
+        self.assertEqual('title_1', movies.all_movies()[0]['name'])
+
+    def test_closes_the_http_client_of_each_event_loop_when_the_loop_ends(self):
+        # given
+        stub = StubServer([(0, 200), (0, 200)])
+        self.addCleanup(stub.close)
+        request_response = AsyncRequestResponse(stub.config())
+        clients = []
+        make = request_response.clients.make
+        request_response.clients.make = lambda: clients.append(make()) or clients[-1]
+
+        # when
+        for _ in range(2):
+            async_to_sync(request_response.response)(kevin_key)
+
+        # then
+        self.assertEqual(2, len(clients))
+        self.assertTrue(all(client.is_closed for client in clients))
+
+    def test_background_refresh_is_kept_until_it_is_done(self):
+        # given
+        third_party = mock.Mock()
+
+        async def api_lookup(key):
+            await asyncio.sleep(0.05)
+            return self.movies
+
+        third_party.api_lookup.side_effect = api_lookup
+        in_mem_cache = AsyncCacheSpi(in_memory=True, third_party=third_party)
+
+        async def refresh():
+            in_mem_cache.schedule_refresh(kevin_key)
+            gc.collect()
+            running = len(in_mem_cache.refresh_tasks)
+            while in_mem_cache.refreshing:
+                await asyncio.sleep(0.01)
+            return running
+
+        # when
+        running = async_to_sync(refresh)()
+
+        # then
+        self.assertEqual(1, running)
+        self.assertEqual(set(), in_mem_cache.refresh_tasks)
+        third_party.api_lookup.assert_called_once_with(kevin_key)
+
+
+class MockResponse:
+    def __init__(self, json_data, status_code):
+        self.json_data = json_data
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.content = json_data
+
+
+class ThirdPartyTests(TestCase):
+
+    @mock.patch('movies_api.movie_requests.RequestResponse')
+    def test_returns_results_when_request_ok(self, request_response):
+        # given
+        request_response.response.return_value = MockResponse(json.dumps({"results": [
+            {"trackName": "title_1", "releaseDate": 2020, "primaryGenreName": 'Drama'}
+        ]}), 200)
+
+        # when
+        third_party = ThirdParty(request_response)
+
+        # then
+        self.assertIsNotNone(third_party.api_lookup(kevin_key))
+
+    @mock.patch('movies_api.movie_requests.RequestResponse')
+    def test_throws_value_error_if_response_not_ok(self, request_response):
+        # given
+        request_response.response.return_value = MockResponse({}, 400)
+
+        # when
+        third_party = ThirdParty(request_response)
+
+        # then
+        self.assertRaises(ValueError, third_party.api_lookup, kevin_key)
+
+    @mock.patch('movies_api.movie_requests.RequestResponse')
+    def test_throws_upstream_error_if_upstream_fails(self, request_response):
+        # given
+        request_response.response.return_value = MockResponse({}, 502)
+
+        # when
+        third_party = ThirdParty(request_response)
+
+        # then
+        self.assertRaises(UpstreamError, third_party.api_lookup, kevin_key)
+
+
+class GuardTests(TestCase):
+
+    def test_limiter_shares_tokens_through_the_cache(self):
+        # given
+        cache = LocMemCache('ratelimit', {})
+        limiters = [RateLimiter(cache, rate=3, period=60), RateLimiter(cache, rate=3, period=60)]
+
+        # when
+        allowed = [limiters[i % 2].try_acquire() for i in range(5)]
+
+        # then
+        self.assertEqual(allowed, [True, True, True, False, False])
+        self.assertEqual(limiters[1].stats()['saturation'], 1.0)
+        self.assertEqual(limiters[0].stats()['throttled'], 1)
+
+    def test_breaker_opens_after_consecutive_failures_and_recovers_when_half_open(self):
+        # given
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+
+        # when
+        breaker.record_failure()
+
+        # then
+        self.assertEqual(breaker.stats()['state'], 'open')
+        self.assertFalse(breaker.allow())
+        time.sleep(0.06)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.stats(), {'opened': 1, 'rejected': 2, 'state': 'closed', 'failures': 0})
+
+    @mock.patch('movies_api.movie_requests.RequestResponse')
+    def test_open_circuit_fails_fast_without_calling_upstream(self, request_response):
+        # given
+        request_response.response.return_value = MockResponse({}, 503)
+        third_party = ThirdParty(request_response, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+        for _ in range(2):
+            self.assertRaises(UpstreamError, third_party.api_lookup, kevin_key)
+
+        # when
+        self.assertRaises(UpstreamUnavailable, third_party.api_lookup, kevin_key)
+
+        # then
+        self.assertEqual(request_response.response.call_count, 2)
+        self.assertEqual(third_party.stats()['breaker']['state'], 'open')
+
+    @mock.patch('movies_api.movie_requests.RequestResponse')
+    def test_not_found_does_not_open_circuit(self, request_response):
+        # given
+        request_response.response.return_value = MockResponse({}, 404)
+        third_party = ThirdParty(request_response, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60))
+
+        # when
+        self.assertRaises(ArtistNotFound, third_party.api_lookup, kevin_key)
+
+        # then
+        self.assertEqual(third_party.stats()['breaker']['state'], 'closed')
+
+    def test_rate_limited_half_open_call_gives_back_its_trial(self):
+        # given
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        limiter = RateLimiter(LocMemCache('ratelimit-trial', {}), rate=0, period=60)
+
+        # when
+        self.assertRaises(UpstreamUnavailable, check_guards, kevin_key, breaker, limiter)
+
+        # then
+        self.assertTrue(breaker.allow())
+
+    @mock.patch('movies_api.movie_requests.RequestResponse')
+    def test_unreadable_trial_response_opens_circuit_again(self, request_response):
+        for content in ('<html>busy</html>', json.dumps({'results': None})):
+            # given
+            request_response.response.return_value = MockResponse(content, 200)
+            breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0)
+            breaker.record_failure()
+            third_party = ThirdParty(request_response, breaker=breaker)
+
+            # when
+            self.assertRaises(UpstreamError, third_party.api_lookup, kevin_key)
+
+            # then
+            self.assertEqual('open', breaker.stats()['state'])
+            self.assertTrue(breaker.allow())
+
+    def test_gives_up_on_trial_calls_without_outcome(self):
+        # given
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+        breaker.record_failure()
+        time.sleep(0.05)
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+
+        # when
+        time.sleep(0.05)
+
+        # then
+        self.assertTrue(breaker.allow())
+        self.assertEqual('half_open', breaker.stats()['state'])
+
+    def test_open_circuit_serves_stale_and_is_not_remembered_as_failure(self):
+        # given
+        stale = Movies(artist_name=kevin_key)
+        stale.add(test_movies[0])
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.storage.put(kevin_key, CacheEntry(stale, stored_at=time.time() - 100000))
+        third_party = mock.Mock()
+        third_party.api_lookup.side_effect = UpstreamUnavailable("open")
+        handler = RequestHandler(in_mem_cache, third_party, SingleFlight())
+
+        # when
+        movies = handler.get_movies(kevin_key)
+
+        # then
+        self.assertIs(movies, stale)
+        self.assertIsNone(in_mem_cache.negative_lookup(kevin_key))
+
+
+class MetricsTests(TestCase):
+
+    def test_merges_values_recorded_by_each_thread(self):
+        # given
+        registry = Registry()
+        counter = registry.counter('lookups_total', "Lookups", ('result',))
+        histogram = registry.histogram('stage_seconds', "Stages", ('stage',), buckets=(0.01, 0.1))
+
+        def record():
+            for _ in range(100):
+                counter.inc('hit')
+            histogram.observe(0.05, 'lookup')
+
+        threads = [threading.Thread(target=record) for _ in range(4)]
+
+        # when
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc('miss', amount=2)
+
+        # then
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP lookups_total Lookups',
+            '# TYPE lookups_total counter',
+            'lookups_total{result="hit"} 400',
+            'lookups_total{result="miss"} 2',
+            '# HELP stage_seconds Stages',
+            '# TYPE stage_seconds histogram',
+            'stage_seconds_bucket{stage="lookup",le="0.01"} 0',
+            'stage_seconds_bucket{stage="lookup",le="0.1"} 4',
+            'stage_seconds_bucket{stage="lookup",le="+Inf"} 4',
+            'stage_seconds_sum{stage="lookup"} 0.2',
+            'stage_seconds_count{stage="lookup"} 4',
+        ]) + '\n')
+
+    def test_folds_values_of_ended_threads_together(self):
+        # given
+        registry = Registry()
+        counter = registry.counter('lookups_total', "Lookups", ('result',))
+        histogram = registry.histogram('stage_seconds', "Stages", ('stage',), buckets=(0.01, 0.1))
+
+        def record():
+            counter.inc('hit')
+            histogram.observe(0.05, 'lookup')
+
+        # when
+        for _ in range(200):
+            thread = threading.Thread(target=record)
+            thread.start()
+            thread.join()
+        counter.inc('hit')
+
+        # then
+        self.assertEqual(1, len(registry._shards))
+        self.assertEqual({('hit',): 201}, counter.values())
+        self.assertEqual({('lookup',): [0, 200, 0, 200 * 0.05]}, {
+            labels: counts[:3] + [round(counts[3], 6)] for labels, counts in histogram.values().items()})
+
+    def test_merges_samples_of_a_metric_from_many_collectors(self):
+        # given
+        registry = Registry()
+        registry.register_collector(lambda: [('events_total', 'counter', "Events", [({'pipeline': 'sync'}, 1)])])
+        registry.register_collector(lambda: [('events_total', 'counter', "Events", [({'pipeline': 'async'}, 2)])])
+
+        # when
+        rendered = registry.render()
+
+        # then
+        self.assertEqual(rendered, '# HELP events_total Events\n# TYPE events_total counter\n'
+                                   'events_total{pipeline="sync"} 1\nevents_total{pipeline="async"} 2\n')
+
+    def test_metrics_endpoint_counts_cache_hits_and_times_stages(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        movies = Movies(artist_name=kevin_key)
+        movies.add(test_movies[0])
+        in_mem_cache.save_movies(kevin_key, movies)
+        hits = CACHE_LOOKUPS.values().get(('hit',), 0)
+        lookups = STAGE_SECONDS.values().get(('lookup',), [0])[:-1]
+
+        # when
+        with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache):
+            self.client.get('/api/v1/movies/?firstname=kevin&lastname=hart&genre=comedy')
+        response = self.client.get('/metrics')
+
+        # then
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        self.assertEqual(CACHE_LOOKUPS.values()[('hit',)], hits + 1)
+        self.assertEqual(sum(STAGE_SECONDS.values()[('lookup',)][:-1]), sum(lookups) + 1)
+        body = response.content.decode()
+        self.assertIn('movies_stage_seconds_count{stage="filter"}', body)
+        self.assertIn('movies_upstream_circuit_state{state="closed"} 1', body)
+        self.assertIn('movies_single_flight_events_total{event="leaders",pipeline="async"}', body)
+
+
+class StandInTests(TestCase):
+    """ Runs the real memcached and http clients against the stand-ins for memcached and iTunes """
+
+    def setUp(self):
+        self.memcached = MemcachedStub().start()
+        self.itunes = ITunesStub(results=3).start()
+        self.settings = override_settings(
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+                                'LOCATION': self.memcached.location}},
+            LOCAL_CACHE={'ENABLED': False},
+            MEMCACHED={'NOREPLY_WRITES': False},  # so that entries can be read back as soon as they are written
+            SNAPSHOT={'ENABLED': False})
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        self.itunes.stop()
+        self.memcached.stop()
+
+    def test_stores_artists_looked_up_from_itunes_in_memcached(self):
+        # given
+        config = dict(upstream_settings(), URL=self.itunes.url)
+        handler = RequestHandler(CacheSpi(), ThirdParty(RequestResponse(config)), SingleFlight())
+
+        # when
+        movies = handler.get_movies(kevin_key)
+
+        # then
+        self.assertEqual(3, len(movies.all_movies()))
+        self.assertEqual(CacheSpi().storage_lookup(kevin_key).all_movies(), movies.all_movies())
+        self.assertEqual(1, self.itunes.requests)
+
+    def test_memcached_is_used_from_many_threads(self):
+        # given
+        storage = MemCached()
+        keys = [Key('artist', str(i)) for i in range(20)]
+
+        def put_and_get(key):
+            storage.put(key, f'details of {key}')
+            return storage.get(key)
+
+        # when
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            found = list(executor.map(put_and_get, keys * 5))
+
+        # then
+        self.assertEqual(found, [f'details of {key}' for key in keys * 5])
+
+    def test_rate_limit_is_shared_through_memcached(self):
+        # given
+        limiters = [RateLimiter(cache, rate=3, period=60), RateLimiter(cache, rate=3, period=60)]
+
+        # when
+        allowed = [limiters[i % 2].try_acquire() for i in range(4)]
+
+        # then
+        self.assertEqual(allowed, [True, True, True, False])
+
+
+class ShardingTests(TestCase):
+    """ Runs the memcached clients against several stand-ins for memcached """
+
+    def setUp(self):
+        self.nodes = [MemcachedStub().start() for _ in range(3)]
+        self.settings = override_settings(
+            CACHES={'default': {'BACKEND': 'django.core.cache.backends.memcached.PyMemcacheCache',
+                                'LOCATION': [node.location for node in self.nodes]}},
+            LOCAL_CACHE={'ENABLED': False},
+            MEMCACHED={'FAILURES': 2, 'RETRY_AFTER': 60, 'NOREPLY_WRITES': False, 'CONNECT_TIMEOUT': 0.2})
+        self.settings.enable()
+        self.keys = [Key('artist', str(i)) for i in range(60)]
+
+    def tearDown(self):
+        self.settings.disable()
+        for node in self.nodes:
+            node.stop()
+
+    def test_spreads_keys_over_the_nodes(self):
+        # given
+        storage = MemCached()
+
+        # when
+        for key in self.keys:
+            storage.put(key, f'details of {key}')
+
+        # then
+        self.assertTrue(all(node.entries for node in self.nodes))
+        self.assertEqual(60, sum(len(node.entries) for node in self.nodes))
+        self.assertEqual(storage.get_many(self.keys), {key.as_key(): f'details of {key}' for key in self.keys})
+
+    def test_shares_entries_with_the_django_cache(self):
+        # given
+        storage = MemCached()
+
+        # when
+        for key in self.keys:
+            storage.put(key, f'details of {key}')
+
+        # then
+        self.assertEqual(cache.get_many([key.as_key() for key in self.keys]),
+                         {key.as_key(): f'details of {key}' for key in self.keys})
+
+    def test_losing_a_node_only_loses_its_keys(self):
+        # given
+        storage = MemCached()
+        for key in self.keys:
+            storage.put(key, f'details of {key}')
+        lost = len(self.nodes[0].entries)
+
+        # when
+        self.nodes[0].stop()
+        found = [storage.get(key) for key in self.keys]
+
+        # then
+        self.assertEqual(lost, found.count(None))
+        self.assertEqual(60 - lost, len(storage.get_many(self.keys)))
+        self.assertEqual({'nodes': 3, 'ejected': 1, 'ejections': 1, 'readmissions': 0}, storage.node_stats())
+
+    def test_keys_of_an_ejected_node_go_to_the_others(self):
+        # given
+        storage = MemCached()
+        self.nodes[0].stop()
+        for key in self.keys:
+            storage.get(key)
+
+        # when
+        for key in self.keys:
+            storage.put(key, f'details of {key}')
+
+        # then
+        self.assertEqual(60, sum(len(node.entries) for node in self.nodes[1:]))
+        self.assertEqual([storage.get(key) for key in self.keys], [f'details of {key}' for key in self.keys])
+
+    def test_leases_are_held_when_their_node_is_down(self):
+        # given
+        storage = MemCached()
+        for node in self.nodes:
+            node.stop()
+
+        # when
+        acquired = [storage.acquire_lease(key, 10) for key in self.keys[:5]]
+
+        # then
+        self.assertEqual([True] * 5, acquired)
+
+    def test_writes_without_waiting_for_replies(self):
+        # given
+        with override_settings(MEMCACHED={'NOREPLY_WRITES': True}):
+            storage = MemCached()
+
+        # when
+        for key in self.keys:
+            storage.put(key, f'details of {key}')
+        deadline = time.monotonic() + 5
+        while sum(len(node.entries) for node in self.nodes) < 60 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # then
+        self.assertEqual([storage.get(key) for key in self.keys], [f'details of {key}' for key in self.keys])
+
+    def test_waits_for_a_free_connection_when_all_are_in_use(self):
+        # given
+        with override_settings(MEMCACHED={'POOL_SIZE': 2, 'NOREPLY_WRITES': False}):
+            storage = MemCached()
+
+        def put_and_get(key):
+            storage.put(key, f'details of {key}')
+            return storage.get(key)
+
+        # when
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            found = list(executor.map(put_and_get, self.keys * 3))
+
+        # then
+        self.assertEqual(found, [f'details of {key}' for key in self.keys * 3])
+
+    def test_async_client_loses_only_the_keys_of_a_failed_node(self):
+        # given
+        storage = AsyncMemCached()
+        for key in self.keys:
+            MemCached().put(key, f'details of {key}')
+        lost = len(self.nodes[0].entries)
+
+        # when
+        self.nodes[0].stop()
+
+        async def get_all():
+            return [await storage.get(key) for key in self.keys]
+        found = async_to_sync(get_all)()
+
+        # then
+        self.assertEqual(lost, found.count(None))
+        self.assertEqual(1, storage.node_stats()['ejected'])
+
+    def test_async_client_counts_error_replies_as_node_failures(self):
+        # given
+        storage = AsyncMemCached()
+        error_reply = b'SERVER_ERROR out of memory\r\n'
+
+        async def get_all():
+            return [await storage.get(key) for key in self.keys]
+
+        # when
+        with mock.patch('movies_api.testing.memcached_stub._Handler.do_get', return_value=error_reply):
+            found = async_to_sync(get_all)()
+
+        # then
+        self.assertEqual([None] * 60, found)
+        self.assertEqual(3, storage.node_stats()['ejected'])
+
+    def test_async_client_closes_its_connections_when_its_event_loop_ends(self):
+        # given
+        storage = AsyncMemCached()
+
+        async def get_all():
+            return [await storage.get(key) for key in self.keys]
+
+        # when
+        for _ in range(2):
+            async_to_sync(get_all)()
+        deadline = time.monotonic() + 5
+        while any(node.connections for node in self.nodes) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # then
+        self.assertEqual([set()] * 3, [node.connections for node in self.nodes])
+
+
+class NodeRingTests(TestCase):
+
+    def setUp(self):
+        self.ring = NodeRing(['a:11211', 'b:11211', 'c:11211'], failures=2, retry_after=30)
+        self.keys = [f'artist_{i}' for i in range(30)]
+
+    def test_ejects_a_node_after_consecutive_failures(self):
+        # given
+        self.ring.failed('a:11211')
+        self.ring.succeeded('a:11211')
+        self.ring.failed('a:11211')
+        before = {key: self.ring.get_node(key) for key in self.keys}
+
+        # when
+        self.ring.failed('a:11211')
+
+        # then
+        after = {key: self.ring.get_node(key) for key in self.keys}
+        self.assertNotIn('a:11211', after.values())
+        self.assertEqual({key: node for key, node in before.items() if node != 'a:11211'},
+                         {key: node for key, node in after.items() if before[key] != 'a:11211'})
+
+    def test_retries_an_ejected_node_after_a_while(self):
+        # given
+        now = time.monotonic()
+        with mock.patch('movies_api.memcached.time.monotonic', return_value=now):
+            self.ring.failed('a:11211')
+            self.ring.failed('a:11211')
+
+        # when
+        with mock.patch('movies_api.memcached.time.monotonic', return_value=now + 31):
+            nodes = {self.ring.get_node(key) for key in self.keys}
+            self.ring.failed('a:11211')
+
+        # then
+        self.assertIn('a:11211', nodes)
+        self.assertEqual({'nodes': 3, 'ejected': 1, 'ejections': 2, 'readmissions': 1}, self.ring.stats())
+
+    def test_has_no_node_once_all_are_ejected(self):
+        for node in ('a:11211', 'b:11211', 'c:11211'):
+            self.ring.failed(node)
+            self.ring.failed(node)
+
+        self.assertIsNone(self.ring.get_node('artist_1'))
+
+
+class SnapshotTests(TransactionTestCase):
+    """ The snapshot is written by a background thread, so these tests commit their writes """
+
+    def setUp(self):
+        self.snapshot = Snapshot(max_age=freshness_settings()['MAX_STALE'], interval=60)
+        self.brad, self.tom = Key('brad', 'pitt'), Key('tom', 'hanks')
+        self.movies = Movies(artist_name=kevin_key)
+        for test_movie in test_movies:
+            self.movies.add(test_movie)
+
+    def restarted(self, shared=None):
+        """ Gets a CacheSpi in front of the snapshot, as a restarted worker would have with memcached flushed """
+        spi = CacheSpi(in_memory=True)
+        spi.storage = SnapshotStorage(shared or InMemoryStorage(), self.snapshot)
+        return spi
+
+    def test_writes_stored_artists_on_flush(self):
+        # given
+        spi = self.restarted()
+
+        # when
+        spi.save_movies(kevin_key, self.movies)
+        before = ArtistSnapshot.objects.count()
+        self.snapshot.flush()
+
+        # then
+        self.assertEqual(0, before)
+        stored = from_stored(self.snapshot.get(kevin_key.as_key()))
+        self.assertEqual(self.movies.all_movies(), stored.movies.all_movies())
+
+    def test_writes_an_artist_stored_twice_once(self):
+        # given
+        spi = self.restarted()
+
+        # when
+        spi.save_movies(kevin_key, self.movies)
+        spi.save_movies(kevin_key, self.movies)
+        self.snapshot.flush()
+
+        # then
+        self.assertEqual(1, self.snapshot.stats()['writes'])
+        self.assertEqual(1, ArtistSnapshot.objects.count())
+
+    def test_writes_in_the_background(self):
+        # given
+        self.snapshot.interval = 0.01
+
+        # when
+        self.restarted().save_movies(kevin_key, self.movies)
+        deadline = time.monotonic() + 5
+        # waits on the counters rather than the table, which sqlite locks while the writer holds it
+        while not self.snapshot.stats()['writes'] and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # then
+        self.assertEqual([kevin_key.as_key()], list(ArtistSnapshot.objects.values_list('key', flat=True)))
+
+    def test_serves_artists_missing_from_memcached_and_puts_them_back(self):
+        # given
+        self.restarted().save_movies(kevin_key, self.movies)
+        self.snapshot.flush()
+        memcached = InMemoryStorage()
+
+        # when
+        movies = self.restarted(memcached).storage_lookup(kevin_key)
+
+        # then
+        self.assertEqual(self.movies.all_movies(), movies.all_movies())
+        self.assertEqual(self.movies.all_movies(), memcached.get(kevin_key).movies.all_movies())
+        self.assertEqual(1, self.snapshot.stats()['hits'])
+
+    def test_restored_artists_go_stale_as_they_were_stored(self):
+        # given
+        config = freshness_settings()
+        storage = SnapshotStorage(InMemoryStorage(), self.snapshot)
+        storage.put(kevin_key, CacheEntry(self.movies, stored_at=time.time() - config['SOFT_TTL'] - 60))
+        storage.put(self.brad, CacheEntry(self.movies, stored_at=time.time() - config['HARD_TTL'] - 60))
+        self.snapshot.flush()
+        stale = CACHE_LOOKUPS.values().get(('stale',), 0)
+
+        # when
+        spi = self.restarted()
+        found = [spi.storage_lookup(kevin_key), spi.storage_lookup(self.brad)]
+
+        # then
+        self.assertEqual(self.movies.all_movies(), found[0].all_movies())
+        self.assertIsNone(found[1])
+        self.assertEqual(stale + 1, CACHE_LOOKUPS.values()[('stale',)])
+
+    def test_neither_serves_nor_keeps_artists_older_than_max_stale(self):
+        # given
+        storage = SnapshotStorage(InMemoryStorage(), self.snapshot)
+        storage.put(kevin_key, CacheEntry(self.movies, stored_at=time.time() - freshness_settings()['MAX_STALE'] - 1))
+        self.snapshot.flush()
+
+        # when
+        found = self.snapshot.get(kevin_key.as_key())
+        storage.put(self.brad, CacheEntry(self.movies))
+        self.snapshot.flush()
+
+        # then
+        self.assertIsNone(found)
+        self.assertEqual([self.brad.as_key()], list(ArtistSnapshot.objects.values_list('key', flat=True)))
+
+    def test_removes_invalidated_artists(self):
+        # given
+        spi = self.restarted()
+        spi.save_movies(kevin_key, self.movies)
+        self.snapshot.flush()
+
+        # when
+        spi.invalidate(kevin_key)
+        self.snapshot.flush()
+
+        # then
+        self.assertIsNone(self.restarted().storage_lookup(kevin_key))
+        self.assertFalse(ArtistSnapshot.objects.exists())
+
+    def test_looks_up_many_artists_in_one_query(self):
+        # given
+        spi = self.restarted()
+        spi.save_movies(kevin_key, self.movies)
+        spi.save_movies(self.brad, self.movies)
+        self.snapshot.flush()
+
+        # when
+        with self.assertNumQueries(1):
+            found = self.restarted().storage_lookup_many([kevin_key, self.brad, self.tom])
+
+        # then
+        self.assertEqual({kevin_key.as_key(), self.brad.as_key()}, set(found))
+
+    def test_async_storage_serves_artists_missing_from_memcached(self):
+        # given
+        self.restarted().save_movies(kevin_key, self.movies)
+        self.snapshot.flush()
+        memcached = AsyncInMemoryStorage()
+        storage = AsyncSnapshotStorage(memcached, self.snapshot)
+
+        # when
+        entry = async_to_sync(storage.get)(kevin_key)
+
+        # then
+        self.assertEqual(self.movies.all_movies(), entry.movies.all_movies())
+        self.assertIsNotNone(memcached.storage.get(kevin_key))
+
+    def test_is_put_in_front_of_memcached_when_enabled(self):
+        with override_settings(SNAPSHOT={'ENABLED': True}, LOCAL_CACHE={'ENABLED': True}):
+            self.assertIsInstance(get_storage(False).shared, SnapshotStorage)
+        with override_settings(SNAPSHOT={'ENABLED': False}, LOCAL_CACHE={'ENABLED': True}):
+            self.assertIsInstance(get_storage(False).shared, MemCached)
+
+
+@override_settings(ROOT_URLCONF=settings_api.ROOT_URLCONF, MIDDLEWARE=settings_api.MIDDLEWARE)
+class ApiProfileTests(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super(ApiProfileTests, self).__init__(*args, **kwargs)
+        self.movies = Movies(artist_name=kevin_key)
+
+        for test_movie in test_movies:
+            self.movies.add(test_movie)
+
+    def test_serves_movies_with_and_without_trailing_slash(self):
+        # given
+        in_mem_cache = CacheSpi(in_memory=True)
+        in_mem_cache.save_movies(kevin_key, self.movies)
+
+        for path in ('/api/v1/movies', '/api/v1/movies/'):
+            # when
+            with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache):
+                response = self.client.get(path, {'firstname': 'kevin', 'lastname': 'hart', 'genre': 'drama'})
+
+            # then
+            self.assertEqual(200, response.status_code, path)
+            self.assertEqual(['title_2'], [movie['name'] for movie in json.loads(response.content)['kevin hart']])
+
+    def test_takes_batches_without_csrf_middleware(self):
+        response = self.client.post('/api/v1/movies/batch', '{"artists": []}', content_type='application/json')
+
+        self.assertEqual(400, response.status_code)
+
+
+class LoggingTests(TestCase):
+
+    def test_writes_records_out_on_a_background_thread(self):
+        # given
+        stream = io.StringIO()
+        handler = QueuedHandler(stream=stream)
+        logger = logging.getLogger('movies_api.tests.queued')
+        logger.addHandler(handler)
+        logger.propagate = False
+        formatted_on = []
+
+        class Artist:
+            def __str__(self):
+                formatted_on.append(threading.current_thread())
+                return 'kevin hart'
+
+        # when
+        try:
+            logger.warning("Returning details for artist '%s'", Artist())
+            handler.flush()
+        finally:
+            logger.removeHandler(handler)
+            handler.close()
+
+        # then
+        self.assertEqual("Returning details for artist 'kevin hart'\n", stream.getvalue())
+        self.assertNotIn(threading.current_thread(), formatted_on)
+
+    def test_drops_records_when_queue_is_full(self):
+        # given
+        handler = QueuedHandler(capacity=2, stream=io.StringIO())
+        handler.listener.stop()
+        dropped = LOG_RECORDS_DROPPED.values().get(('full',), 0)
+        record = logging.LogRecord('movies_api', logging.INFO, __file__, 1, 'message', None, None)
+
+        # when
+        for _ in range(5):
+            handler.handle(record)
+        handler.close()
+
+        # then
+        self.assertEqual(dropped + 3, LOG_RECORDS_DROPPED.values()[('full',)])
+
+    def test_samples_records_of_listed_loggers_up_to_level(self):
+        # given
+        sampling = SamplingFilter(rates={'movies_api.models': 0.1, 'movies_api.views': 0})
+
+        def record(name, level=logging.DEBUG):
+            return logging.LogRecord(name, level, __file__, 1, 'message', None, None)
+
+        # when
+        models_kept = sum(sampling.filter(record('movies_api.models')) for _ in range(100))
+        views_kept = sum(sampling.filter(record('movies_api.views')) for _ in range(100))
+        others_kept = sum(sampling.filter(record('movies_api.movie_requests')) for _ in range(100))
+        warnings_kept = sum(sampling.filter(record('movies_api.models', logging.WARNING)) for _ in range(100))
+
+        # then
+        self.assertEqual((10, 0, 100, 100), (models_kept, views_kept, others_kept, warnings_kept))
+
+
+class ServerTimingTests(TestCase):
+
+    def get_kevin(self, **headers):
+        in_mem_cache = CacheSpi(in_memory=True)
+        movies = Movies(artist_name=kevin_key)
+        movies.add(test_movies[0])
+        in_mem_cache.save_movies(kevin_key, movies)
+        with mock.patch('movies_api.movie_requests.cache_spi', in_mem_cache), \
+                mock.patch('movies_api.movie_requests.response_cache', ResponseCache(None)):
+            return self.client.get('/api/v1/movies/?firstname=kevin&lastname=hart&genre=comedy', **headers)
+
+    def test_reports_stages_of_the_request(self):
+        # when
+        response = self.get_kevin()
+
+        # then
+        timings = dict(metric.split(';dur=') for metric in response['Server-Timing'].split(', '))
+        self.assertEqual(['lookup', 'filter', 'serialize', 'view', 'total'], list(timings))
+        self.assertLessEqual(float(timings['view']), float(timings['total']))
+
+    def test_reports_stages_of_async_requests(self):
+        # given
+        async def get_response(request):
+            with stage('upstream'):
+                await asyncio.sleep(0.01)
+            return HttpResponse('ok')
+
+        middleware = ServerTimingMiddleware(get_response)
+
+        # when
+        response = async_to_sync(middleware)(mock.Mock(spec=[]))
+
+        # then
+        upstream, total = (float(metric.split(';dur=')[1]) for metric in response['Server-Timing'].split(', '))
+        self.assertGreaterEqual(upstream, 10)
+        self.assertGreaterEqual(total, upstream)
+
+    def test_reports_stages_of_artists_fetched_for_a_batch(self):
+        # given
+        handler = RequestHandler(CacheSpi(in_memory=True), ThirdParty(None))
+
+        def fetch(key):
+            with stage('upstream'):
+                time.sleep(0.01)
+            return Movies(artist_name=key)
+
+        def get_response(request):
+            handler.get_many([kevin_key, Key('brad', 'pitt')], max_parallelism=2)
+            return HttpResponse('ok')
+
+        # when
+        with mock.patch.object(handler, '_fetch', side_effect=fetch):
+            response = ServerTimingMiddleware(get_response)(mock.Mock(spec=[]))
+
+        # then
+        timings = dict(metric.split(';dur=') for metric in response['Server-Timing'].split(', '))
+        self.assertGreaterEqual(float(timings['upstream']), 20)
+
+    def test_profiles_requests_carrying_the_token(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                override_settings(PROFILING={'TOKEN': 'secret', 'DIRECTORY': directory}):
+            # when
+            unprofiled = self.get_kevin(HTTP_X_PROFILE='guess')
+            profiled = self.get_kevin(HTTP_X_PROFILE='secret')
+
+            # then
+            self.assertFalse(unprofiled.has_header('X-Profile-Id'))
+            self.assertEqual([profiled['X-Profile-Id']], os.listdir(directory))
+            stats = pstats.Stats(os.path.join(directory, profiled['X-Profile-Id']))
+            self.assertTrue(any(function == 'get_response' for _, _, function in stats.stats))
+
+
+class JsonCodecTests(TestCase):
+    content = json.dumps({'resultCount': 3, 'results': [
+        {'trackName': 'title_1', 'releaseDate': '2013-07-03T07:00:00Z', 'primaryGenreName': 'Comedy',
+         'artwork': {'url': 'https://example.com/1.jpg'}, 'trackPrice': 9.99},
+        {'trackName': 'title_2', 'releaseDate': '2017-07-03T07:00:00Z'},
+        {'kind': 'feature-movie', 'releaseDate': '2020-07-03T07:00:00Z', 'primaryGenreName': 'Drama'},
+    ]})
+
+    def test_projection_parses_the_same_fields_as_a_full_parse(self):
+        # when
+        projected = json_codec.load_results(self.content, API_FIELDS, projection=True)
+        full = json_codec.load_results(self.content, API_FIELDS, projection=False)
+
+        # then
+        self.assertEqual(projected, [('title_1', '2013-07-03T07:00:00Z', 'Comedy')])
+        self.assertEqual(projected, full)
+
+    def test_results_missing_a_field_are_dropped_before_they_are_cached(self):
+        # given
+        content = json.dumps({'results': json.loads(self.content)['results'] + [
+            {'trackName': 'title_4', 'releaseDate': '2021-07-03T07:00:00Z', 'primaryGenreName': None}]})
+
+        # when
+        movies = to_movies(kevin_key, 200, content)
+
+        # then
+        self.assertEqual(['title_1'], [row[0] for row in movies.rows])
+        self.assertEqual(1, len(movies.matching(genre='comedy')))
+        self.assertIsNotNone(from_stored(encode_entry(CacheEntry(movies))))
+
+    def test_falls_back_to_the_standard_library(self):
+        with override_settings(JSON_CODEC={'BACKEND': 'stdlib'}), mock.patch.object(json, 'loads', wraps=json.loads):
+            self.assertEqual(json_codec.STDLIB, json_codec.backend())
+            self.assertTrue(json_codec.projecting())
+            self.assertEqual('{"a": [1, "b"]}', json_codec.dumps({'a': [1, 'b']}))
+            json_codec.load_results(self.content, API_FIELDS)
+            self.assertIn('object_hook', json.loads.call_args.kwargs)
+
+    @skipIf(json_codec.orjson is None, "orjson is not installed")
+    def test_encodes_the_same_values_with_orjson(self):
+        # given
+        value = {'kevin hart': [{'name': 'Ça ira', 'release date': 2013, 'genre': 'Comedy'}]}
+
+        # when
+        with override_settings(JSON_CODEC={'BACKEND': 'orjson'}):
+            encoded = json_codec.dumps(value)
+
+        # then
+        self.assertEqual(value, json.loads(encoded))
+        self.assertEqual(json_codec.dumps_bytes(value), encoded.encode())
+
+
+class MoviesTests(TestCase):
+
+    def test_should_add_movies(self):
+        movies = Movies(artist_name=kevin_key)
+        test_movies = [
+            Movie('title_1', '2013-07-03T07:00:00Z', 'Comedy'),
+            Movie('title_2', '2017-07-03T07:00:00Z', 'Drama'),
+            Movie('title_3', '2020-07-03T07:00:00Z', 'Thriller')
+        ]
+
+        for test_movie in test_movies:
+            movies.add(test_movie)
+
+        self.assertTrue(len(movies.all_movies()) == 3)
+
+    def test_should_select_movies_from_index_in_any_case(self):
+        movies = Movies(artist_name=kevin_key)
+        for test_movie in test_movies:
+            movies.add(test_movie)
+        movies.build_index()
+
+        selected = movies.select(kevin_key, genre='dRaMa', release_date=2017)
+
+        self.assertEqual(['title_2'], [movie['name'] for movie in selected.all_movies()])
+
+    def test_should_rebuild_index_when_movies_are_added(self):
+        movies = Movies(artist_name=kevin_key)
+        movies.add(test_movies[0])
+        movies.build_index()
+
+        movies.add(Movie('title_4', '2013-01-03T07:00:00Z', 'Comedy'))
+
+        self.assertEqual(2, len(movies.select(kevin_key, genre='comedy').all_movies()))
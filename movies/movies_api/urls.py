@@ -1,7 +1,9 @@
+from django.conf import settings
 from django.urls import path
 
 from . import views
 
 urlpatterns = [
-    path('movies/', views.actor_movies, name='actor_movies'),
+    path('movies/', views.actor_movies_async if settings.ASYNC_VIEWS else views.actor_movies, name='actor_movies'),
+    path('movies/batch/', views.batch_actor_movies, name='batch_actor_movies'),
 ]
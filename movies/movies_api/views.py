@@ -1,9 +1,17 @@
 from django.http import HttpResponse
-import requests
-import json
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 
+from .json_codec import loads
+from .metrics import CONTENT_TYPE
+from .metrics import registry
 from .models import Key
+from .movie_requests import NDJSON
+from .movie_requests import batch_settings
+from .movie_requests import get_batch_response
+from .movie_requests import get_batch_streaming_response
 from .movie_requests import get_response
+from .movie_requests import get_streaming_response
 import logging
 logger = logging.getLogger(__name__)
 
@@ -11,20 +19,109 @@ logger = logging.getLogger(__name__)
 def actor_movies(request):
     try:
         key = validate_request(request)
-        logger.info(f"Processing http request {request.__str__()}")
-        return get_response(key)
+        logger.info("Processing http request %s", request)
+        if wants_stream(request):
+            return get_streaming_response(key)
+        return get_response(key, request.META.get('HTTP_ACCEPT_ENCODING', ''), request)
     except ValueError:
-        return HttpResponse('Bad request', 400)
+        return HttpResponse('Bad request', status=400)
+
+
+async def actor_movies_async(request):
+    # the non-blocking pipeline and httpx are only loaded when these views are served, see MoviesApiConfig.ready
+    from .async_movie_requests import get_response_async
+    from .async_movie_requests import get_streaming_response_async
+    try:
+        key = validate_request(request)
+        logger.info("Processing http request %s", request)
+        if wants_stream(request):
+            return await get_streaming_response_async(key)
+        return await get_response_async(key, request.META.get('HTTP_ACCEPT_ENCODING', ''), request)
+    except ValueError:
+        return HttpResponse('Bad request', status=400)
+
+
+@csrf_exempt
+@require_POST
+def batch_actor_movies(request):
+    try:
+        keys = validate_batch_request(request)
+        logger.info("Processing http request %s for %d artists", request, len(keys))
+        if wants_stream(request):
+            return get_batch_streaming_response(keys)
+        return get_batch_response(keys)
+    except ValueError:
+        return HttpResponse('Bad request', status=400)
+
+
+def metrics(request):
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
+
+
+def wants_stream(request):
+    """ Returns True if the client asks for newline delimited json, by the format query parameter or the Accept header
+    """
+    return request.GET.get('format') == 'ndjson' or NDJSON in request.META.get('HTTP_ACCEPT', '')
 
 
 def validate_request(request):
-    firstname = request.GET.get('firstname')
-    lastname = request.GET.get('lastname')
-    genre = request.GET.get('genre', 'all')
-    release_date = request.GET.get('releaseDate', 9999)
+    return to_key(request.GET)
+
+
+def validate_batch_request(request):
+    """ Validates a batch request, whose body is a json object holding the queries of each artist, eg:
+        {"artists": [{"firstname": "kevin", "lastname": "hart", "genre": "comedy"}, ...]}
+    """
+    try:
+        queries = loads(request.body)['artists']
+    except (ValueError, KeyError, TypeError):
+        raise ValueError('the body needs to be a json object holding a list of artists')
+    if not isinstance(queries, list) or not 0 < len(queries) <= batch_settings()['MAX_SIZE']:
+        raise ValueError(f"between 1 and {batch_settings()['MAX_SIZE']} artists need to be provided")
+    if not all(isinstance(query, dict) for query in queries):
+        raise ValueError('each artist needs to be a json object')
+    return [to_key(query) for query in queries]
+
+
+# names of the details of a movie in the fields parameter, and the names they are returned under
+FIELDS = {'name': 'name', 'releaseDate': 'release date', 'release date': 'release date', 'genre': 'genre'}
+
+
+def to_key(query):
+    firstname = query.get('firstname')
+    lastname = query.get('lastname')
+    genre = query.get('genre', 'all')
+    release_date = query.get('releaseDate', 9999)
     if firstname is None or lastname is None:
         raise ValueError('firstname and lastname need to be provided')
+    if not all(isinstance(value, str) for value in (firstname, lastname, genre)):
+        raise ValueError('firstname, lastname and genre need to be strings')
+    if isinstance(release_date, bool) or not isinstance(release_date, (int, str)):
+        raise ValueError('releaseDate needs to be a year')
+
+    key = Key(firstname=firstname, lastname=lastname, genre=genre, release_date=release_date,
+              offset=to_count(query.get('offset'), 'offset', default=0), limit=to_count(query.get('limit'), 'limit'),
+              fields=to_fields(query.get('fields')))
+    key.get_release_date()  # raises ValueError if it is not a year
+    return key
+
 
-    return Key(firstname=firstname, lastname=lastname, genre=genre, release_date=release_date)
+def to_count(value, name, default=None):
+    """ Validates the offset or limit of a page, which is a whole number given as such or as a string, and gets
+        default when it is not given or null
+    """
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, (int, str)) or not str(value).isdigit():
+        raise ValueError(f'{name} needs to be a whole number')
+    return int(value)
 
 
+def to_fields(value):
+    """ Validates the details of each movie asked for, given as a comma separated string or as a list of names """
+    if value is None:
+        return None
+    names = value.split(',') if isinstance(value, str) else value
+    if not isinstance(names, list) or not names or not all(isinstance(name, str) and name in FIELDS for name in names):
+        raise ValueError(f"fields need to be some of {', '.join(name for name in FIELDS if ' ' not in name)}")
+    return [FIELDS[name] for name in names]